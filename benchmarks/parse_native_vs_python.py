@@ -0,0 +1,102 @@
+#!/bin/env python
+
+import argparse
+import collections
+import json
+import os
+import sys
+import tempfile
+import time
+
+import pytrec_eval
+
+
+def python_parse_run(path):
+    with open(path, 'r') as f_run:
+        return pytrec_eval.parse_run(f_run)
+
+
+def python_parse_qrel(path):
+    with open(path, 'r') as f_qrel:
+        return pytrec_eval.parse_qrel(f_qrel)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--tmp_dir', type=str, default=None)
+    parser.add_argument('--num_repeats', type=int, default=5)
+
+    parser.add_argument('--measurements_out', type=str, required=True)
+
+    args = parser.parse_args()
+
+    print(args)
+
+    all_measurements = []
+
+    for num_queries in (10, 100, 1000, 10000):
+        for num_documents_per_query in (10, 100, 1000):
+            with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+                run_path = os.path.join(tmp_dir, 'run')
+                qrel_path = os.path.join(tmp_dir, 'qrel')
+
+                with open(run_path, 'w') as f_run, \
+                        open(qrel_path, 'w') as f_qrel:
+                    for query_idx in range(num_queries):
+                        for document_idx in range(num_documents_per_query):
+                            f_run.write(
+                                'query_{} Q0 document_{} {} {:.6f} test\n'
+                                .format(query_idx, document_idx,
+                                        document_idx + 1,
+                                        1.0 / (document_idx + 1)))
+                            f_qrel.write(
+                                'query_{} 0 document_{} {}\n'
+                                .format(query_idx, document_idx,
+                                        document_idx % 2))
+
+                durations = collections.OrderedDict()
+
+                for name, parse_fn, path in (
+                        ('python_run_time', python_parse_run, run_path),
+                        ('native_run_time',
+                         pytrec_eval.parse_run_file,
+                         run_path),
+                        ('python_qrel_time', python_parse_qrel, qrel_path),
+                        ('native_qrel_time',
+                         pytrec_eval.parse_qrel_file,
+                         qrel_path)):
+                    start_time = time.time()
+
+                    for _ in range(args.num_repeats):
+                        parse_fn(path)
+
+                    end_time = time.time()
+
+                    durations[name] = \
+                        (end_time - start_time) / args.num_repeats
+
+            measurement = collections.OrderedDict([
+                ('num_queries', num_queries),
+                ('num_documents_per_query', num_documents_per_query),
+            ])
+
+            measurement.update(durations)
+
+            measurement['run_speedup'] = \
+                durations['python_run_time'] / durations['native_run_time']
+            measurement['qrel_speedup'] = \
+                durations['python_qrel_time'] / durations['native_qrel_time']
+
+            print(json.dumps(measurement))
+
+            all_measurements.append(measurement)
+
+    if all_measurements:
+        with open(args.measurements_out, 'w') as f_measurements_out:
+            for measurement in all_measurements:
+                f_measurements_out.write(json.dumps(measurement))
+                f_measurements_out.write('\n')
+
+if __name__ == '__main__':
+    sys.exit(main())
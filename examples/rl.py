@@ -183,18 +183,19 @@ class RetrievalEnv(gym.Env):
             query_str = None
 
         if not query_str:
-            self.state['cache'][query_str] = {'0': {}}
+            self.state['cache'][query_str] = {'0': []}
         elif query_str not in self.state['cache']:
-            document_scores = {
-                self.index.ext_document_id(internal_doc_id): score
-                for internal_doc_id, score in
-                self.index.query(query_str, results_requested=10)}
+            # Results are returned in ranking order.
+            ranking = [
+                self.index.ext_document_id(internal_doc_id)
+                for internal_doc_id, _ in
+                self.index.query(query_str, results_requested=10)]
 
-            self.state['cache'][query_str] = {'0': document_scores}
+            self.state['cache'][query_str] = {'0': ranking}
 
-        run = self.state['cache'][query_str]
+        rankings = self.state['cache'][query_str]
 
-        evaluation = self.state['evaluator'].evaluate(run)
+        evaluation = self.state['evaluator'].evaluate_ranked(rankings)
         utility = evaluation['0'][self.measure]
 
         return utility
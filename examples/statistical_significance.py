@@ -2,10 +2,12 @@
 
 import argparse
 import os
-import scipy.stats
 import sys
 
+import numpy as np
+
 import pytrec_eval
+from pytrec_eval import significance
 
 
 def main():
@@ -20,6 +22,9 @@ def main():
                         choices=pytrec_eval.supported_measures,
                         required=True)
 
+    parser.add_argument('--num_permutations', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=None)
+
     args = parser.parse_args()
 
     assert os.path.exists(args.qrel)
@@ -37,18 +42,25 @@ def main():
     evaluator = pytrec_eval.RelevanceEvaluator(
         qrel, {args.measure})
 
-    first_results = evaluator.evaluate(first_run)
-    second_results = evaluator.evaluate(second_run)
-
-    query_ids = list(
-        set(first_results.keys()) & set(second_results.keys()))
-
-    first_scores = [
-        first_results[query_id][args.measure] for query_id in query_ids]
-    second_scores = [
-        second_results[query_id][args.measure] for query_id in query_ids]
-
-    print(scipy.stats.ttest_rel(first_scores, second_scores))
+    results = evaluator.evaluate_many([first_run, second_run])
+
+    # Only compare queries that both runs rank.
+    ranked_by_both = ~np.isnan(results.values).any(axis=(0, 2))
+    first_scores, second_scores = results.values[:, ranked_by_both]
+
+    for test_name, result in (
+            ('t-test',
+             significance.t_test(first_scores, second_scores)),
+            ('wilcoxon',
+             significance.wilcoxon_test(first_scores, second_scores)),
+            ('randomization',
+             significance.randomization_test(
+                 first_scores, second_scores,
+                 num_permutations=args.num_permutations, seed=args.seed))):
+        for measure, statistic, pvalue in zip(
+                results.measures, result.statistic, result.pvalue):
+            print('{}\t{}\t{:.4f}\t{:.4g}'.format(
+                test_name, measure, statistic, pvalue))
 
 if __name__ == "__main__":
     sys.exit(main())
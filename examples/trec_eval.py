@@ -27,7 +27,8 @@ def main():
     evaluator = pytrec_eval.RelevanceEvaluator(
         qrel, pytrec_eval.supported_measures)
 
-    results = evaluator.evaluate(run)
+    results = evaluator.evaluate(run, aggregate=True)
+    aggregates = results.pop('all')
 
     def print_line(measure, scope, value):
         print('{:25s}{:8s}{:.4f}'.format(measure, scope, value))
@@ -36,19 +37,8 @@ def main():
         for measure, value in sorted(query_measures.items()):
             print_line(measure, query_id, value)
 
-    # Scope hack: use query_measures of last item in previous loop to
-    # figure out all unique measure names.
-    #
-    # TODO(cvangysel): add member to RelevanceEvaluator
-    #                  with a list of measure names.
-    for measure in sorted(query_measures.keys()):
-        print_line(
-            measure,
-            'all',
-            pytrec_eval.compute_aggregated_measure(
-                measure,
-                [query_measures[measure]
-                 for query_measures in results.values()]))
+    for measure, value in sorted(aggregates.items()):
+        print_line(measure, 'all', value)
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -2,17 +2,33 @@
 
 import re
 import collections
+import collections.abc
+import multiprocessing
+import os
 import numpy as np
 
 from pytrec_eval_ext import RelevanceEvaluator as _RelevanceEvaluator
+from pytrec_eval_ext import EvaluationAccumulator
 from pytrec_eval_ext import supported_measures, supported_nicknames
+from pytrec_eval_ext import parse_run_file, parse_qrel_file
+
+from . import vectorized as _vectorized
+from .significance import _query_values
 
 __all__ = [
     'parse_run',
     'parse_qrel',
+    'parse_run_file',
+    'parse_qrel_file',
     'supported_measures',
     'supported_nicknames',
     'RelevanceEvaluator',
+    'EvaluationTensor',
+    'EvaluationMatrix',
+    'EvaluationResults',
+    'EvaluationSession',
+    'EvaluationAccumulator',
+    'BootstrapIntervals',
 ]
 
 
@@ -52,16 +68,492 @@ def compute_aggregated_measure(measure, values):
     return agg_fun(values)
 
 
+# Result of compute_bootstrap_intervals: the aggregated measures and the
+# bounds of their confidence intervals, with measures along the last axis.
+BootstrapIntervals = collections.namedtuple(
+    'BootstrapIntervals', ['estimates', 'lower', 'upper', 'measures'])
+
+# Number of bootstrap samples that are aggregated together.
+_BOOTSTRAP_CHUNK_SIZE = 1000
+
+
+def compute_bootstrap_intervals(results, num_samples=1000, confidence=0.95,
+                                seed=None):
+    """Computes percentile bootstrap confidence intervals of aggregates.
+
+    results is an EvaluationMatrix or an EvaluationTensor (for several
+    runs at once); its row of aggregates (query 'all', as added by
+    evaluate with aggregate=True) is left out. Every bootstrap sample resamples the queries with
+    replacement; the same samples are used for all measures and runs, and
+    are aggregated as matrix products of the per-sample query counts with
+    the values. Measures are aggregated as by compute_aggregated_measure
+    (summed for num_ measures, geometric means for gm_ measures). Returns
+    BootstrapIntervals whose arrays have shape [len(measures)], or [runs,
+    len(measures)] for a tensor.
+    """
+    values = _query_values(results)
+    measures = list(results.measures)
+
+    num_queries = values.shape[-2]
+
+    if num_samples < 1:
+        raise ValueError('num_samples should be positive')
+
+    if num_queries == 0:
+        raise ValueError('results should contain queries')
+
+    if np.isnan(values).any():
+        # E.g., queries that a run of an EvaluationTensor does not rank.
+        raise ValueError('values should not contain NaN')
+
+    is_sum = np.array([measure.startswith('num_') for measure in measures])
+    is_geometric = np.array([measure.startswith('gm_') for measure in measures])
+
+    def aggregate(sums):
+        # Aggregates from sums of per-query values over num_queries queries.
+        return np.where(
+            is_sum, sums,
+            np.where(is_geometric, np.exp(sums / num_queries),
+                     sums / num_queries))
+
+    rng = np.random.default_rng(seed)
+
+    samples = []
+
+    for chunk_start in range(0, num_samples, _BOOTSTRAP_CHUNK_SIZE):
+        num_chunk_samples = min(_BOOTSTRAP_CHUNK_SIZE,
+                                num_samples - chunk_start)
+
+        query_idxs = rng.integers(
+            0, num_queries, size=(num_chunk_samples, num_queries))
+
+        # How often every query occurs in every sample.
+        counts = np.bincount(
+            (query_idxs +
+             num_queries * np.arange(num_chunk_samples)[:, np.newaxis]
+             ).ravel(),
+            minlength=num_chunk_samples * num_queries,
+        ).reshape(num_chunk_samples, num_queries).astype(np.float64)
+
+        samples.append(aggregate(np.matmul(counts, values)))
+
+    samples = np.concatenate(samples, axis=-2)
+
+    alpha = (1.0 - confidence) / 2.0
+    lower, upper = np.quantile(samples, [alpha, 1.0 - alpha], axis=-2)
+
+    return BootstrapIntervals(
+        aggregate(values.sum(axis=-2)), lower, upper, measures)
+
+
+# Result of RelevanceEvaluator.evaluate_many: values has shape [runs,
+# queries, measures], labelled by query_ids and measures.
+EvaluationTensor = collections.namedtuple(
+    'EvaluationTensor', ['values', 'query_ids', 'measures'])
+
+# Columnar result of RelevanceEvaluator.evaluate: values has shape [queries,
+# measures], labelled by query_ids and measures.
+EvaluationMatrix = collections.namedtuple(
+    'EvaluationMatrix', ['values', 'query_ids', 'measures'])
+
+
+class EvaluationResults(collections.abc.Mapping):
+    """Read-only mapping of query identifiers to measures.
+
+    Backed by the array of an EvaluationMatrix; values are only converted
+    to floats when they are looked up, and measure returns a column of the
+    array without copying.
+    """
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+
+        self._query_idxs = None
+        self._measure_idxs = {
+            measure: measure_idx
+            for measure_idx, measure in enumerate(matrix.measures)}
+
+    def __getitem__(self, query_id):
+        if self._query_idxs is None:
+            self._query_idxs = {
+                query_id: query_idx
+                for query_idx, query_id in enumerate(self.matrix.query_ids)}
+
+        return _QueryMeasures(
+            self.matrix.values[self._query_idxs[query_id]],
+            self._measure_idxs)
+
+    def __iter__(self):
+        return iter(self.matrix.query_ids)
+
+    def __len__(self):
+        return len(self.matrix.query_ids)
+
+    @property
+    def measures(self):
+        return self.matrix.measures
+
+    def measure(self, measure):
+        """Returns the values of measure for all queries, in iteration order."""
+        return self.matrix.values[:, self._measure_idxs[measure]]
+
+
+class _QueryMeasures(collections.abc.Mapping):
+
+    def __init__(self, row, measure_idxs):
+        self._row = row
+        self._measure_idxs = measure_idxs
+
+    def __getitem__(self, measure):
+        return float(self._row[self._measure_idxs[measure]])
+
+    def __iter__(self):
+        return iter(self._measure_idxs)
+
+    def __len__(self):
+        return len(self._measure_idxs)
+
+
+# State of an evaluate_parallel worker process (see _init_parallel_worker):
+# the evaluator, and the full run when it is inherited through fork.
+_parallel_evaluator = None
+_parallel_scores = None
+
+
+def _init_parallel_worker(evaluator, scores):
+    global _parallel_evaluator, _parallel_scores
+
+    _parallel_evaluator, _parallel_scores = evaluator, scores
+
+
+def _evaluate_parallel_shard(shard):
+    if _parallel_scores is not None:
+        # Query identifiers into the inherited run.
+        shard = {qid: _parallel_scores[qid] for qid in shard}
+
+    return _parallel_evaluator.evaluate(shard)
+
+
+def _evaluation_matrix(values, query_ids, measures):
+    # Wraps the buffer of a native columnar result.
+    values = np.frombuffer(values, dtype=np.float64).reshape(
+        len(query_ids), len(measures))
+
+    return EvaluationMatrix(values, query_ids, measures)
+
+
+def _restore_evaluator(cls, query_relevance, init_kwargs, documents,
+                       candidates):
+    evaluator = cls.__new__(cls)
+
+    # Intern documents first, such that they keep their identifiers.
+    evaluator.intern_documents(documents)
+    evaluator._init_native(query_relevance=query_relevance, **init_kwargs)
+
+    if candidates is not None:
+        evaluator.set_candidates(candidates)
+
+    return evaluator
+
+
 class RelevanceEvaluator(_RelevanceEvaluator):
-    def __init__(self, query_relevance, measures, relevance_level=1):
+    _candidates = None
+    _dense_judgments = None
+
+    def __init__(self, query_relevance, measures, relevance_level=1,
+                 depth=None, fused=True):
+        """Builds an evaluator from a dictionary of judgments.
+
+        If depth is given, only the top depth documents of every ranking are
+        considered, as with trec_eval's -M option. Regardless, rankings are
+        only ordered as deep as the largest cutoff of the measures requires.
+
+        Unless fused is False, common measures (e.g., P, recall, map, ndcg
+        and their cutoff variants, bpref) are computed together in a single
+        pass over every ranking instead of one trec_eval pass per measure;
+        their values are the same.
+        """
         measures = self._expand_nicknames(measures)
         measures = self._combine_measures(measures)
-        super().__init__(query_relevance=query_relevance, measures=measures, relevance_level=relevance_level)
+        self._init_native(query_relevance=query_relevance, measures=measures, relevance_level=relevance_level,
+                          fused=fused, **self._depth_kwargs(depth))
+
+    @classmethod
+    def from_qrel_file(cls, path, measures, relevance_level=1, depth=None):
+        """Builds an evaluator from a TREC qrel file.
+
+        The judgments are read directly into the native structures, without
+        going through a dictionary as returned by parse_qrel.
+        """
+        return cls._from_native_qrels(
+            measures, relevance_level, depth, qrel_path=path)
+
+    @classmethod
+    def from_arrays(cls, qids, docids, relevances, measures,
+                    relevance_level=1, offsets=None, depth=None):
+        """Builds an evaluator from arrays of integer identifiers.
+
+        Accepts the same layout as evaluate_arrays, with relevance labels
+        instead of scores. Identifiers are matched by their decimal string
+        representation.
+        """
+        return cls._from_native_qrels(
+            measures, relevance_level, depth,
+            qrel_arrays=(qids, docids, relevances, offsets))
+
+    def with_measures(self, measures, relevance_level=None):
+        """Returns an evaluator for other measures over the same judgments.
+
+        The judgments are shared with this evaluator instead of being copied
+        and sorted again, so only the measures are resolved. The new
+        evaluator keeps the depth and candidate documents of this one, and
+        its relevance level unless one is given.
+        """
+        if relevance_level is None:
+            relevance_level = self._init_kwargs['relevance_level']
+
+        evaluator = self._from_native_qrels(
+            measures, relevance_level, self._init_kwargs.get('depth'),
+            judgments_of=self, fused=self._init_kwargs.get('fused', True))
+        evaluator._candidates = self._candidates
+
+        return evaluator
+
+    @classmethod
+    def _from_native_qrels(cls, measures, relevance_level, depth, **kwargs):
+        evaluator = cls.__new__(cls)
+
+        measures = evaluator._expand_nicknames(measures)
+        measures = evaluator._combine_measures(measures)
+        kwargs.update(evaluator._depth_kwargs(depth))
+        evaluator._init_native(
+            query_relevance=None, measures=measures,
+            relevance_level=relevance_level, **kwargs)
+
+        return evaluator
+
+    def _init_native(self, query_relevance, measures, relevance_level,
+                     **kwargs):
+        _RelevanceEvaluator.__init__(
+            self, query_relevance=query_relevance, measures=measures,
+            relevance_level=relevance_level, **kwargs)
 
-    def evaluate(self, scores):
-        if not scores:
-            return {}
-        return super().evaluate(scores)
+        # Kept for pickling; the source of the judgments is not.
+        self._init_kwargs = dict(measures=measures,
+                                 relevance_level=relevance_level)
+        for key in ('depth', 'fused'):
+            if key in kwargs:
+                self._init_kwargs[key] = kwargs[key]
+
+    @staticmethod
+    def _depth_kwargs(depth):
+        return {'depth': depth} if depth is not None else {}
+
+    def __reduce__(self):
+        return (_restore_evaluator,
+                (type(self), self.query_relevance(), self._init_kwargs,
+                 self.interned_documents(), self._candidates))
+
+    def evaluate(self, scores, num_threads=1, aggregate=False,
+                 columnar=False, lazy=False):
+        """Evaluates a run given as a dictionary of document scores.
+
+        With num_threads > 1, queries are ranked and evaluated on native
+        threads without holding the GIL.
+
+        With aggregate=True, the result additionally maps 'all' to the
+        aggregates over the evaluated queries, as summarized by trec_eval
+        (see compute_aggregated_measure). With aggregate='only', the result
+        only holds the aggregates, and per-query dictionaries are never
+        built.
+
+        With columnar=True, returns an EvaluationMatrix instead, holding a
+        float64 array with a row per query (and a final 'all' row when
+        aggregating) and a column per measure. This avoids creating a
+        dictionary and a float object for every query and measure. With
+        lazy=True, returns an EvaluationResults mapping over that array,
+        which behaves like the default result but converts values on
+        demand.
+        """
+        if aggregate not in (False, True, 'only'):
+            raise ValueError(
+                'aggregate should be False, True or \'only\'.')
+
+        result = super().evaluate(scores, num_threads=num_threads,
+                                  aggregate=bool(aggregate),
+                                  per_query=aggregate != 'only',
+                                  columnar=bool(columnar or lazy))
+
+        if columnar or lazy:
+            matrix = _evaluation_matrix(*result)
+
+            if lazy:
+                matrix.values.flags.writeable = False
+
+                return EvaluationResults(matrix)
+
+            return matrix
+
+        return result
+
+    def evaluate_parallel(self, scores, processes=None, start_method=None):
+        """Evaluates a run by sharding its queries across processes.
+
+        start_method defaults to that of multiprocessing. With 'fork',
+        workers inherit the evaluator and the run, and only query
+        identifiers and per-query results are transferred. Only fork avoids
+        re-pickling: with other start methods (e.g., 'spawn'), the
+        evaluator is pickled for every worker, which rebuilds the judgments
+        from a dictionary (see query_relevance), and every worker receives
+        a pickled copy of its shard of the run.
+        """
+        if processes is None:
+            processes = os.cpu_count() or 1
+
+        if start_method is None:
+            start_method = multiprocessing.get_start_method()
+
+        qids = list(scores)
+        processes = max(1, min(processes, len(qids)))
+
+        if processes == 1:
+            return self.evaluate(scores)
+
+        shards = [qids[shard_idx::processes]
+                  for shard_idx in range(processes)]
+
+        if start_method == 'fork':
+            # Forked workers receive the initializer arguments unpickled.
+            initargs = (self, scores)
+        else:
+            initargs = (self, None)
+            shards = [{qid: scores[qid] for qid in shard}
+                      for shard in shards]
+
+        result = {}
+
+        with multiprocessing.get_context(start_method).Pool(
+                processes, initializer=_init_parallel_worker,
+                initargs=initargs) as pool:
+            for shard_result in pool.imap_unordered(
+                    _evaluate_parallel_shard, shards):
+                result.update(shard_result)
+
+        return result
+
+    def evaluate_many(self, runs, num_threads=1):
+        """Evaluates several runs into a dense array of measure values.
+
+        Every run is either a dictionary as accepted by evaluate, or a tuple
+        of (qids, docids, scores[, offsets]) arrays as accepted by
+        evaluate_arrays. Returns an EvaluationTensor whose values have shape
+        [len(runs), len(query_ids), len(measures)]; queries follow the order
+        of the judgments, and queries missing from a run are NaN. With
+        num_threads > 1, all queries of all runs are evaluated on native
+        threads without holding the GIL.
+        """
+        runs = list(runs)
+
+        values, query_ids, measures = super().evaluate_many(
+            runs, num_threads=num_threads)
+
+        values = np.frombuffer(values, dtype=np.float64).reshape(
+            len(runs), len(query_ids), len(measures))
+
+        return EvaluationTensor(values, query_ids, measures)
+
+    def evaluate_curves(self, scores, measures=('P', 'recall', 'ndcg_cut'),
+                        depth=1000):
+        """Evaluates cutoff measures at every rank from 1 to depth.
+
+        measures may contain P, recall, success, map_cut and ndcg_cut.
+        Returns a dictionary that maps every query to a dictionary of
+        measures to arrays of length depth, where element k - 1 equals the
+        measure at cutoff k (e.g., P_k). Every curve is computed in a single
+        pass over the ranking.
+        """
+        measures = list(measures)
+
+        values, query_ids = super().evaluate_curves(scores, measures, depth)
+
+        values = np.frombuffer(values, dtype=np.float64).reshape(
+            len(query_ids), len(measures), depth)
+
+        return {
+            query_id: dict(zip(measures, query_values))
+            for query_id, query_values in zip(query_ids, values)
+        }
+
+    def evaluate_matrix(self, scores, vectorized=False, columnar=False):
+        """Evaluates a score matrix over the candidates of set_candidates.
+
+        With vectorized=True, all queries are ranked and evaluated at once
+        with NumPy instead of trec_eval, which is considerably faster for
+        many queries. This supports ndcg, ndcg_cut, P, recall, map,
+        recip_rank and Rprec (see pytrec_eval.vectorized), with the same
+        values as trec_eval.
+
+        Either way, returns a dictionary of queries to measures, or with
+        columnar=True, an EvaluationMatrix whose columns follow measures.
+        """
+        if not vectorized:
+            result = super().evaluate_matrix(scores, columnar=columnar)
+
+            return _evaluation_matrix(*result) if columnar else result
+
+        if self._candidates is None:
+            raise ValueError(
+                'No candidates were set; call set_candidates first.')
+
+        if self._dense_judgments is None:
+            self._dense_judgments = _vectorized.DenseJudgments(
+                list(self._candidates.keys()),
+                list(self._candidates.values()),
+                self.query_relevance(),
+                self._init_kwargs['relevance_level'])
+
+        values, query_ids, measures = _vectorized.evaluate(
+            self._dense_judgments, scores, self._init_kwargs['measures'],
+            depth=self._init_kwargs.get('depth'))
+
+        # Order the columns as the trec_eval engine does.
+        column_idxs = [list(measures).index(measure)
+                       for measure in self.measures]
+        values, measures = values[:, column_idxs], self.measures
+
+        if columnar:
+            return EvaluationMatrix(values, query_ids, measures)
+
+        return {
+            query_id: dict(zip(measures, query_values))
+            for query_id, query_values in zip(query_ids, values.tolist())
+        }
+
+    def intern_documents(self, docnos):
+        """Maps document identifiers to integer identifiers.
+
+        Judged documents are interned when the evaluator is built; unseen
+        identifiers are added. The returned int64 array can be passed to
+        evaluate_arrays with interned=True, which then skips all string
+        handling.
+        """
+        return np.frombuffer(super().intern_documents(docnos), dtype=np.int64)
+
+    def set_candidates(self, candidates):
+        """Fixes the candidate documents of every query for evaluate_matrix.
+
+        candidates maps query identifiers to sequences of document
+        identifiers; its iteration order determines the row order of the
+        score matrices. Rows of queries with fewer candidates than the
+        widest row are padded, and the padding is ignored.
+        """
+        candidates = dict(candidates)
+
+        super().set_candidates(list(candidates.keys()),
+                               list(candidates.values()))
+
+        self._candidates = candidates
+        self._dense_judgments = None
 
     def _expand_nicknames(self, measures):
         # Expand nicknames (e.g., official, all_trec)
@@ -102,3 +594,76 @@ class RelevanceEvaluator(_RelevanceEvaluator):
             fmt_meas.add(meas)
 
         return fmt_meas
+
+
+class EvaluationSession(object):
+    """Maintains the per-query results and aggregates of a run.
+
+    After evaluating a full run, update re-evaluates only the queries of a
+    partial run and adjusts the aggregates (following the rules of
+    compute_aggregated_measure) in time linear in the number of updated
+    queries.
+    """
+
+    def __init__(self, evaluator, run=None, num_threads=1):
+        self.evaluator = evaluator
+
+        self._results = {}
+
+        # Per measure, the sum of the values and the number of queries.
+        self._sums = collections.defaultdict(float)
+        self._counts = collections.defaultdict(int)
+
+        if run:
+            self.update(run, num_threads=num_threads)
+
+    @property
+    def results(self):
+        """Per-query results of the most recent ranking of every query."""
+        return self._results
+
+    def update(self, partial_run, num_threads=1):
+        """Evaluates the rankings of partial_run, replacing earlier ones.
+
+        Returns the results of the evaluated queries.
+        """
+        partial_results = self.evaluator.evaluate(
+            partial_run, num_threads=num_threads)
+
+        for query_id, query_measures in partial_results.items():
+            self._retract(query_id)
+
+            for measure, value in query_measures.items():
+                self._sums[measure] += value
+                self._counts[measure] += 1
+
+            self._results[query_id] = query_measures
+
+        return partial_results
+
+    def aggregated_measures(self):
+        """Returns the aggregate of every measure over all queries."""
+        aggregates = {}
+
+        for measure, count in self._counts.items():
+            if not count:
+                continue
+
+            if measure.startswith('num_'):
+                aggregates[measure] = self._sums[measure]
+            elif measure.startswith('gm_'):
+                aggregates[measure] = np.exp(self._sums[measure] / count)
+            else:
+                aggregates[measure] = self._sums[measure] / count
+
+        return aggregates
+
+    def _retract(self, query_id):
+        query_measures = self._results.pop(query_id, None)
+
+        if query_measures is None:
+            return
+
+        for measure, value in query_measures.items():
+            self._sums[measure] -= value
+            self._counts[measure] -= 1
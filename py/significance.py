@@ -0,0 +1,305 @@
+"""Paired significance tests over per-query measure values.
+
+Values are given as arrays with a row per query, such as the values of an
+EvaluationMatrix (a column per measure) or of a run in an EvaluationTensor,
+or as such a matrix or tensor itself, in which case the row of the
+aggregates (query 'all') is left out. Both arrays list the same queries in
+the same order, and every test is computed for all remaining dimensions
+(e.g., every measure) at once. The t-test and the Wilcoxon signed-rank test
+require SciPy.
+"""
+
+import collections
+import concurrent.futures
+
+import numpy as np
+
+TestResult = collections.namedtuple('TestResult', ['statistic', 'pvalue'])
+
+# Result of compare_runs: arrays of shape [runs, runs, ...], where element
+# [i, j] compares run i to run j. differences are the mean differences,
+# effect_sizes those divided by the standard deviation of the per-query
+# differences (Cohen's d), and adjusted_pvalues the p-values corrected for
+# comparing all pairs. The diagonal has no p-values (NaN).
+ComparisonMatrix = collections.namedtuple(
+    'ComparisonMatrix',
+    ['differences', 'effect_sizes', 'pvalues', 'adjusted_pvalues'])
+
+# Number of permutations that are sampled and evaluated together; fixed such
+# that the permutations only depend on the seed, not on the number of threads.
+PERMUTATION_CHUNK_SIZE = 1024
+
+# Query identifier of the aggregates that RelevanceEvaluator.evaluate adds
+# with aggregate=True.
+_AGGREGATE_QUERY_ID = 'all'
+
+
+def _query_values(values):
+    # Values of an array, or of an EvaluationMatrix or EvaluationTensor
+    # without the row of the aggregates, which is not a query.
+    query_ids = getattr(values, 'query_ids', None)
+
+    if query_ids is None:
+        return np.asarray(values, dtype=np.float64)
+
+    query_idxs = [query_idx for query_idx, query_id in enumerate(query_ids)
+                  if query_id != _AGGREGATE_QUERY_ID]
+
+    return np.asarray(values.values, dtype=np.float64)[..., query_idxs, :]
+
+
+def _count_permutations(values, count_fn, num_permutations, seed,
+                        num_threads):
+    # Samples num_permutations random sign flips of the rows (queries) of
+    # values, and sums count_fn over batches of the resulting means.
+    num_queries = values.shape[0]
+
+    chunk_seeds = np.random.SeedSequence(seed).spawn(
+        -(-num_permutations // PERMUTATION_CHUNK_SIZE))
+
+    def count_chunk(chunk_idx):
+        num_chunk_permutations = min(
+            PERMUTATION_CHUNK_SIZE,
+            num_permutations - chunk_idx * PERMUTATION_CHUNK_SIZE)
+
+        rng = np.random.default_rng(chunk_seeds[chunk_idx])
+
+        signs = rng.integers(
+            0, 2, size=(num_chunk_permutations, num_queries)) * 2.0 - 1.0
+
+        return count_fn(np.dot(signs, values) / num_queries)
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(num_threads, 1)) as executor:
+        return sum(executor.map(count_chunk, range(len(chunk_seeds))))
+
+
+def _paired_values(a, b):
+    a = _query_values(a)
+    b = _query_values(b)
+
+    if a.ndim == 0 or a.shape != b.shape:
+        raise ValueError(
+            'expected arrays of equal shape with a row per query, '
+            'got {} and {}'.format(a.shape, b.shape))
+
+    if np.isnan(a).any() or np.isnan(b).any():
+        # E.g., queries that a run of an EvaluationTensor does not rank.
+        raise ValueError('values should not contain NaN')
+
+    return a, b
+
+
+def t_test(a, b):
+    """Paired Student's t-test of the values of two runs.
+
+    Returns a TestResult with the t statistics and two-sided p-values.
+    """
+    import scipy.stats
+
+    a, b = _paired_values(a, b)
+
+    result = scipy.stats.ttest_rel(a, b, axis=0)
+
+    return TestResult(result.statistic, result.pvalue)
+
+
+def wilcoxon_test(a, b, zero_method='wilcox'):
+    """Wilcoxon signed-rank test of the values of two runs.
+
+    zero_method determines how queries with equal values are handled (see
+    scipy.stats.wilcoxon). Returns a TestResult with the statistics and
+    two-sided p-values.
+    """
+    import scipy.stats
+
+    a, b = _paired_values(a, b)
+
+    result = scipy.stats.wilcoxon(a, b, zero_method=zero_method, axis=0)
+
+    return TestResult(result.statistic, result.pvalue)
+
+
+def randomization_test(a, b, num_permutations=10000, seed=None,
+                       num_threads=1):
+    """Paired randomization (permutation) test of the values of two runs.
+
+    Under the null hypothesis, the values of the two runs are exchangeable
+    for every query; num_permutations random sign flips of the per-query
+    differences are sampled, and the p-value is the (smoothed) fraction of
+    them whose absolute mean difference is at least the observed one. All
+    measures share the same permutations, which are evaluated in batches
+    using matrix products and spread over num_threads threads. Results only
+    depend on seed, not on num_threads.
+
+    Returns a TestResult with the mean differences and two-sided p-values.
+    """
+    a, b = _paired_values(a, b)
+
+    if num_permutations < 1:
+        raise ValueError('num_permutations should be positive')
+
+    shape = a.shape[1:]
+    num_queries = a.shape[0]
+
+    differences = (a - b).reshape(num_queries, -1)
+    observed = differences.mean(axis=0)
+
+    # Permutations that reproduce the observed difference may differ from
+    # it by rounding.
+    threshold = np.abs(observed) - 1e-12
+
+    counts = _count_permutations(
+        differences,
+        lambda permuted: np.sum(np.abs(permuted) >= threshold, axis=0),
+        num_permutations, seed, num_threads)
+
+    pvalues = (counts + 1.0) / (num_permutations + 1.0)
+
+    return TestResult(observed.reshape(shape)[()], pvalues.reshape(shape)[()])
+
+
+def adjust_pvalues(pvalues, method='holm'):
+    """Corrects p-values for multiple testing.
+
+    The tests are along the first axis of pvalues; any other axes (e.g.,
+    measures) are corrected independently. method is 'bonferroni',
+    'holm' (Holm-Bonferroni) or 'fdr_bh' (Benjamini-Hochberg false
+    discovery rate).
+    """
+    pvalues = np.asarray(pvalues, dtype=np.float64)
+
+    num_tests = pvalues.shape[0]
+
+    if method == 'bonferroni':
+        return np.minimum(pvalues * num_tests, 1.0)
+    elif method not in ('holm', 'fdr_bh'):
+        raise ValueError('unknown method {}'.format(method))
+
+    order = np.argsort(pvalues, axis=0, kind='stable')
+    sorted_pvalues = np.take_along_axis(pvalues, order, axis=0)
+
+    ranks = np.arange(num_tests).reshape((-1,) + (1,) * (pvalues.ndim - 1))
+
+    if method == 'holm':
+        adjusted = np.maximum.accumulate(
+            (num_tests - ranks) * sorted_pvalues, axis=0)
+    else:
+        adjusted = np.minimum.accumulate(
+            (num_tests / (ranks + 1.0) * sorted_pvalues)[::-1], axis=0)[::-1]
+
+    result = np.empty_like(adjusted)
+    np.put_along_axis(result, order, np.minimum(adjusted, 1.0), axis=0)
+
+    return result
+
+
+def compare_runs(values, test='randomization', correction='holm',
+                 num_permutations=10000, seed=None, num_threads=1):
+    """Compares all pairs of runs with paired significance tests.
+
+    values has shape [runs, queries, ...], such as an EvaluationTensor or
+    its values. test is 'randomization', 't' or 'wilcoxon', and
+    correction is a method of adjust_pvalues (or None), applied to the
+    family of all pairs of runs for every measure. The randomization test
+    evaluates the same sign flips for all pairs: the permuted means are
+    computed once per run, and those of a pair are their differences. The
+    t-test is computed from the covariances of the runs. Returns a
+    ComparisonMatrix.
+    """
+    values = _query_values(values)
+
+    if values.ndim < 2:
+        raise ValueError(
+            'expected an array with a run per row and a query per column, '
+            'got {}'.format(values.shape))
+
+    if np.isnan(values).any():
+        raise ValueError('values should not contain NaN')
+
+    num_runs, num_queries = values.shape[:2]
+    shape = values.shape[2:]
+
+    # [queries, runs, measures]
+    values = values.reshape(num_runs, num_queries, -1).transpose(1, 0, 2)
+
+    means = values.mean(axis=0)
+    differences = means[:, np.newaxis] - means[np.newaxis, :]
+
+    # Variances of the per-query differences of all pairs.
+    centered = values - means
+    covariances = np.einsum('qrm,qsm->rsm', centered, centered) / max(
+        num_queries - 1, 1)
+    variances = np.diagonal(covariances).T
+    difference_stds = np.sqrt(np.maximum(
+        variances[:, np.newaxis] + variances[np.newaxis, :] -
+        2.0 * covariances, 0.0))
+
+    effect_sizes = np.divide(
+        differences, difference_stds,
+        out=np.zeros_like(differences), where=difference_stds > 0)
+
+    if test == 'randomization':
+        if num_permutations < 1:
+            raise ValueError('num_permutations should be positive')
+
+        threshold = np.abs(differences) - 1e-12
+
+        def count_fn(permuted):
+            # permuted has shape [permutations, runs * measures].
+            permuted = permuted.reshape(-1, num_runs, means.shape[-1])
+
+            return np.stack([
+                np.sum(
+                    np.abs(permuted[:, run_idx, np.newaxis] - permuted) >=
+                    threshold[run_idx], axis=0)
+                for run_idx in range(num_runs)])
+
+        counts = _count_permutations(
+            values.reshape(num_queries, -1), count_fn,
+            num_permutations, seed, num_threads)
+
+        pvalues = (counts + 1.0) / (num_permutations + 1.0)
+    elif test == 't':
+        import scipy.stats
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            statistics = np.where(
+                difference_stds > 0,
+                differences / (difference_stds / np.sqrt(num_queries)),
+                np.where(differences == 0, 0.0, np.sign(differences) * np.inf))
+
+        pvalues = 2.0 * scipy.stats.t.sf(np.abs(statistics), num_queries - 1)
+    elif test == 'wilcoxon':
+        pvalues = np.ones_like(differences)
+
+        for first_idx in range(num_runs):
+            for second_idx in range(first_idx + 1, num_runs):
+                pvalues[first_idx, second_idx] = \
+                    pvalues[second_idx, first_idx] = wilcoxon_test(
+                        values[:, first_idx], values[:, second_idx]).pvalue
+    else:
+        raise ValueError('unknown test {}'.format(test))
+
+    pvalues = np.minimum(pvalues, 1.0)
+
+    adjusted_pvalues = pvalues.copy()
+
+    if correction is not None:
+        pairs = np.triu_indices(num_runs, 1)
+
+        if len(pairs[0]) > 0:
+            adjusted_pvalues[pairs] = adjust_pvalues(
+                pvalues[pairs], correction)
+            adjusted_pvalues[pairs[::-1]] = adjusted_pvalues[pairs]
+
+    diagonal = np.arange(num_runs)
+    pvalues[diagonal, diagonal] = np.nan
+    adjusted_pvalues[diagonal, diagonal] = np.nan
+
+    def unflatten(array):
+        return array.reshape((num_runs, num_runs) + shape)
+
+    return ComparisonMatrix(
+        unflatten(differences), unflatten(effect_sizes),
+        unflatten(pvalues), unflatten(adjusted_pvalues))
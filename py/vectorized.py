@@ -0,0 +1,222 @@
+"""Vectorized implementations of common measures over dense batches.
+
+Scores are given as matrices with a row per query and a column per
+candidate document (see RelevanceEvaluator.set_candidates). All queries are
+ranked with a single argsort and the measures are computed with array
+arithmetic, instead of evaluating every query through trec_eval. Values
+follow trec_eval's definitions: documents are ranked by decreasing score
+(as single-precision floats), ties are broken by decreasing document
+identifier, and gains are the relevance labels.
+"""
+
+import re
+
+import numpy as np
+
+# Cutoffs of parameterized measures when none are given, as in trec_eval.
+DEFAULT_CUTOFFS = (5, 10, 15, 20, 30, 100, 200, 500, 1000)
+
+SUPPORTED_MEASURES = (
+    'ndcg', 'ndcg_cut', 'P', 'recall', 'map', 'recip_rank', 'Rprec')
+
+_CUTOFF_MEASURES = ('ndcg_cut', 'P', 'recall')
+
+
+def parse_measures(measures):
+    """Resolves measures (e.g., 'map' or 'P.5,10') into output names.
+
+    Returns a list of (name, measure, cutoff) tuples, with cutoff None for
+    measures without cutoffs, ordered by name. Raises ValueError for
+    measures that have no vectorized implementation.
+    """
+    resolved = set()
+
+    for measure in measures:
+        match = re.match(r'^([A-Za-z_]+?)(?:[._]([0-9,]+))?$', measure)
+
+        if match is None or match.group(1) not in SUPPORTED_MEASURES:
+            raise ValueError(
+                'measure {} has no vectorized implementation'.format(measure))
+
+        base_measure, cutoffs = match.groups()
+
+        if base_measure in _CUTOFF_MEASURES:
+            cutoffs = (map(int, cutoffs.split(',')) if cutoffs
+                       else DEFAULT_CUTOFFS)
+
+            resolved.update(
+                ('{}_{}'.format(base_measure, cutoff), base_measure, cutoff)
+                for cutoff in cutoffs)
+        elif cutoffs:
+            raise ValueError(
+                'measure {} does not take parameters'.format(measure))
+        else:
+            resolved.add((base_measure, base_measure, None))
+
+    return sorted(resolved)
+
+
+class DenseJudgments(object):
+    """Relevance labels of fixed candidates, laid out like score matrices.
+
+    Built once from the judgments and the candidates of every query; only
+    queries with judgments are evaluated.
+    """
+
+    def __init__(self, query_ids, candidates, query_relevance,
+                 relevance_level=1):
+        candidates = [list(docnos) for docnos in candidates]
+
+        num_queries = len(candidates)
+        num_columns = max(map(len, candidates), default=0)
+
+        self.query_ids = list(query_ids)
+        self.relevance_level = relevance_level
+
+        # Label of every candidate; -1 for unjudged candidates and padding.
+        self.labels = np.full((num_queries, num_columns), -1, dtype=np.int64)
+        self.mask = np.zeros((num_queries, num_columns), dtype=bool)
+
+        # Position of every candidate when ordered by decreasing document
+        # identifier, which breaks ties between equal scores.
+        self.tie_ranks = np.zeros((num_queries, num_columns), dtype=np.int64)
+
+        self.num_rel = np.zeros(num_queries, dtype=np.int64)
+        self.judged = np.zeros(num_queries, dtype=bool)
+
+        ideal_labels = []
+
+        for query_idx, (query_id, docnos) in enumerate(
+                zip(self.query_ids, candidates)):
+            judgments = query_relevance.get(query_id)
+
+            self.mask[query_idx, :len(docnos)] = True
+
+            if judgments is None:
+                ideal_labels.append([])
+                continue
+
+            self.judged[query_idx] = True
+
+            self.labels[query_idx, :len(docnos)] = [
+                max(judgments.get(docno, -1), -1) for docno in docnos]
+
+            self.tie_ranks[query_idx, :len(docnos)] = np.argsort(
+                sorted(range(len(docnos)),
+                       key=lambda idx: docnos[idx], reverse=True))
+
+            self.num_rel[query_idx] = sum(
+                label >= relevance_level for label in judgments.values())
+
+            ideal_labels.append(
+                sorted((label for label in judgments.values() if label > 0),
+                       reverse=True))
+
+        # Discounted gains of the ideal ranking of every query, cumulated.
+        num_ideal = max(map(len, ideal_labels), default=0)
+
+        ideal_gains = np.zeros((num_queries, num_ideal))
+
+        for query_idx, labels in enumerate(ideal_labels):
+            ideal_gains[query_idx, :len(labels)] = labels
+
+        self.ideal_dcg = np.cumsum(
+            ideal_gains / np.log2(np.arange(num_ideal) + 2.0), axis=1)
+
+    @property
+    def shape(self):
+        return self.labels.shape
+
+
+def evaluate(judgments, scores, measures, depth=None):
+    """Evaluates a score matrix against DenseJudgments.
+
+    measures are resolved by parse_measures. Only the top depth documents
+    of every ranking are considered, if given. Returns a tuple of a float64
+    array with a row per judged query and a column per measure, the
+    identifiers of the judged queries and the measure names.
+    """
+    measures = parse_measures(measures)
+
+    scores = np.asarray(scores)
+
+    if scores.shape != judgments.shape:
+        raise ValueError(
+            'scores should have shape {}, got {}'.format(
+                judgments.shape, scores.shape))
+
+    judged = judgments.judged
+
+    # trec_eval stores scores as single-precision floats.
+    scores = np.where(judgments.mask, scores.astype(np.float32), -np.inf)[judged]
+
+    # Padding goes last.
+    order = np.lexsort(
+        (judgments.tie_ranks[judged], -scores, ~judgments.mask[judged]),
+        axis=1)
+
+    labels = np.take_along_axis(judgments.labels[judged], order, axis=1)
+    mask = np.take_along_axis(judgments.mask[judged], order, axis=1)
+
+    if depth is not None:
+        labels, mask = labels[:, :depth], mask[:, :depth]
+
+    num_queries, num_ranks = labels.shape
+
+    num_rel = judgments.num_rel[judged].astype(np.float64)
+    ideal_dcg = judgments.ideal_dcg[judged]
+
+    ranks = np.arange(1, num_ranks + 1, dtype=np.float64)
+
+    relevant = mask & (labels >= judgments.relevance_level)
+    cum_relevant = np.cumsum(relevant, axis=1)
+
+    gains = np.where(mask & (labels > 0), labels, 0)
+    dcg = np.cumsum(gains / np.log2(ranks + 1.0), axis=1)
+
+    def at_cutoff(cumulative, cutoffs):
+        # Values after cutoffs documents; constant beyond the ranking, as
+        # trec_eval's cutoffs count beyond its end.
+        if cumulative.shape[1] == 0:
+            return np.zeros(num_queries)
+
+        return cumulative[np.arange(num_queries),
+                          np.clip(cutoffs, 1, cumulative.shape[1]) - 1]
+
+    def divide(numerator, denominator):
+        return np.divide(numerator, denominator,
+                         out=np.zeros(num_queries),
+                         where=denominator > 0)
+
+    everything = np.full(num_queries, max(num_ranks, ideal_dcg.shape[1], 1))
+
+    values = np.zeros((num_queries, len(measures)))
+
+    for measure_idx, (name, measure, cutoff) in enumerate(measures):
+        cutoffs = np.full(num_queries, cutoff) if cutoff else everything
+
+        if measure == 'P':
+            value = at_cutoff(cum_relevant, cutoffs) / float(cutoff)
+        elif measure == 'recall':
+            value = divide(at_cutoff(cum_relevant, cutoffs), num_rel)
+        elif measure in ('ndcg', 'ndcg_cut'):
+            value = divide(at_cutoff(dcg, cutoffs),
+                           at_cutoff(ideal_dcg, cutoffs))
+        elif measure == 'map':
+            value = divide(
+                np.sum(np.where(relevant, cum_relevant / ranks, 0.0), axis=1),
+                num_rel)
+        elif measure == 'recip_rank':
+            value = np.where(np.any(relevant, axis=1),
+                             1.0 / (np.argmax(relevant, axis=1) + 1.0), 0.0)
+        elif measure == 'Rprec':
+            value = divide(
+                at_cutoff(cum_relevant, num_rel.astype(np.int64)), num_rel)
+
+        values[:, measure_idx] = value
+
+    query_ids = [query_id
+                 for query_id, is_judged in zip(judgments.query_ids, judged)
+                 if is_judged]
+
+    return values, query_ids, [name for name, _, _ in measures]
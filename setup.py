@@ -14,6 +14,12 @@ LOCAL_TREC_EVAL_DIR = os.path.realpath(
 
 TREC_EVAL_SRC = []
 
+# Sources of trec_eval that are replaced by pytrec_eval.
+REPLACED_TREC_EVAL_SRC = (
+    'trec_eval.c',
+    'form_res_rels.c',  # See te_form_res_rels in src/pytrec_eval.cpp.
+)
+
 with tempfile.TemporaryDirectory() as tmp_dir:
     if os.path.isfile(os.path.join(LOCAL_TREC_EVAL_DIR, 'trec_eval.h')):
         # Use local version.
@@ -41,7 +47,7 @@ with tempfile.TemporaryDirectory() as tmp_dir:
         trec_eval_dir = os.path.join(tmp_dir, REMOTE_TREC_EVAL_TLD_NAME)
 
     for filename in os.listdir(trec_eval_dir):
-        if filename.endswith('.c') and not filename == "trec_eval.c":
+        if filename.endswith('.c') and filename not in REPLACED_TREC_EVAL_SRC:
             TREC_EVAL_SRC.append(os.path.join(trec_eval_dir, filename))
     #include the windows/ subdirectory on windows machines
     if sys.platform == 'win32':
@@ -56,7 +62,8 @@ with tempfile.TemporaryDirectory() as tmp_dir:
         libraries=[] if sys.platform == 'win32' else ['m', 'stdc++'],
         include_dirs=[trec_eval_dir, os.path.join(trec_eval_dir, "windows")] if sys.platform == 'win32' else [trec_eval_dir],
         undef_macros=['NDEBUG'],
-        extra_compile_args=['-g', '-Wall', '-O3'],
+        extra_compile_args=['-g', '-Wall', '-O3'] + ([] if sys.platform == 'win32' else ['-pthread']),
+        extra_link_args=[] if sys.platform == 'win32' else ['-pthread'],
         define_macros=[('VERSIONID', '\"pytrec_eval\"'),
                        ('_GLIBCXX_USE_CXX11_ABI', '0'),
                        ('P_NEEDS_GNU_CXX_NAMESPACE', '1')])
@@ -11,15 +11,27 @@ extern "C" int te_print_single_meas_a_cut (
     const EPI *epi, const TREC_MEAS *tm,
     const TREC_EVAL *eval);
 
+// Defined below, instead of by trec_eval's form_res_rels.c.
+extern "C" int te_form_res_rels(const EPI* epi, const REL_INFO* rel_info,
+                                const RESULTS* results, RES_RELS* res_rels);
 extern "C" int te_form_res_rels_cleanup();
 
 #include "functions.h"
 
 // Standard library.
 #include <algorithm>
+#include <atomic>
+#include <cerrno>
+#include <cstdio>
+#include <limits>
 #include <map>
+#include <mutex>
 #include <set>
 #include <string>
+#include <thread>
+#include <unordered_map>
+#include <unordered_set>
+#include <vector>
 
 extern "C" int te_num_trec_measures;
 extern "C" TREC_MEAS* te_trec_measures[];
@@ -65,333 +77,1543 @@ char* CopyCString(const char* originalCString) {
     return newCString;
 }
 
-static PyTypeObject RelevanceEvaluatorType;
+// Document identifiers.
 
-// RelevanceEvaluator
+// Interns document identifiers: every distinct identifier is stored once
+// and gets a dense integer id. Strings are never moved, such that pointers
+// returned by Get remain valid for the lifetime of the vocabulary.
+class DocumentVocabulary {
+ public:
+    // An empty vocabulary, or one that extends base: documents of base keep
+    // their ids, and others get subsequent ids. base must outlive the
+    // vocabulary and is never modified through it.
+    explicit DocumentVocabulary(const DocumentVocabulary* const base = NULL)
+        : base_(base), base_size_(base != NULL ? base->size() : 0),
+          block_begin_(NULL), block_end_(NULL) {}
+
+    ~DocumentVocabulary() {
+        for (size_t block_idx = 0; block_idx < blocks_.size(); ++block_idx) {
+            delete[] blocks_[block_idx];
+        }
+    }
 
-typedef struct {
-    PyObject_HEAD
+    // Returns a vocabulary with the same ids, which extends the same base.
+    DocumentVocabulary* Copy() const {
+        DocumentVocabulary* const copy = new DocumentVocabulary(base_);
 
-    // whether init has been successfully called
-    bool inited_;
+        for (size_t idx = 0; idx < strings_.size(); ++idx) {
+            copy->Intern(strings_[idx]);
+        }
 
-    // Original dictionary with relevance information.
-    PyObject* object_relevance_per_qid_;
+        return copy;
+    }
 
-    // trec_eval session structure.
-    EPI epi_;
+    // Returns the id of docno, adding it to the vocabulary if necessary.
+    int64 Intern(const char* const docno) {
+        const int64 existing_id = Find(docno);
 
-    // trec_eval relevance structure.
-    ALL_REL_INFO all_rel_info_;
+        if (existing_id >= 0) {
+            return existing_id;
+        }
 
-    // Mapping from query identifier to internal idx.
-    std::map<std::string, size_t>* query_id_to_idx_;
-    std::set<size_t>* measures_;
-} RelevanceEvaluator;
+        const size_t length = strlen(docno) + 1;
 
-static PyObject* RelevanceEvaluator_new(PyTypeObject* type, PyObject* args, PyObject* kwds) {
-    RelevanceEvaluator* self;
+        if ((size_t) (block_end_ - block_begin_) < length) {
+            const size_t block_size = std::max(length, (size_t) kBlockSize);
 
-    self = (RelevanceEvaluator*) type->tp_alloc(type, 0);
-    if (self != NULL) {
-        self->inited_ = false;
-        self->object_relevance_per_qid_ = NULL;
-        self->query_id_to_idx_ = new std::map<std::string, size_t>;
-        self->measures_ = new std::set<size_t>;
-        self->all_rel_info_.num_q_rels = -1;
-    }
+            block_begin_ = new char[block_size];
+            block_end_ = block_begin_ + block_size;
 
-    return (PyObject*) self;
-}
+            blocks_.push_back(block_begin_);
+        }
 
-template <typename QueryT, typename ListOfPairsT, typename PairT>
-class RankingBuilder {
- public:
-    typedef QueryT QueryType;
-    typedef PairT QueryDocumentPairType;
+        char* const interned_docno = block_begin_;
+        memcpy(interned_docno, docno, length);
+        block_begin_ += length;
 
-    bool operator()(PyObject* const dict, int64& num_queries, QueryT*& queries) {
-        num_queries = PyDict_Size(dict);
+        const int64 id = base_size_ + strings_.size();
 
-        queries = Malloc(num_queries, QueryT);
-        ListOfPairsT* const query_pair_list = Malloc(num_queries, ListOfPairsT);
+        strings_.push_back(interned_docno);
+        index_.insert(std::make_pair((const char*) interned_docno, id));
 
-        CHECK_NOTNULL(queries);
-        CHECK_NOTNULL(query_pair_list);
+        return id;
+    }
 
-        PyObject* key = NULL;
-        PyObject* value = NULL;
+    // Returns the id of docno, or -1 if it is not part of the vocabulary.
+    int64 Find(const char* const docno) const {
+        if (base_ != NULL) {
+            const int64 id = base_->Find(docno);
 
-        Py_ssize_t pos = 0;
+            if (id >= 0) {
+                return id;
+            }
+        }
 
-        size_t query_idx = 0;
+        const Index::const_iterator it = index_.find(docno);
 
-        while (PyDict_Next(dict, &pos, &key, &value)) {
-            if (!PyUnicode_Check(key)) {
-                PyErr_SetString(PyExc_TypeError, "Expected string as key.");
+        return it != index_.end() ? it->second : -1;
+    }
 
-                return false;
-            }
+    char* Get(const int64 id) const {
+        return id < base_size_ ? base_->Get(id) : strings_[id - base_size_];
+    }
 
-            if (!PyDict_Check(value)) {
-                PyErr_SetString(PyExc_TypeError, "Expected dictionary as value.");
+    int64 size() const {
+        return base_size_ + strings_.size();
+    }
 
-                return false;
+    // FNV-1a.
+    struct CStringHash {
+        size_t operator()(const char* str) const {
+            size_t hash = (size_t) 14695981039346656037ULL;
+
+            for (; *str != '\0'; ++str) {
+                hash = (hash ^ (unsigned char) *str) * (size_t) 1099511628211ULL;
             }
 
-            queries[query_idx].qid = CopyCString(PyUnicode_AsUTF8(key));
-            CHECK_NOTNULL(queries[query_idx].qid);
+            return hash;
+        }
+    };
 
-            PairT* const query_document_pairs = Malloc(PyDict_Size(value) + 1, PairT);
+    struct CStringEqual {
+        bool operator()(const char* first, const char* second) const {
+            return strcmp(first, second) == 0;
+        }
+    };
 
-            PyObject* inner_key = NULL;
-            PyObject* inner_value = NULL;
+ private:
+    static const size_t kBlockSize = 1 << 20;
 
-            Py_ssize_t inner_pos = 0;
+    typedef std::unordered_map<const char*, int64, CStringHash, CStringEqual> Index;
 
-            size_t pair_idx = 0;
+    const DocumentVocabulary* const base_;
+    const int64 base_size_;
 
-            while (PyDict_Next(value, &inner_pos, &inner_key, &inner_value)) {
-                if (!PyUnicode_Check(inner_key)) {
-                    PyErr_SetString(PyExc_TypeError, "Expected mapping of document id to query relevance or matching score.");
+    Index index_;
+    std::vector<char*> strings_;
 
-                    return false;  // TODO(cvangysel): need to clean up here!
-                }
+    std::vector<char*> blocks_;
+    char* block_begin_;
+    char* block_end_;
+};
 
-                query_document_pairs[pair_idx].docno = CopyCString(PyUnicode_AsUTF8(inner_key));
-                CHECK_NOTNULL(query_document_pairs[pair_idx].docno);
+// File parsing.
 
-                if (!ProcessQueryDocumentPair(&query_document_pairs[pair_idx],
-                                              inner_value)) {
+// Reads a file line by line through a single growing buffer. Lines are
+// NUL-terminated in place and stay valid until the next call to Next.
+class LineReader {
+ public:
+    explicit LineReader(FILE* const f)
+        : f_(f), buffer_(1 << 20), begin_(0), end_(0),
+          eof_(false), error_(false), line_number_(0) {}
+
+    // Returns false at the end of the file or on a read error.
+    bool Next(char** const line, size_t* const length) {
+        while (true) {
+            char* const start = &buffer_[0] + begin_;
+            char* const newline = (char*) memchr(start, '\n', end_ - begin_);
+
+            if (newline != NULL) {
+                *newline = '\0';
+                *line = start;
+                *length = newline - start;
+
+                begin_ += *length + 1;
+                ++line_number_;
+
+                return true;
+            } else if (eof_) {
+                if (begin_ == end_) {
                     return false;
                 }
 
-                ++pair_idx;
-            }
-            query_document_pairs[pair_idx].docno = NULL;
+                // Last line without a trailing newline; Fill always leaves
+                // room for the terminator.
+                buffer_[end_] = '\0';
+                *line = start;
+                *length = end_ - begin_;
 
-            if (!ProcessListOfQueryDocumentPairs(&query_pair_list[query_idx],
-                                                 PyDict_Size(value),
-                                                 query_document_pairs)) {
-                return false;
-            }
+                begin_ = end_;
+                ++line_number_;
 
-            if (!ProcessQuery(&queries[query_idx], &query_pair_list[query_idx])) {
-                return false;
+                return true;
             }
 
-            ++query_idx;
+            Fill();
         }
+    }
 
-        return true;
+    bool error() const {
+        return error_;
     }
 
-    virtual void cleanup(const int64 num_queries, QueryT* queries) const = 0;
+    size_t line_number() const {
+        return line_number_;
+    }
 
- protected:
-    virtual bool ProcessQuery(QueryT* const query,
-                              ListOfPairsT* query_pair_list) const = 0;
+ private:
+    void Fill() {
+        // Move the incomplete line to the front of the buffer.
+        const size_t remaining = end_ - begin_;
+        if (begin_ > 0) {
+            memmove(&buffer_[0], &buffer_[begin_], remaining);
 
-    virtual bool ProcessListOfQueryDocumentPairs(
-        ListOfPairsT* const query_pair_list,
-        const size_t num_pairs,
-        PairT* const query_document_pairs) const = 0;
+            begin_ = 0;
+            end_ = remaining;
+        }
 
-    virtual bool ProcessQueryDocumentPair(
-        PairT* const pair,
-        PyObject* const inner_value) const = 0;
-};
+        if (end_ + 1 >= buffer_.size()) {
+            buffer_.resize(2 * buffer_.size());
+        }
 
-class QrelRankingBuilder : public RankingBuilder<REL_INFO, TEXT_QRELS_INFO, TEXT_QRELS> {
- public:
-    virtual void cleanup(const int64 num_queries, REL_INFO* queries) const {
-        if (num_queries > 0) { // Since Malloc(0) can either return NULL or an empty pointer, need special handling
-            for (size_t idx = 0; idx < num_queries; ++idx) {
-                TEXT_QRELS* text_qrels = ((TEXT_QRELS_INFO*) queries[idx].q_rel_info)->text_qrels;
-                size_t r_idx=0;
-                while (text_qrels[r_idx].docno != NULL) {
-                    Free(text_qrels[r_idx++].docno);
-                }
-                Free(text_qrels);
-                Free(queries[idx].qid);
-            }
+        const size_t num_read = fread(
+            &buffer_[end_], 1, buffer_.size() - end_ - 1, f_);
 
-            Free(queries->q_rel_info);
-            Free(queries);
+        if (num_read == 0) {
+            error_ = ferror(f_) != 0;
+            eof_ = true;
         }
+
+        end_ += num_read;
     }
 
- protected:
-    virtual bool ProcessQuery(REL_INFO* const query,
-                              TEXT_QRELS_INFO* const query_pair_list) const {
-        query->rel_format = "qrels";
-        query->q_rel_info = query_pair_list;
+    FILE* const f_;
+    std::vector<char> buffer_;
 
-        return true;
-    }
+    size_t begin_;
+    size_t end_;
 
-    virtual bool ProcessListOfQueryDocumentPairs(
-            TEXT_QRELS_INFO* const query_pair_list,
-            const size_t num_pairs,
-            TEXT_QRELS* const query_document_pairs) const {
-        query_pair_list->num_text_qrels = num_pairs;
-        query_pair_list->text_qrels = query_document_pairs;
+    bool eof_;
+    bool error_;
 
-        return true;
-    }
+    size_t line_number_;
+};
 
-    virtual bool ProcessQueryDocumentPair(TEXT_QRELS* const pair,
-                                          PyObject* const inner_value) const {
-        if (!PyLong_Check(inner_value)) {
-            PyErr_SetString(PyExc_TypeError, "Expected relevance to be integer.");
+inline bool IsFieldSeparator(const char c) {
+    return c == ' ' || c == '\t' || c == '\r' || c == '\v' || c == '\f';
+}
 
-            return false;
+// Splits a NUL-terminated line on whitespace, terminating every field in
+// place. Returns the number of fields, which is capped at max_fields + 1 so
+// that callers can detect lines with too many fields.
+size_t SplitFields(char* line, char** const fields, const size_t max_fields) {
+    size_t num_fields = 0;
+
+    while (true) {
+        while (IsFieldSeparator(*line)) {
+            ++line;
         }
 
-        pair->rel = PyLong_AsLong(inner_value);
+        if (*line == '\0') {
+            break;
+        }
 
-        return true;
-    }
-};
+        if (num_fields == max_fields) {
+            return max_fields + 1;
+        }
 
-class ResultRankingBuilder : public RankingBuilder<RESULTS, TEXT_RESULTS_INFO, TEXT_RESULTS> {
- public:
-    virtual void cleanup(const int64 num_queries, RESULTS* queries) const {
-        if (num_queries > 0) { // Since Malloc(0) can either return NULL or an empty pointer, need special handling
-            for (size_t idx = 0; idx < num_queries; ++idx) {
-                size_t r_idx=0;
-                TEXT_RESULTS* text_results = ((TEXT_RESULTS_INFO*) queries[idx].q_results)->text_results;
-                while (text_results[r_idx].docno != NULL) {
-                    Free(text_results[r_idx++].docno);
-                }
-                Free(text_results);
-                Free(queries[idx].qid);
-            }
+        fields[num_fields++] = line;
 
-            Free(queries->q_results);
-            Free(queries);
+        while (*line != '\0' && !IsFieldSeparator(*line)) {
+            ++line;
         }
-    }
-
- protected:
-    virtual bool ProcessQuery(RESULTS* const query,
-                              TEXT_RESULTS_INFO* const query_pair_list) const {
-        query->run_id = "my_little_test_run";
-        query->ret_format = "trec_results";
-        query->q_results = query_pair_list;
 
-        return true;
+        if (*line != '\0') {
+            *line++ = '\0';
+        }
     }
 
-    virtual bool ProcessListOfQueryDocumentPairs(
-            TEXT_RESULTS_INFO* const query_pair_list,
-            const size_t num_pairs,
-            TEXT_RESULTS* const query_document_pairs) const {
-        query_pair_list->num_text_results = num_pairs;
-        query_pair_list->text_results = query_document_pairs;
+    return num_fields;
+}
 
-        return true;
-    }
+// Parse numbers as float and int do, independently of the C locale (e.g.,
+// of its decimal separator). Require the GIL.
+bool ParseDouble(const char* const str, double* const value) {
+    char* end = NULL;
+    *value = PyOS_string_to_double(str, &end, NULL);
 
-    virtual bool ProcessQueryDocumentPair(TEXT_RESULTS* const pair,
-                                          PyObject* const inner_value) const {
-        if (PyFloat_Check(inner_value)) {
-		pair->sim = PyFloat_AsDouble(inner_value);
-	} else if (PyLong_Check(inner_value)) {
-		pair->sim = PyLong_AsDouble(inner_value);
-	} else {
-		PyErr_SetString(PyExc_TypeError, "Expected matching score to be int, long or float.");
-		return false;
-        }
-        return true;
+    if (*value == -1.0 && PyErr_Occurred()) {
+        // No number at all; callers report their own error.
+        PyErr_Clear();
+
+        return false;
     }
-};
 
-bool qrel_docno_compare(
-        const QrelRankingBuilder::QueryDocumentPairType& a,
-        const QrelRankingBuilder::QueryDocumentPairType& b) {
-    return strcmp(a.docno, b.docno) < 0;
+    return *end == '\0';
 }
 
-static int RelevanceEvaluator_init(RelevanceEvaluator* self, PyObject* args, PyObject* kwds) {
-    PyObject* object_relevance_per_qid = NULL;
-    PyObject* measures = NULL;
-    PyObject* tmp_measures = NULL;
-
-    int32 relevance_level = 1;
+bool ParseLong(const char* const str, long* const value) {
+    char* end = NULL;
+    errno = 0;
+    *value = PyOS_strtol(str, &end, 10);
 
-    static char* kwlist[] = {
-        "query_relevance", "measures", "relevance_level",
-        NULL};
+    return end != str && *end == '\0' && errno == 0;
+}
 
-    if (!PyArg_ParseTupleAndKeywords(
-            args, kwds, "OO|i", kwlist,
-            &object_relevance_per_qid,
-            &measures,
-            &relevance_level)) {
-        PyErr_SetString(
-            PyExc_TypeError,
-            "Expected object_relevance_per_qid dictionary "
-            "and measures set.");
+// Field layout of the TREC run and qrel formats.
+#define RUN_NUM_FIELDS 6
+#define RUN_QID_FIELD 0
+#define RUN_DOCNO_FIELD 2
+#define RUN_SIM_FIELD 4
+
+#define QREL_NUM_FIELDS 4
+#define QREL_QID_FIELD 0
+#define QREL_DOCNO_FIELD 2
+#define QREL_REL_FIELD 3
+
+// Parses a TREC run (qrel_format == false) or qrel file into a dictionary
+// of query identifiers to dictionaries of document identifiers to scores
+// (or relevance labels).
+static PyObject* ParseTrecFile(const char* const path, const bool qrel_format) {
+    const size_t num_fields = qrel_format ? QREL_NUM_FIELDS : RUN_NUM_FIELDS;
+    const size_t docno_field = qrel_format ? QREL_DOCNO_FIELD : RUN_DOCNO_FIELD;
+    const size_t value_field = qrel_format ? QREL_REL_FIELD : RUN_SIM_FIELD;
+
+    FILE* const f = fopen(path, "rb");
+    if (f == NULL) {
+        PyErr_SetFromErrnoWithFilename(PyExc_OSError, path);
 
-        return -1;
+        return NULL;
     }
 
-    if (!PyDict_Check(object_relevance_per_qid)) {
-        PyErr_SetString(PyExc_TypeError,
-                        "Argument query_relevance should be of type dictionary.");
+    PyObject* const result = PyDict_New();
+    if (result == NULL) {
+        fclose(f);
 
-        return -1;
+        return NULL;
     }
 
-    if (!PySet_Check(measures)) {
-        PyErr_SetString(PyExc_TypeError,
-                        "Argument measures should be of type set.");
+    LineReader reader(f);
 
-        return -1;
-    }
+    // Lines are typically grouped by query; remember the last query to
+    // avoid a lookup in result for every line.
+    std::string current_qid;
+    PyObject* current_query = NULL;  // Borrowed from result.
 
-    if (relevance_level < 1) {
-        PyErr_SetString(PyExc_TypeError,
-                        "Argument relevance_level should be positive.");
+    char* line = NULL;
+    size_t length = 0;
+    char* fields[RUN_NUM_FIELDS];
 
-        return -1;
-    }
+    bool success = true;
 
-    // Configure trec_eval session.
-    self->epi_.query_flag = 0;
-    self->epi_.average_complete_flag = 0;
-    self->epi_.judged_docs_only_flag = 0;
-    self->epi_.summary_flag = 0;
-    self->epi_.relation_flag = 1;
-    self->epi_.debug_level = 0;
-    self->epi_.debug_query = NULL;
-    self->epi_.num_docs_in_coll = 0;
-    self->epi_.relevance_level = relevance_level;
-    self->epi_.max_num_docs_per_topic = MAXLONG;
-    self->epi_.rel_info_format = "qrels";
-    self->epi_.results_format = "trec_results";
-    self->epi_.zscore_flag = 0;
-    self->epi_.meas_arg = NULL;
+    while (success && reader.Next(&line, &length)) {
+        const size_t line_num_fields = SplitFields(line, fields, num_fields);
 
-    // Resolve requested measures.
-    self->epi_.meas_arg = Malloc(PySet_Size(measures)+1, MEAS_ARG);
-    self->epi_.meas_arg[0].measure_name = NULL;
-    self->epi_.meas_arg[0].parameters = NULL;
-    size_t meas_arg_idx = 0;
+        if (line_num_fields == 0) {
+            continue;  // Skip blank lines.
+        }
 
-    tmp_measures = PySet_New(measures);
-    PyObject* meas_iter = PyObject_GetIter(measures);
-    PyObject *meas;
-    char* meas_args;
-    char* meas_name;
-    while ((meas = PyIter_Next(meas_iter))) {
-        meas_name = CopyCString(PyUnicode_AsUTF8(meas));
-        meas_args = meas_name;
-        while (*meas_args && *meas_args!='.') meas_args++;
-        if (*meas_args) {
-            *meas_args++ = '\0';
-            self->epi_.meas_arg[meas_arg_idx].measure_name = meas_name;
+        if (line_num_fields != num_fields) {
+            PyErr_Format(PyExc_ValueError,
+                         "%s:%zu: expected %zu fields.",
+                         path, reader.line_number(), num_fields);
+
+            success = false;
+            break;
+        }
+
+        PyObject* value = NULL;
+
+        if (qrel_format) {
+            long relevance = 0;
+            if (ParseLong(fields[value_field], &relevance)) {
+                value = PyLong_FromLong(relevance);
+            }
+        } else {
+            double score = 0.0;
+            if (ParseDouble(fields[value_field], &score)) {
+                value = PyFloat_FromDouble(score);
+            }
+        }
+
+        if (value == NULL) {
+            PyErr_Format(PyExc_ValueError,
+                         "%s:%zu: unable to parse %s '%s'.",
+                         path, reader.line_number(),
+                         qrel_format ? "relevance" : "score",
+                         fields[value_field]);
+
+            success = false;
+            break;
+        }
+
+        if (current_query == NULL || current_qid.compare(fields[RUN_QID_FIELD]) != 0) {
+            PyObject* const qid = PyUnicode_FromString(fields[RUN_QID_FIELD]);
+            if (qid == NULL) {
+                Py_DECREF(value);
+
+                success = false;
+                break;
+            }
+
+            current_query = PyDict_GetItemWithError(result, qid);
+
+            if (current_query == NULL && !PyErr_Occurred()) {
+                PyObject* const query = PyDict_New();
+
+                if (query != NULL && PyDict_SetItem(result, qid, query) == 0) {
+                    current_query = query;
+                }
+
+                Py_XDECREF(query);
+            }
+
+            Py_DECREF(qid);
+
+            if (current_query == NULL) {
+                Py_DECREF(value);
+
+                success = false;
+                break;
+            }
+
+            current_qid = fields[RUN_QID_FIELD];
+        }
+
+        PyObject* const docno = PyUnicode_FromString(fields[docno_field]);
+        if (docno == NULL) {
+            Py_DECREF(value);
+
+            success = false;
+            break;
+        }
+
+        const int contains = PyDict_Contains(current_query, docno);
+
+        if (contains != 0) {
+            if (contains > 0) {
+                PyErr_Format(PyExc_ValueError,
+                             "%s:%zu: duplicate document '%s' for query '%s'.",
+                             path, reader.line_number(),
+                             fields[docno_field], current_qid.c_str());
+            }
+
+            Py_DECREF(docno);
+            Py_DECREF(value);
+
+            success = false;
+            break;
+        }
+
+        if (PyDict_SetItemAndSteal(current_query, docno, value) < 0) {
+            success = false;
+            break;
+        }
+    }
+
+    if (success && reader.error()) {
+        PyErr_SetFromErrnoWithFilename(PyExc_OSError, path);
+
+        success = false;
+    }
+
+    fclose(f);
+
+    if (!success) {
+        Py_DECREF(result);
+
+        return NULL;
+    }
+
+    return result;
+}
+
+static PyObject* ParseTrecFileFromArgs(PyObject* args, const bool qrel_format) {
+    PyObject* path = NULL;
+
+    if (!PyArg_ParseTuple(args, "O&", PyUnicode_FSConverter, &path)) {
+        return NULL;
+    }
+
+    PyObject* const result = ParseTrecFile(PyBytes_AsString(path), qrel_format);
+
+    Py_DECREF(path);
+
+    return result;
+}
+
+static PyObject* parse_run_file(PyObject* self, PyObject* args) {
+    return ParseTrecFileFromArgs(args, false /* qrel_format */);
+}
+
+static PyObject* parse_qrel_file(PyObject* self, PyObject* args) {
+    return ParseTrecFileFromArgs(args, true /* qrel_format */);
+}
+
+// Array input.
+
+// Read-only access to a one-dimensional, contiguous buffer-protocol object
+// (e.g., a NumPy array, array.array or memoryview) of numbers.
+class ArrayView {
+ public:
+    ArrayView() : acquired_(false), type_('\0') {}
+
+    ~ArrayView() {
+        if (acquired_) {
+            PyBuffer_Release(&view_);
+        }
+    }
+
+    // Returns false and sets a Python exception if obj is not a
+    // one-dimensional (or ndim-dimensional) array of (integral, if
+    // requested) numbers. Elements are indexed in row-major order.
+    bool Acquire(PyObject* const obj, const char* const name, const bool integral,
+                 const int ndim = 1) {
+        if (PyObject_GetBuffer(obj, &view_, PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) < 0) {
+            return false;
+        }
+
+        acquired_ = true;
+
+        if (view_.ndim != ndim) {
+            PyErr_Format(PyExc_ValueError,
+                         "Argument %s should be %s.",
+                         name, ndim == 1 ? "one-dimensional" : "two-dimensional");
+
+            return false;
+        }
+
+        const char* format = view_.format != NULL ? view_.format : "B";
+
+        // Only native byte order is supported.
+        if (*format == '@' || *format == '=' ||
+#if PY_LITTLE_ENDIAN
+            *format == '<'
+#else
+            *format == '>' || *format == '!'
+#endif
+            ) {
+            ++format;
+        }
+
+        type_ = (format[0] != '\0' && format[1] == '\0') ? format[0] : '\0';
+
+        switch (type_) {
+            case 'b': case 'B': case 'h': case 'H': case 'i': case 'I':
+            case 'l': case 'L': case 'q': case 'Q':
+                return true;
+            case 'f': case 'd':
+                if (!integral) {
+                    return true;
+                }
+                // Fall through.
+            default:
+                PyErr_Format(PyExc_TypeError,
+                             "Argument %s should be an array of %s, got format '%s'.",
+                             name, integral ? "integers" : "numbers",
+                             view_.format != NULL ? view_.format : "B");
+
+                return false;
+        }
+    }
+
+    Py_ssize_t size() const {
+        return view_.shape != NULL ? view_.shape[0] : view_.len / view_.itemsize;
+    }
+
+    Py_ssize_t shape(const int dim) const {
+        return dim == 0 ? size() : view_.shape[dim];
+    }
+
+    int64 AsInt(const Py_ssize_t idx) const {
+        switch (type_) {
+            case 'b': return ((const signed char*) view_.buf)[idx];
+            case 'B': return ((const unsigned char*) view_.buf)[idx];
+            case 'h': return ((const short*) view_.buf)[idx];
+            case 'H': return ((const unsigned short*) view_.buf)[idx];
+            case 'i': return ((const int*) view_.buf)[idx];
+            case 'I': return ((const unsigned int*) view_.buf)[idx];
+            case 'l': return ((const long*) view_.buf)[idx];
+            case 'L': return ((const unsigned long*) view_.buf)[idx];
+            case 'q': return ((const long long*) view_.buf)[idx];
+            case 'Q': return ((const unsigned long long*) view_.buf)[idx];
+            default: return (int64) AsDouble(idx);
+        }
+    }
+
+    double AsDouble(const Py_ssize_t idx) const {
+        switch (type_) {
+            case 'f': return ((const float*) view_.buf)[idx];
+            case 'd': return ((const double*) view_.buf)[idx];
+            default: return (double) AsInt(idx);
+        }
+    }
+
+ private:
+    Py_buffer view_;
+    bool acquired_;
+
+    char type_;
+};
+
+// Formats an integer identifier, terminated by NUL, as trec_eval sees it.
+inline void AppendIdentifier(const int64 id, std::vector<char>* const block) {
+    char buffer[32];
+    const int length = snprintf(buffer, sizeof(buffer), "%lld", id);
+
+    block->insert(block->end(), buffer, buffer + length + 1);
+}
+
+// Splits num_elements parallel array elements into per-query segments
+// [segment_offsets[i], segment_offsets[i + 1]) with identifiers
+// segment_qids[i]. When offsets is NULL, qids holds an identifier for
+// every element and segments are runs of equal identifiers; otherwise, qids
+// holds an identifier for every segment. With unique_qids, every query must
+// occupy a single segment.
+static bool ComputeSegments(const ArrayView& qids,
+                            const ArrayView* const offsets,
+                            const Py_ssize_t num_elements,
+                            const bool unique_qids,
+                            std::vector<int64>* const segment_qids,
+                            std::vector<Py_ssize_t>* const segment_offsets) {
+    if (offsets == NULL) {
+        if (qids.size() != num_elements) {
+            PyErr_SetString(PyExc_ValueError,
+                            "Arguments should be arrays of equal length.");
+
+            return false;
+        }
+
+        for (Py_ssize_t idx = 0; idx < num_elements; ++idx) {
+            const int64 qid = qids.AsInt(idx);
+
+            if (idx == 0 || qid != segment_qids->back()) {
+                segment_qids->push_back(qid);
+                segment_offsets->push_back(idx);
+            }
+        }
+
+        segment_offsets->push_back(num_elements);
+    } else {
+        if (offsets->size() != qids.size() + 1 ||
+                offsets->AsInt(0) != 0 ||
+                offsets->AsInt(qids.size()) != num_elements) {
+            PyErr_SetString(PyExc_ValueError,
+                            "Argument offsets should start at zero, end at "
+                            "the number of elements and hold one more entry "
+                            "than qids.");
+
+            return false;
+        }
+
+        for (Py_ssize_t idx = 0; idx <= qids.size(); ++idx) {
+            const int64 offset = offsets->AsInt(idx);
+
+            if (idx > 0 && offset < segment_offsets->back()) {
+                PyErr_SetString(PyExc_ValueError,
+                                "Argument offsets should be non-decreasing.");
+
+                return false;
+            }
+
+            segment_offsets->push_back(offset);
+
+            if (idx < qids.size()) {
+                segment_qids->push_back(qids.AsInt(idx));
+            }
+        }
+    }
+
+    if (unique_qids) {
+        std::set<int64> seen_qids;
+
+        for (size_t segment_idx = 0; segment_idx < segment_qids->size(); ++segment_idx) {
+            if (!seen_qids.insert((*segment_qids)[segment_idx]).second) {
+                PyErr_Format(PyExc_ValueError,
+                             "Query %lld occurs in multiple segments; the "
+                             "arrays should be grouped by query.",
+                             (*segment_qids)[segment_idx]);
+
+                return false;
+            }
+        }
+    }
+
+    return true;
+}
+
+static PyTypeObject RelevanceEvaluatorType;
+static PyTypeObject EvaluationAccumulatorType;
+
+// Fixed candidate documents per query, for evaluating dense score matrices;
+// row i of a matrix holds the scores of candidates[i] for query qids[i].
+// Document identifiers point into the evaluator's DocumentVocabulary.
+struct CandidateSet {
+    std::vector<std::string> qids;
+    std::vector<std::vector<char*> > candidates;
+
+    size_t max_num_candidates;
+
+    CandidateSet() : max_num_candidates(0) {}
+};
+
+// Statistics of the judgments of a single query that trec_eval derives for
+// every ranking it evaluates.
+struct QueryJudgments {
+    // Largest relevance label.
+    long max_rel;
+
+    // Number of judged documents per relevance label in [0, max_rel].
+    std::vector<long> rel_levels;
+
+    // Discounted cumulative gains of the ideal ranking (relevant documents
+    // by descending label, as trec_eval's ndcg orders them): element k is
+    // the gain of its first k + 1 documents.
+    std::vector<double> ideal_gains;
+};
+
+// Returns the gain of the first num_ranks documents of the ideal ranking.
+static double IdealGain(const QueryJudgments& judgments, const long num_ranks) {
+    if (num_ranks <= 0 || judgments.ideal_gains.empty()) {
+        return 0.0;
+    }
+
+    return judgments.ideal_gains[
+        std::min((size_t) num_ranks, judgments.ideal_gains.size()) - 1];
+}
+
+static void ComputeQueryJudgments(const REL_INFO* const rel_info,
+                                  QueryJudgments* const judgments) {
+    const TEXT_QRELS_INFO* const text_qrels_info = (const TEXT_QRELS_INFO*) rel_info->q_rel_info;
+
+    const TEXT_QRELS* const text_qrels = text_qrels_info->text_qrels;
+    const long num_text_qrels = text_qrels_info->num_text_qrels;
+
+    // As in trec_eval, also when all labels are negative.
+    judgments->max_rel = 0;
+
+    for (long pair_idx = 0; pair_idx < num_text_qrels; ++pair_idx) {
+        judgments->max_rel = std::max(judgments->max_rel, text_qrels[pair_idx].rel);
+    }
+
+    judgments->rel_levels.assign(judgments->max_rel + 1, 0);
+
+    for (long pair_idx = 0; pair_idx < num_text_qrels; ++pair_idx) {
+        if (text_qrels[pair_idx].rel >= 0) {
+            ++judgments->rel_levels[text_qrels[pair_idx].rel];
+        }
+    }
+
+    judgments->ideal_gains.clear();
+
+    double ideal_gain = 0.0;
+
+    for (long rel = judgments->max_rel; rel > 0; --rel) {
+        for (long doc_idx = 0; doc_idx < judgments->rel_levels[rel]; ++doc_idx) {
+            ideal_gain += (double) rel / log2((double) (judgments->ideal_gains.size() + 2));
+            judgments->ideal_gains.push_back(ideal_gain);
+        }
+    }
+}
+
+// RelevanceEvaluator
+
+typedef struct {
+    PyObject_HEAD
+
+    // whether init has been successfully called
+    bool inited_;
+
+    // Original dictionary with relevance information.
+    PyObject* object_relevance_per_qid_;
+
+    // Block holding all query identifiers when the relevance information
+    // was not given as a dictionary (NULL otherwise).
+    char* qrel_strings_;
+
+    // Document identifiers interned by this evaluator. Until init, these
+    // include the judged documents; afterwards, the vocabulary extends
+    // judged_documents_ with the documents interned since.
+    DocumentVocabulary* documents_;
+
+    // Judged (and before init, explicitly interned) document identifiers;
+    // the relevance structures point into it. Never modified once init
+    // completes, such that evaluators sharing the judgments can read it
+    // concurrently (NULL until then).
+    const DocumentVocabulary* judged_documents_;
+
+    // Set by set_candidates (NULL otherwise).
+    CandidateSet* candidates_;
+
+    // Evaluator that owns the relevance structures (object_relevance_per_qid_,
+    // qrel_strings_, judged_documents_, all_rel_info_, query_id_to_idx_ and
+    // judgments_) when they are shared with it, and NULL otherwise. A
+    // reference is held; none of them are modified once built.
+    PyObject* judgments_owner_;
+
+    // trec_eval session structure.
+    EPI epi_;
+
+    // trec_eval relevance structure.
+    ALL_REL_INFO all_rel_info_;
+
+    // Mapping from query identifier to internal idx.
+    std::map<std::string, size_t>* query_id_to_idx_;
+
+    // Judgment statistics per query (in the order of all_rel_info_).
+    std::vector<QueryJudgments>* judgments_;
+    std::set<size_t>* measures_;
+
+    // Private copies of the requested measures (in the order of measures_),
+    // initialized once against epi_; trec_eval's global measure table is
+    // never modified.
+    std::vector<TREC_MEAS>* measure_plan_;
+
+    // Default parameters handed to the measure copies, which init_meas may
+    // replace by the requested ones.
+    std::vector<PARAMS*>* measure_default_params_;
+
+    // Value layout of the measure plan, as filled in by init_meas.
+    TREC_EVAL measure_values_;
+
+    // Number of top-ranked documents that gets evaluated.
+    long depth_;
+
+    // Whether the measures of kFusedMeasures are computed in a single pass
+    // over the ranking (see EvaluationSession::ComputeFused) instead of by
+    // trec_eval.
+    bool fused_;
+} RelevanceEvaluator;
+
+// Measures that only look at the documents up to their largest cutoff.
+static const char* const kCutoffMeasures[] = {
+    "P", "relative_P", "recall", "success", "map_cut", "ndcg_cut", NULL};
+
+// Measures that do not depend on the ranking at all.
+static const char* const kRankingIndependentMeasures[] = {
+    "num_q", "num_rel", "runid", NULL};
+
+static bool IsMeasureIn(const TREC_MEAS* const measure, const char* const* names) {
+    for (; *names != NULL; ++names) {
+        if (strcmp(measure->name, *names) == 0) {
+            return true;
+        }
+    }
+
+    return false;
+}
+
+// Returns the number of top-ranked documents an initialized measure looks
+// at; MAXLONG if it needs the full ranking.
+static long MeasureDepth(const TREC_MEAS* const measure) {
+    if (IsMeasureIn(measure, kRankingIndependentMeasures)) {
+        return 0;
+    } else if (!IsMeasureIn(measure, kCutoffMeasures) || measure->meas_params == NULL) {
+        return MAXLONG;
+    }
+
+    const long* const cutoffs = (const long*) measure->meas_params->param_values;
+
+    long depth = 0;
+
+    for (long param_idx = 0; param_idx < measure->meas_params->num_params; ++param_idx) {
+        depth = std::max(depth, cutoffs[param_idx]);
+    }
+
+    return depth;
+}
+
+// Compiles the requested measures into the evaluator's measure plan: every
+// measure gets a private copy of its trec_eval definition and parameters,
+// which init_meas resolves against epi_ once. Sessions only copy the
+// resulting value layout.
+static bool InitMeasurePlan(RelevanceEvaluator* const self) {
+    self->measure_plan_->reserve(self->measures_->size());
+
+    for (std::set<size_t>::iterator it = self->measures_->begin();
+         it != self->measures_->end(); ++it) {
+        const size_t measure_idx = *it;
+
+        TREC_MEAS measure = *te_trec_measures[measure_idx];
+        PARAMS* params = NULL;
+
+        if (measure.meas_params != NULL) {
+            params = Malloc(1, PARAMS);
+            CHECK_NOTNULL(params);
+
+            *params = default_meas_params[measure_idx];
+        }
+
+        measure.meas_params = params;
+
+        if (measure.init_meas(&self->epi_, &measure, &self->measure_values_) == UNDEF) {
+            Free(params);
+
+            PyErr_Format(PyExc_ValueError,
+                         "Unable to initialize measure %s.", measure.name);
+
+            return false;
+        }
+
+        self->measure_plan_->push_back(measure);
+        self->measure_default_params_->push_back(params);
+    }
+
+    // Only the top-ranked documents that any measure looks at need to be
+    // ordered; as with trec_eval's -M, the ranking is never considered
+    // beyond max_num_docs_per_topic.
+    long measures_depth = 0;
+
+    for (size_t plan_idx = 0; plan_idx < self->measure_plan_->size(); ++plan_idx) {
+        measures_depth = std::max(measures_depth, MeasureDepth(&(*self->measure_plan_)[plan_idx]));
+    }
+
+    self->depth_ = std::min(self->epi_.max_num_docs_per_topic, measures_depth);
+
+    return true;
+}
+
+static void CleanupMeasurePlan(RelevanceEvaluator* const self) {
+    for (size_t plan_idx = 0; plan_idx < self->measure_plan_->size(); ++plan_idx) {
+        TREC_MEAS* const measure = &(*self->measure_plan_)[plan_idx];
+
+        // Cleanup; nothing gets printed as epi_.summary_flag == 0.
+        measure->print_final_and_cleanup_meas(
+            &self->epi_, measure, &self->measure_values_);
+
+        PARAMS* const default_params = (*self->measure_default_params_)[plan_idx];
+
+        if (measure->meas_params != NULL && measure->meas_params != default_params) {
+            Free(measure->meas_params);
+        }
+
+        if (default_params != NULL) {
+            Free(default_params);
+        }
+    }
+
+    self->measure_plan_->clear();
+    self->measure_default_params_->clear();
+
+    if (self->measure_values_.values != NULL) {
+        Free(self->measure_values_.values);
+
+        self->measure_values_.values = NULL;
+    }
+}
+
+static PyObject* RelevanceEvaluator_new(PyTypeObject* type, PyObject* args, PyObject* kwds) {
+    RelevanceEvaluator* self;
+
+    self = (RelevanceEvaluator*) type->tp_alloc(type, 0);
+    if (self != NULL) {
+        self->inited_ = false;
+        self->object_relevance_per_qid_ = NULL;
+        self->qrel_strings_ = NULL;
+        self->documents_ = new DocumentVocabulary;
+        self->judged_documents_ = NULL;
+        self->candidates_ = NULL;
+        self->judgments_owner_ = NULL;
+        self->query_id_to_idx_ = new std::map<std::string, size_t>;
+        self->judgments_ = new std::vector<QueryJudgments>;
+        self->measures_ = new std::set<size_t>;
+        self->measure_plan_ = new std::vector<TREC_MEAS>;
+        self->measure_default_params_ = new std::vector<PARAMS*>;
+#ifdef _MSC_VER
+        self->measure_values_ = TREC_EVAL {"all", 0, NULL, 0, 0};
+#else
+        self->measure_values_ = (TREC_EVAL) {"all", 0, NULL, 0, 0};
+#endif
+        self->depth_ = MAXLONG;
+        self->fused_ = true;
+        self->all_rel_info_.num_q_rels = -1;
+    }
+
+    return (PyObject*) self;
+}
+
+template <typename QueryT, typename ListOfPairsT, typename PairT>
+class RankingBuilder {
+ public:
+    typedef QueryT QueryType;
+    typedef PairT QueryDocumentPairType;
+
+    bool operator()(PyObject* const dict, int64& num_queries, QueryT*& queries) {
+        num_queries = PyDict_Size(dict);
+
+        // Reserve an additional element, such that empty dictionaries (e.g.,
+        // an empty run) still get valid buffers.
+        queries = Malloc(num_queries + 1, QueryT);
+        ListOfPairsT* const query_pair_list = Malloc(num_queries + 1, ListOfPairsT);
+
+        CHECK_NOTNULL(queries);
+        CHECK_NOTNULL(query_pair_list);
+
+        // The pair lists are freed through the first query (see cleanup).
+        ProcessQuery(&queries[0], &query_pair_list[0]);
+
+        PyObject* key = NULL;
+        PyObject* value = NULL;
+
+        Py_ssize_t pos = 0;
+
+        size_t query_idx = 0;
+
+        while (PyDict_Next(dict, &pos, &key, &value)) {
+            if (!PyUnicode_Check(key)) {
+                PyErr_SetString(PyExc_TypeError, "Expected string as key.");
+
+                return false;
+            }
+
+            if (!PyDict_Check(value)) {
+                PyErr_SetString(PyExc_TypeError, "Expected dictionary as value.");
+
+                return false;
+            }
+
+            queries[query_idx].qid = CopyCString(PyUnicode_AsUTF8(key));
+            CHECK_NOTNULL(queries[query_idx].qid);
+
+            PairT* const query_document_pairs = Malloc(PyDict_Size(value) + 1, PairT);
+
+            PyObject* inner_key = NULL;
+            PyObject* inner_value = NULL;
+
+            Py_ssize_t inner_pos = 0;
+
+            size_t pair_idx = 0;
+
+            while (PyDict_Next(value, &inner_pos, &inner_key, &inner_value)) {
+                if (!PyUnicode_Check(inner_key)) {
+                    PyErr_SetString(PyExc_TypeError, "Expected mapping of document id to query relevance or matching score.");
+
+                    return false;  // TODO(cvangysel): need to clean up here!
+                }
+
+                query_document_pairs[pair_idx].docno = ProcessDocno(PyUnicode_AsUTF8(inner_key));
+                CHECK_NOTNULL(query_document_pairs[pair_idx].docno);
+
+                if (!ProcessQueryDocumentPair(&query_document_pairs[pair_idx],
+                                              inner_value)) {
+                    return false;
+                }
+
+                ++pair_idx;
+            }
+            query_document_pairs[pair_idx].docno = NULL;
+
+            if (!ProcessListOfQueryDocumentPairs(&query_pair_list[query_idx],
+                                                 PyDict_Size(value),
+                                                 query_document_pairs)) {
+                return false;
+            }
+
+            if (!ProcessQuery(&queries[query_idx], &query_pair_list[query_idx])) {
+                return false;
+            }
+
+            ++query_idx;
+        }
+
+        return true;
+    }
+
+    virtual void cleanup(const int64 num_queries, QueryT* queries) const = 0;
+
+ protected:
+    virtual bool ProcessQuery(QueryT* const query,
+                              ListOfPairsT* query_pair_list) const = 0;
+
+    virtual bool ProcessListOfQueryDocumentPairs(
+        ListOfPairsT* const query_pair_list,
+        const size_t num_pairs,
+        PairT* const query_document_pairs) const = 0;
+
+    virtual bool ProcessQueryDocumentPair(
+        PairT* const pair,
+        PyObject* const inner_value) const = 0;
+
+    // Returns the document identifier to store; docno is owned by the key
+    // of the input dictionary.
+    virtual char* ProcessDocno(const char* const docno) const = 0;
+};
+
+class QrelRankingBuilder : public RankingBuilder<REL_INFO, TEXT_QRELS_INFO, TEXT_QRELS> {
+ public:
+    // Document identifiers are interned in documents, which owns them. When
+    // owns_qids is false, query identifiers point into a separately managed
+    // block (see QrelCollector) and are not freed here.
+    explicit QrelRankingBuilder(DocumentVocabulary* const documents,
+                                const bool owns_qids = true)
+        : documents_(documents), owns_qids_(owns_qids) {}
+
+    virtual void cleanup(const int64 num_queries, REL_INFO* queries) const {
+        if (queries == NULL) {
+            return;
+        }
+
+        for (size_t idx = 0; idx < num_queries; ++idx) {
+            Free(((TEXT_QRELS_INFO*) queries[idx].q_rel_info)->text_qrels);
+            if (owns_qids_) {
+                Free(queries[idx].qid);
+            }
+        }
+
+        Free(queries->q_rel_info);
+        Free(queries);
+    }
+
+ protected:
+    virtual bool ProcessQuery(REL_INFO* const query,
+                              TEXT_QRELS_INFO* const query_pair_list) const {
+        query->rel_format = "qrels";
+        query->q_rel_info = query_pair_list;
+
+        return true;
+    }
+
+    virtual bool ProcessListOfQueryDocumentPairs(
+            TEXT_QRELS_INFO* const query_pair_list,
+            const size_t num_pairs,
+            TEXT_QRELS* const query_document_pairs) const {
+        query_pair_list->num_text_qrels = num_pairs;
+        query_pair_list->text_qrels = query_document_pairs;
+
+        return true;
+    }
+
+    virtual bool ProcessQueryDocumentPair(TEXT_QRELS* const pair,
+                                          PyObject* const inner_value) const {
+        if (!PyLong_Check(inner_value)) {
+            PyErr_SetString(PyExc_TypeError, "Expected relevance to be integer.");
+
+            return false;
+        }
+
+        pair->rel = PyLong_AsLong(inner_value);
+
+        return true;
+    }
+
+    virtual char* ProcessDocno(const char* const docno) const {
+        return documents_->Get(documents_->Intern(docno));
+    }
+
+ private:
+    DocumentVocabulary* const documents_;
+    const bool owns_qids_;
+};
+
+class ResultRankingBuilder : public RankingBuilder<RESULTS, TEXT_RESULTS_INFO, TEXT_RESULTS> {
+ public:
+    virtual void cleanup(const int64 num_queries, RESULTS* queries) const {
+        if (queries == NULL) {
+            return;
+        }
+
+        for (size_t idx = 0; idx < num_queries; ++idx) {
+            Free(((TEXT_RESULTS_INFO*) queries[idx].q_results)->text_results);
+            Free(queries[idx].qid);
+        }
+
+        Free(queries->q_results);
+        Free(queries);
+    }
+
+ protected:
+    virtual bool ProcessQuery(RESULTS* const query,
+                              TEXT_RESULTS_INFO* const query_pair_list) const {
+        query->run_id = "my_little_test_run";
+        query->ret_format = "trec_results";
+        query->q_results = query_pair_list;
+
+        return true;
+    }
+
+    virtual bool ProcessListOfQueryDocumentPairs(
+            TEXT_RESULTS_INFO* const query_pair_list,
+            const size_t num_pairs,
+            TEXT_RESULTS* const query_document_pairs) const {
+        query_pair_list->num_text_results = num_pairs;
+        query_pair_list->text_results = query_document_pairs;
+
+        return true;
+    }
+
+    virtual bool ProcessQueryDocumentPair(TEXT_RESULTS* const pair,
+                                          PyObject* const inner_value) const {
+        if (PyFloat_Check(inner_value)) {
+		pair->sim = PyFloat_AsDouble(inner_value);
+	} else if (PyLong_Check(inner_value)) {
+		pair->sim = PyLong_AsDouble(inner_value);
+	} else {
+		PyErr_SetString(PyExc_TypeError, "Expected matching score to be int, long or float.");
+		return false;
+        }
+        return true;
+    }
+
+    virtual char* ProcessDocno(const char* const docno) const {
+        // The run dictionary outlives the structures, so there is no need
+        // to copy.
+        return (char*) docno;
+    }
+};
+
+bool qrel_docno_compare(
+        const QrelRankingBuilder::QueryDocumentPairType& a,
+        const QrelRankingBuilder::QueryDocumentPairType& b) {
+    return strcmp(a.docno, b.docno) < 0;
+}
+
+// Collects relevance judgments, in any order, into trec_eval's relevance
+// structures without creating Python objects. Document identifiers are
+// interned in documents and query identifiers are stored in a single block
+// (returned by Finish); clean up using
+// QrelRankingBuilder(documents, false /* owns_qids */).
+class QrelCollector {
+ public:
+    explicit QrelCollector(DocumentVocabulary* const documents)
+        : documents_(documents), current_query_idx_(0) {}
+
+    void Add(const char* const qid, const char* const docno, const long relevance) {
+        if (judgments_.empty() || current_qid_.compare(qid) != 0) {
+            current_qid_ = qid;
+
+            std::map<std::string, size_t>::iterator it = qid_to_idx_.find(current_qid_);
+
+            if (it == qid_to_idx_.end()) {
+                current_query_idx_ = judgments_.size();
+                qid_to_idx_.insert(std::make_pair(current_qid_, current_query_idx_));
+
+                qid_offsets_.push_back(string_block_.size());
+                string_block_.insert(string_block_.end(),
+                                     current_qid_.c_str(),
+                                     current_qid_.c_str() + current_qid_.size() + 1);
+
+                judgments_.push_back(std::vector<std::pair<char*, long> >());
+            } else {
+                current_query_idx_ = it->second;
+            }
+        }
+
+        judgments_[current_query_idx_].push_back(
+            std::make_pair(documents_->Get(documents_->Intern(docno)), relevance));
+    }
+
+    void Finish(int64& num_queries, REL_INFO*& queries, char*& strings) {
+        strings = Malloc(string_block_.size() + 1, char);
+        CHECK_NOTNULL(strings);
+
+        if (!string_block_.empty()) {
+            memcpy(strings, &string_block_[0], string_block_.size());
+        }
+
+        num_queries = judgments_.size();
+
+        // As RankingBuilder, reserve an additional element and link the pair
+        // lists to the first query, such that cleanup frees them.
+        queries = Malloc(num_queries + 1, REL_INFO);
+        TEXT_QRELS_INFO* const query_pair_list = Malloc(num_queries + 1, TEXT_QRELS_INFO);
+
+        CHECK_NOTNULL(queries);
+        CHECK_NOTNULL(query_pair_list);
+
+        queries[0].q_rel_info = query_pair_list;
+
+        for (size_t query_idx = 0; query_idx < (size_t) num_queries; ++query_idx) {
+            const std::vector<std::pair<char*, long> >& query_judgments = judgments_[query_idx];
+
+            TEXT_QRELS* const text_qrels = Malloc(query_judgments.size() + 1, TEXT_QRELS);
+            CHECK_NOTNULL(text_qrels);
+
+            for (size_t pair_idx = 0; pair_idx < query_judgments.size(); ++pair_idx) {
+                text_qrels[pair_idx].docno = query_judgments[pair_idx].first;
+                text_qrels[pair_idx].rel = query_judgments[pair_idx].second;
+            }
+            text_qrels[query_judgments.size()].docno = NULL;
+
+            query_pair_list[query_idx].num_text_qrels = query_judgments.size();
+            query_pair_list[query_idx].max_num_text_qrels = query_judgments.size();
+            query_pair_list[query_idx].text_qrels = text_qrels;
+
+            queries[query_idx].qid = strings + qid_offsets_[query_idx];
+            queries[query_idx].rel_format = "qrels";
+            queries[query_idx].q_rel_info = &query_pair_list[query_idx];
+        }
+    }
+
+ private:
+    DocumentVocabulary* const documents_;
+
+    // Query identifiers are referenced by their offset until the block is
+    // final.
+    std::vector<char> string_block_;
+    std::map<std::string, size_t> qid_to_idx_;
+    std::vector<size_t> qid_offsets_;
+    std::vector<std::vector<std::pair<char*, long> > > judgments_;
+
+    std::string current_qid_;
+    size_t current_query_idx_;
+};
+
+// Reads a TREC qrel file directly into trec_eval's relevance structures
+// (see QrelCollector).
+static bool ReadQrelFile(const char* const path,
+                         DocumentVocabulary* const documents,
+                         int64& num_queries,
+                         REL_INFO*& queries,
+                         char*& strings) {
+    FILE* const f = fopen(path, "rb");
+    if (f == NULL) {
+        PyErr_SetFromErrnoWithFilename(PyExc_OSError, path);
+
+        return false;
+    }
+
+    LineReader reader(f);
+    QrelCollector collector(documents);
+
+    char* line = NULL;
+    size_t length = 0;
+    char* fields[QREL_NUM_FIELDS];
+
+    bool success = true;
+
+    while (reader.Next(&line, &length)) {
+        const size_t num_fields = SplitFields(line, fields, QREL_NUM_FIELDS);
+
+        if (num_fields == 0) {
+            continue;  // Skip blank lines.
+        }
+
+        long relevance = 0;
+
+        if (num_fields != QREL_NUM_FIELDS) {
+            PyErr_Format(PyExc_ValueError,
+                         "%s:%zu: expected %d fields.",
+                         path, reader.line_number(), QREL_NUM_FIELDS);
+
+            success = false;
+            break;
+        } else if (!ParseLong(fields[QREL_REL_FIELD], &relevance)) {
+            PyErr_Format(PyExc_ValueError,
+                         "%s:%zu: unable to parse relevance '%s'.",
+                         path, reader.line_number(), fields[QREL_REL_FIELD]);
+
+            success = false;
+            break;
+        }
+
+        collector.Add(fields[QREL_QID_FIELD], fields[QREL_DOCNO_FIELD], relevance);
+    }
+
+    if (success && reader.error()) {
+        PyErr_SetFromErrnoWithFilename(PyExc_OSError, path);
+
+        success = false;
+    }
+
+    fclose(f);
+
+    if (success) {
+        collector.Finish(num_queries, queries, strings);
+    }
+
+    return success;
+}
+
+// Collects relevance judgments from parallel arrays of integer query
+// identifiers, integer document identifiers and relevance labels (see
+// QrelCollector and ComputeSegments).
+static bool CollectQrelArrays(PyObject* const qids_obj,
+                              PyObject* const docids_obj,
+                              PyObject* const relevances_obj,
+                              PyObject* const offsets_obj,
+                              DocumentVocabulary* const documents,
+                              int64& num_queries,
+                              REL_INFO*& queries,
+                              char*& strings) {
+    ArrayView qids, docids, relevances, offsets;
+
+    if (!qids.Acquire(qids_obj, "qids", true /* integral */) ||
+            !docids.Acquire(docids_obj, "docids", true /* integral */) ||
+            !relevances.Acquire(relevances_obj, "relevances", true /* integral */) ||
+            (offsets_obj != Py_None &&
+             !offsets.Acquire(offsets_obj, "offsets", true /* integral */))) {
+        return false;
+    }
+
+    if (docids.size() != relevances.size()) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Arguments docids and relevances should be of equal length.");
+
+        return false;
+    }
+
+    std::vector<int64> segment_qids;
+    std::vector<Py_ssize_t> segment_offsets;
+
+    if (!ComputeSegments(qids, offsets_obj != Py_None ? &offsets : NULL,
+                         docids.size(), false /* unique_qids */,
+                         &segment_qids, &segment_offsets)) {
+        return false;
+    }
+
+    QrelCollector collector(documents);
+
+    std::vector<char> qid, docno;
+
+    for (size_t segment_idx = 0; segment_idx < segment_qids.size(); ++segment_idx) {
+        qid.clear();
+        AppendIdentifier(segment_qids[segment_idx], &qid);
+
+        for (Py_ssize_t idx = segment_offsets[segment_idx];
+             idx < segment_offsets[segment_idx + 1]; ++idx) {
+            docno.clear();
+            AppendIdentifier(docids.AsInt(idx), &docno);
+
+            collector.Add(&qid[0], &docno[0], (long) relevances.AsInt(idx));
+        }
+    }
+
+    collector.Finish(num_queries, queries, strings);
+
+    return true;
+}
+
+static int RelevanceEvaluator_init(RelevanceEvaluator* self, PyObject* args, PyObject* kwds) {
+    PyObject* object_relevance_per_qid = NULL;
+    PyObject* measures = NULL;
+    PyObject* tmp_measures = NULL;
+
+    // Alternative sources of relevance information.
+    PyObject* qrel_path = NULL;
+    PyObject* qrel_arrays = NULL;
+
+    int32 relevance_level = 1;
+
+    // Maximum number of documents per query to consider (trec_eval's -M).
+    long depth = MAXLONG;
+
+    // Evaluator whose relevance structures are shared.
+    PyObject* judgments_of = NULL;
+
+    int fused = 1;
+
+    static char* kwlist[] = {
+        "query_relevance", "measures", "relevance_level",
+        "qrel_path", "qrel_arrays", "depth", "judgments_of", "fused",
+        NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(
+            args, kwds, "OO|iO&O!lO!p", kwlist,
+            &object_relevance_per_qid,
+            &measures,
+            &relevance_level,
+            PyUnicode_FSConverter, &qrel_path,
+            &PyTuple_Type, &qrel_arrays,
+            &depth,
+            &RelevanceEvaluatorType, &judgments_of,
+            &fused)) {
+        PyErr_SetString(
+            PyExc_TypeError,
+            "Expected object_relevance_per_qid dictionary "
+            "and measures set.");
+
+        return -1;
+    }
+
+    const int num_sources =
+        (qrel_path != NULL) + (qrel_arrays != NULL) + (judgments_of != NULL);
+
+    if (num_sources > 0) {
+        if (object_relevance_per_qid != Py_None || num_sources > 1) {
+            PyErr_SetString(PyExc_TypeError,
+                            "Expected a single source of relevance "
+                            "information.");
+
+            Py_XDECREF(qrel_path);
+
+            return -1;
+        }
+
+        if (qrel_arrays != NULL && PyTuple_Size(qrel_arrays) != 4) {
+            PyErr_SetString(PyExc_TypeError,
+                            "Argument qrel_arrays should be a tuple of qids, "
+                            "docids, relevances and offsets.");
+
+            return -1;
+        }
+
+        if (judgments_of != NULL && !((RelevanceEvaluator*) judgments_of)->inited_) {
+            PyErr_SetString(PyExc_ValueError,
+                            "Argument judgments_of should be an initialized "
+                            "evaluator.");
+
+            return -1;
+        }
+    } else if (!PyDict_Check(object_relevance_per_qid)) {
+        PyErr_SetString(PyExc_TypeError,
+                        "Argument query_relevance should be of type dictionary.");
+
+        return -1;
+    }
+
+    if (!PySet_Check(measures)) {
+        PyErr_SetString(PyExc_TypeError,
+                        "Argument measures should be of type set.");
+
+        Py_XDECREF(qrel_path);
+
+        return -1;
+    }
+
+    if (relevance_level < 1) {
+        PyErr_SetString(PyExc_TypeError,
+                        "Argument relevance_level should be positive.");
+
+        Py_XDECREF(qrel_path);
+
+        return -1;
+    }
+
+    if (depth < 1) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Argument depth should be positive.");
+
+        Py_XDECREF(qrel_path);
+
+        return -1;
+    }
+
+    // Configure trec_eval session.
+    self->epi_.query_flag = 0;
+    self->epi_.average_complete_flag = 0;
+    self->epi_.judged_docs_only_flag = 0;
+    self->epi_.summary_flag = 0;
+    self->epi_.relation_flag = 1;
+    self->epi_.debug_level = 0;
+    self->epi_.debug_query = NULL;
+    self->epi_.num_docs_in_coll = 0;
+    self->epi_.relevance_level = relevance_level;
+    self->epi_.max_num_docs_per_topic = depth;
+    self->epi_.rel_info_format = "qrels";
+    self->epi_.results_format = "trec_results";
+    self->epi_.zscore_flag = 0;
+    self->epi_.meas_arg = NULL;
+
+    self->fused_ = fused;
+
+    // Resolve requested measures.
+    self->epi_.meas_arg = Malloc(PySet_Size(measures)+1, MEAS_ARG);
+    self->epi_.meas_arg[0].measure_name = NULL;
+    self->epi_.meas_arg[0].parameters = NULL;
+    size_t meas_arg_idx = 0;
+
+    tmp_measures = PySet_New(measures);
+    PyObject* meas_iter = PyObject_GetIter(measures);
+    PyObject *meas;
+    char* meas_args;
+    char* meas_name;
+    while ((meas = PyIter_Next(meas_iter))) {
+        meas_name = CopyCString(PyUnicode_AsUTF8(meas));
+        meas_args = meas_name;
+        while (*meas_args && *meas_args!='.') meas_args++;
+        if (*meas_args) {
+            *meas_args++ = '\0';
+            self->epi_.meas_arg[meas_arg_idx].measure_name = meas_name;
             self->epi_.meas_arg[meas_arg_idx].parameters = meas_args;
             self->epi_.meas_arg[++meas_arg_idx].measure_name = NULL;
             PySet_Discard(tmp_measures, meas);
@@ -399,311 +1621,2989 @@ static int RelevanceEvaluator_init(RelevanceEvaluator* self, PyObject* args, PyO
             meas = PyUnicode_FromString(meas_name);
             PySet_Add(tmp_measures, meas);
         }
-        else {
-            Free(meas_name);
+        else {
+            Free(meas_name);
+        }
+        Py_DECREF(meas);
+    }
+
+    Py_DECREF(meas_iter);
+
+    for (size_t measure_idx = 0;
+         measure_idx < te_num_trec_measures;
+         ++measure_idx) {
+        PyObject* const measure_name = PyUnicode_FromFormat(
+            "%s", te_trec_measures[measure_idx]->name);
+
+        if (1 == PySet_Contains(tmp_measures, measure_name)) {
+            self->measures_->insert(measure_idx);
+        }
+
+        Py_DECREF(measure_name);
+    }
+
+    const bool invalid_measures = self->measures_->size() != PySet_Size(tmp_measures);
+
+    Py_DECREF(tmp_measures);
+
+    if (invalid_measures) {
+        PyErr_SetString(
+            PyExc_TypeError,
+            "Unable to resolve all measures.");
+
+        Py_XDECREF(qrel_path);
+
+        return -1;
+    }
+
+    if (!InitMeasurePlan(self)) {
+        Py_XDECREF(qrel_path);
+
+        return -1;
+    }
+
+    if (judgments_of != NULL) {
+        // Share the relevance structures instead of building them; they do
+        // not depend on the measures or the relevance level.
+        RelevanceEvaluator* const source = (RelevanceEvaluator*) judgments_of;
+
+        PyObject* const owner = source->judgments_owner_ != NULL
+            ? source->judgments_owner_ : judgments_of;
+        RelevanceEvaluator* const owner_evaluator = (RelevanceEvaluator*) owner;
+
+        Py_INCREF(owner);
+        self->judgments_owner_ = owner;
+
+        delete self->documents_;
+        delete self->query_id_to_idx_;
+        delete self->judgments_;
+
+        self->qrel_strings_ = owner_evaluator->qrel_strings_;
+        self->judged_documents_ = owner_evaluator->judged_documents_;
+        self->all_rel_info_ = owner_evaluator->all_rel_info_;
+        self->query_id_to_idx_ = owner_evaluator->query_id_to_idx_;
+        self->judgments_ = owner_evaluator->judgments_;
+
+        // Documents interned by the source (e.g., its candidates) keep their
+        // ids; documents interned afterwards are private to either.
+        self->documents_ = source->documents_->Copy();
+
+        if (source->candidates_ != NULL) {
+            self->candidates_ = new CandidateSet(*source->candidates_);
+
+            for (size_t query_idx = 0; query_idx < self->candidates_->candidates.size(); ++query_idx) {
+                std::vector<char*>& candidates = self->candidates_->candidates[query_idx];
+
+                for (size_t candidate_idx = 0; candidate_idx < candidates.size(); ++candidate_idx) {
+                    candidates[candidate_idx] = self->documents_->Get(
+                        self->documents_->Find(candidates[candidate_idx]));
+                }
+            }
+        }
+
+        self->inited_ = true;
+
+        return 0;
+    }
+
+    int64 num_queries = 0;
+    QrelRankingBuilder::QueryType* queries = NULL;
+
+    if (qrel_path != NULL) {
+        // Read relevance information straight from file.
+        const bool success = ReadQrelFile(
+            PyBytes_AsString(qrel_path), self->documents_,
+            num_queries, queries,
+            self->qrel_strings_);
+
+        if (!success) {
+            Py_DECREF(qrel_path);
+
+            return -1;
+        }
+    } else if (qrel_arrays != NULL) {
+        if (!CollectQrelArrays(PyTuple_GET_ITEM(qrel_arrays, 0),
+                               PyTuple_GET_ITEM(qrel_arrays, 1),
+                               PyTuple_GET_ITEM(qrel_arrays, 2),
+                               PyTuple_GET_ITEM(qrel_arrays, 3),
+                               self->documents_,
+                               num_queries, queries,
+                               self->qrel_strings_)) {
+            return -1;
+        }
+    } else {
+        // Save reference to object_relevance_per_qid.
+        Py_INCREF(object_relevance_per_qid);
+
+        self->object_relevance_per_qid_ = object_relevance_per_qid;
+        CHECK_NOTNULL(self->object_relevance_per_qid_);
+
+        // Build internal trec_eval data structures.
+        QrelRankingBuilder builder(self->documents_);
+
+        if (!builder(self->object_relevance_per_qid_, num_queries, queries)) {
+            Py_DECREF(self->object_relevance_per_qid_);
+            self->object_relevance_per_qid_ = NULL;
+
+            return -1;
+        }
+    }
+
+    CHECK_NOTNULL(queries);
+
+    // Install the structures before validating them, such that they get
+    // cleaned up on failure.
+    self->all_rel_info_.num_q_rels = num_queries;
+    self->all_rel_info_.rel_info = queries;
+
+    for (size_t query_idx = 0; query_idx < num_queries; ++query_idx) {
+        TEXT_QRELS_INFO* const text_qrels_info = (TEXT_QRELS_INFO*) queries[query_idx].q_rel_info;
+
+        QrelRankingBuilder::QueryDocumentPairType* const text_qrels = text_qrels_info->text_qrels;
+        const long num_text_qrels = text_qrels_info->num_text_qrels;
+
+        std::sort(
+            text_qrels, text_qrels + num_text_qrels,
+            qrel_docno_compare);
+
+        // Dictionary keys are unique, but lines in a file or arrays need not
+        // be. Document identifiers are interned, so comparing pointers suffices.
+        for (long pair_idx = 1;
+             self->object_relevance_per_qid_ == NULL && pair_idx < num_text_qrels;
+             ++pair_idx) {
+            if (text_qrels[pair_idx - 1].docno == text_qrels[pair_idx].docno) {
+                PyErr_Format(PyExc_ValueError,
+                             "%s: duplicate document '%s' for query '%s'.",
+                             qrel_path != NULL ? PyBytes_AsString(qrel_path) : "qrel_arrays",
+                             text_qrels[pair_idx].docno,
+                             queries[query_idx].qid);
+
+                Py_XDECREF(qrel_path);
+
+                return -1;
+            }
+        }
+    }
+
+    Py_XDECREF(qrel_path);
+
+    for (size_t query_idx = 0; query_idx < num_queries; ++query_idx) {
+        const std::string& qid = queries[query_idx].qid;
+        CHECK_EQ(self->query_id_to_idx_->find(qid), self->query_id_to_idx_->end());
+
+        self->query_id_to_idx_->insert(std::pair<std::string, size_t>(qid, query_idx));
+    }
+
+    // Judgments are sorted by document identifier and free of duplicates.
+    self->judgments_->resize(num_queries);
+
+    for (size_t query_idx = 0; query_idx < num_queries; ++query_idx) {
+        ComputeQueryJudgments(&queries[query_idx], &(*self->judgments_)[query_idx]);
+    }
+
+    // Freeze the judged documents; documents interned from now on extend
+    // them privately.
+    self->judged_documents_ = self->documents_;
+    self->documents_ = new DocumentVocabulary(self->judged_documents_);
+
+    self->inited_ = true;
+
+    return NULL;
+}
+
+static void RelevanceEvaluator_dealloc(RelevanceEvaluator* self) {
+    if (self->judgments_owner_ != NULL) {
+        // The relevance structures belong to the owner.
+        self->all_rel_info_.num_q_rels = -1;
+        self->qrel_strings_ = NULL;
+        self->judged_documents_ = NULL;
+        self->query_id_to_idx_ = NULL;
+        self->judgments_ = NULL;
+    }
+
+    if (self->object_relevance_per_qid_ != NULL) {
+        Py_DECREF(self->object_relevance_per_qid_);
+
+        self->object_relevance_per_qid_ = NULL;
+    }
+
+    if (self->all_rel_info_.num_q_rels >= 0) {
+        // Clean up internal trec_eval data structures.
+        QrelRankingBuilder builder(self->documents_,
+                                   self->qrel_strings_ == NULL /* owns_qids */);
+        builder.cleanup(self->all_rel_info_.num_q_rels, self->all_rel_info_.rel_info);
+
+        self->all_rel_info_.num_q_rels = -1;
+    }
+
+    if (self->qrel_strings_ != NULL) {
+        Free(self->qrel_strings_);
+
+        self->qrel_strings_ = NULL;
+    }
+
+    CleanupMeasurePlan(self);
+
+    delete self->candidates_;
+    delete self->documents_;
+    delete self->judged_documents_;
+    delete self->query_id_to_idx_;
+    delete self->judgments_;
+    delete self->measures_;
+    delete self->measure_plan_;
+    delete self->measure_default_params_;
+    if (self->inited_) {
+        size_t i = 0;
+        while (self->epi_.meas_arg[i].measure_name != NULL) {
+            Free(self->epi_.meas_arg[i].measure_name);
+            i++;
+        }
+        Free(self->epi_.meas_arg);
+    }
+
+    Py_XDECREF(self->judgments_owner_);
+}
+
+// Orders results the way trec_eval ranks them: by decreasing score, ties
+// broken by decreasing document identifier.
+bool query_document_pair_compare(
+        const ResultRankingBuilder::QueryDocumentPairType& a,
+        const ResultRankingBuilder::QueryDocumentPairType& b) {
+    if (a.sim < b.sim) return false;
+    if (a.sim > b.sim) return true;
+    return strcmp(a.docno, b.docno) > 0;
+}
+
+// Cutoff measures that evaluate_curves computes at every rank, in the order
+// of kCurveMeasures.
+enum CurveMeasure {
+    kCurveP, kCurveRecall, kCurveSuccess, kCurveMapCut, kCurveNdcgCut,
+};
+
+static const char* const kCurveMeasures[] = {
+    "P", "recall", "success", "map_cut", "ndcg_cut", NULL};
+
+// Measures that EvaluationSession::ComputeFused computes in a single pass
+// over the ranking, in the order of kFusedMeasures; the cutoff measures come
+// first.
+enum FusedMeasure {
+    kFusedNone = -1,
+    kFusedP, kFusedRecall, kFusedSuccess, kFusedMapCut, kFusedNdcgCut,
+    kFusedMap, kFusedNdcg, kFusedRprec, kFusedRecipRank, kFusedBpref,
+    kFusedNumRet, kFusedNumRel, kFusedNumRelRet, kFusedSetP, kFusedSetRecall,
+};
+
+static const char* const kFusedMeasures[] = {
+    "P", "recall", "success", "map_cut", "ndcg_cut",
+    "map", "ndcg", "Rprec", "recip_rank", "bpref",
+    "num_ret", "num_rel", "num_rel_ret", "set_P", "set_recall", NULL};
+
+// Serializes the calls into trec_eval's measures, some of which keep
+// buffers in globals (or modify their parameters). Only the measures of
+// ComputeFused, which does not call into trec_eval, run concurrently.
+static std::mutex trec_eval_mutex;
+
+// State of te_form_res_rels. Every thread has its own, such that queries
+// can be computed concurrently (see ComputeQueriesInParallel).
+struct FormResRelsState {
+    // Evaluator whose measures are being computed; provides the judgment
+    // statistics, and is part of the key of the cached query.
+    const RelevanceEvaluator* evaluator;
+
+    bool cached;
+    const RelevanceEvaluator* cached_evaluator;
+    std::string cached_qid;
+    RES_RELS saved;
+
+    // Buffers, reused across queries.
+    std::vector<long> rel_levels;
+    std::vector<long> rel_list;
+    std::vector<TEXT_RESULTS> ranking;
+    QueryJudgments judgments;
+    std::unordered_set<const char*,
+                       DocumentVocabulary::CStringHash,
+                       DocumentVocabulary::CStringEqual> docnos;
+
+    FormResRelsState() : evaluator(NULL), cached(false), cached_evaluator(NULL) {
+        memset(&saved, 0, sizeof (saved));
+    }
+};
+
+static thread_local FormResRelsState form_res_rels;
+
+// Matches the ranking of a query against its judgments for all measures;
+// replaces trec_eval's version, which sorts the ranking by document
+// identifier, merges it with the judgments and recounts the relevance
+// levels for every query it sees. Here, the judgment statistics are
+// computed once per evaluator, the ranking is already ordered (see
+// EvaluationSession::Rank) and every ranked document is looked up in the
+// sorted judgments.
+extern "C" int te_form_res_rels(const EPI* epi, const REL_INFO* rel_info,
+                                const RESULTS* results, RES_RELS* res_rels) {
+    FormResRelsState* const state = &form_res_rels;
+
+    if (state->cached && state->cached_evaluator == state->evaluator &&
+            state->cached_qid == results->qid) {
+        // Have done this query already.
+        *res_rels = state->saved;
+
+        return 1;
+    }
+
+    if (strcmp("qrels", rel_info->rel_format) != 0 ||
+            strcmp("trec_results", results->ret_format) != 0) {
+        return UNDEF;
+    }
+
+    const RelevanceEvaluator* const evaluator = state->evaluator;
+    const QueryJudgments* judgments = NULL;
+
+    if (evaluator != NULL &&
+            rel_info >= evaluator->all_rel_info_.rel_info &&
+            rel_info < evaluator->all_rel_info_.rel_info + evaluator->all_rel_info_.num_q_rels) {
+        judgments = &(*evaluator->judgments_)[rel_info - evaluator->all_rel_info_.rel_info];
+    } else {
+        ComputeQueryJudgments(rel_info, &state->judgments);
+        judgments = &state->judgments;
+    }
+
+    const TEXT_QRELS_INFO* const text_qrels_info = (const TEXT_QRELS_INFO*) rel_info->q_rel_info;
+
+    const TEXT_QRELS* const text_qrels_begin = text_qrels_info->text_qrels;
+    const TEXT_QRELS* const text_qrels_end = text_qrels_begin + text_qrels_info->num_text_qrels;
+
+    const TEXT_RESULTS_INFO* const text_results_info = (const TEXT_RESULTS_INFO*) results->q_results;
+
+    const TEXT_RESULTS* text_results = text_results_info->text_results;
+    long num_results = text_results_info->num_text_results;
+
+    if (!std::is_sorted(text_results, text_results + num_results,
+                        query_document_pair_compare)) {
+        state->ranking.assign(text_results, text_results + num_results);
+
+        std::sort(state->ranking.begin(), state->ranking.end(),
+                  query_document_pair_compare);
+
+        text_results = &state->ranking[0];
+    }
+
+    num_results = std::min(num_results, epi->max_num_docs_per_topic);
+
+    RES_RELS saved = state->saved;
+
+    saved.num_rel_ret = 0;
+    saved.num_nonpool = 0;
+    saved.num_unjudged_in_pool = 0;
+
+    state->rel_list.resize(num_results + 1);
+    state->docnos.clear();
+
+    for (long rank_idx = 0; rank_idx < num_results; ++rank_idx) {
+        const char* const docno = text_results[rank_idx].docno;
+
+        if (!state->docnos.insert(docno).second) {
+            // Duplicate document.
+            return UNDEF;
+        }
+
+        const TEXT_QRELS* const text_qrel = std::lower_bound(
+            text_qrels_begin, text_qrels_end, docno,
+            [](const TEXT_QRELS& text_qrel, const char* const docno) {
+                return strcmp(text_qrel.docno, docno) < 0;
+            });
+
+        long rel = RELVALUE_NONPOOL;
+
+        if (text_qrel != text_qrels_end && strcmp(text_qrel->docno, docno) == 0) {
+            // In pool, but possibly unjudged (e.g., infAP uses a sample).
+            rel = text_qrel->rel >= 0 ? text_qrel->rel : RELVALUE_UNJUDGED;
+        }
+
+        state->rel_list[rank_idx] = rel;
+
+        if (rel >= epi->relevance_level) {
+            ++saved.num_rel_ret;
+        } else if (rel == RELVALUE_NONPOOL) {
+            ++saved.num_nonpool;
+        } else if (rel == RELVALUE_UNJUDGED) {
+            ++saved.num_unjudged_in_pool;
+        }
+    }
+
+    // Measures receive their own copy of the relevance levels.
+    state->rel_levels.assign(judgments->rel_levels.begin(), judgments->rel_levels.end());
+    state->rel_levels.push_back(0);
+
+    saved.num_rel = 0;
+
+    for (long rel = std::max((long) epi->relevance_level, 0L); rel <= judgments->max_rel; ++rel) {
+        saved.num_rel += judgments->rel_levels[rel];
+    }
+
+    saved.num_ret = num_results;
+    saved.num_rel_levels = judgments->max_rel + 1;
+    saved.rel_levels = &state->rel_levels[0];
+    saved.results_rel_list = &state->rel_list[0];
+
+    state->saved = saved;
+    state->cached_evaluator = state->evaluator;
+    state->cached_qid = results->qid;
+    state->cached = true;
+
+    *res_rels = saved;
+
+    return 1;
+}
+
+// Invalidates the query cached by te_form_res_rels for the calling thread;
+// the buffers are kept.
+extern "C" int te_form_res_rels_cleanup() {
+    form_res_rels.cached = false;
+
+    return 1;
+}
+
+// Statistics of the documents up to a cutoff, as kept by
+// EvaluationSession::ComputeFused.
+struct FusedStatistics {
+    long num_rel_ret;
+    double precision_sum;
+    double gain;
+    double ideal_gain;
+};
+
+// Evaluates rankings one query at a time against the relevance information
+// and measure plan of an evaluator.
+class EvaluationSession {
+ public:
+    // Unless a positive depth is given, rankings are only ordered as deep as
+    // the measures of the evaluator require.
+    explicit EvaluationSession(RelevanceEvaluator* const evaluator, const long depth = 0)
+            : evaluator_(evaluator), plan_(evaluator->measure_plan_),
+              depth_(depth > 0
+                     ? std::min(depth, evaluator->epi_.max_num_docs_per_topic)
+                     : evaluator->depth_),
+              rows_(NULL), row_qids_(NULL) {
+        // Copy the value layout of the evaluator's measure plan.
+        const TREC_EVAL& measure_values = evaluator_->measure_values_;
+
+        accum_eval_ = measure_values;
+        accum_eval_.values = Malloc(measure_values.num_values, TREC_EVAL_VALUE);
+        CHECK_NOTNULL(accum_eval_.values);
+
+        memcpy(accum_eval_.values, measure_values.values,
+               measure_values.num_values * sizeof (TREC_EVAL_VALUE));
+
+        accum_eval_.max_num_values = measure_values.num_values;
+
+        /* Reserve space and initialize q_eval to be copy of accum_eval */
+        InitQueryEval(&q_eval_);
+
+        InitFusedPlan();
+
+        // Measure names are shared by the output of all queries.
+        std::vector<std::pair<const char*, int32> > values;
+        ListValues(&values);
+
+        for (size_t idx = 0; idx < values.size(); ++idx) {
+            value_names_.push_back(std::make_pair(
+                PyUnicode_InternFromString(values[idx].first), values[idx].second));
+        }
+    }
+
+    ~EvaluationSession() {
+        for (size_t idx = 0; idx < value_names_.size(); ++idx) {
+            Py_DECREF(value_names_[idx].first);
+        }
+
+        FreeQueryEval(&q_eval_);
+        Free(accum_eval_.values);
+    }
+
+    // Evaluates a single query and adds a dictionary with its measures to
+    // result (see Emit). Queries without relevance information are skipped. When
+    // ranked, the results are already in ranking order. Returns false and
+    // sets a Python exception on failure.
+    bool Evaluate(RESULTS* const query, PyObject* const result, const bool ranked = false) {
+        const long eval_query_idx = FindQuery(query->qid);
+
+        if (eval_query_idx < 0) {
+            // Query not found in relevance judgments; skipping.
+            return true;
+        }
+
+        size_t failed_measure_idx = 0;
+
+        if (!Rank(query, ranked) ||
+                !Compute(eval_query_idx, query, &q_eval_, &fused_statistics_,
+                         &failed_measure_idx)) {
+            SetComputeError(failed_measure_idx, query->qid);
+
+            return false;
+        }
+
+        Emit(query->qid, &q_eval_, result);
+
+        return true;
+    }
+
+    // Returns the index of qid in the relevance information, or -1.
+    long FindQuery(const char* const qid) const {
+        std::map<std::string, size_t>::const_iterator it = evaluator_->query_id_to_idx_->find(qid);
+
+        return it != evaluator_->query_id_to_idx_->end() ? (long) it->second : -1;
+    }
+
+    // Orders the results of a query, and drops those beyond the evaluation
+    // depth. Does not call into Python. Returns false if a document occurs
+    // more than once; as in trec_eval, also beyond the depth.
+    bool Rank(RESULTS* const query, const bool ranked) const {
+        TEXT_RESULTS_INFO* const text_results_info = (TEXT_RESULTS_INFO*) query->q_results;
+
+        ResultRankingBuilder::QueryDocumentPairType* const text_results = text_results_info->text_results;
+        long num_text_results = text_results_info->num_text_results;
+
+        if (num_text_results > depth_) {
+            // te_form_res_rels only sees the selection.
+            std::unordered_set<const char*,
+                               DocumentVocabulary::CStringHash,
+                               DocumentVocabulary::CStringEqual> docnos(num_text_results);
+
+            for (long result_idx = 0; result_idx < num_text_results; ++result_idx) {
+                if (!docnos.insert(text_results[result_idx].docno).second) {
+                    return false;
+                }
+            }
+
+            // Select the top-ranked documents and drop the remainder, such
+            // that trec_eval only sorts and joins the selection.
+            if (!ranked) {
+                std::nth_element(
+                    text_results, text_results + depth_, text_results + num_text_results,
+                    query_document_pair_compare);
+            }
+
+            num_text_results = depth_;
+            text_results_info->num_text_results = num_text_results;
+        }
+
+        if (!ranked) {
+            std::sort(
+                text_results, text_results + num_text_results,
+                query_document_pair_compare);
+        }
+
+        return true;
+    }
+
+    // Computes all measures of a ranked query into q_eval (see
+    // InitQueryEval); fused measures in a single pass (see ComputeFused),
+    // using fused_statistics as scratch, the others by trec_eval. Does not
+    // call into Python and may be called from several threads at once,
+    // each with its own buffers; the measures computed by trec_eval are
+    // serialized. On failure, returns false and stores the offending
+    // measure (its index in the plan) in failed_measure_idx.
+    bool Compute(const size_t eval_query_idx,
+                 RESULTS* const query,
+                 TREC_EVAL* const q_eval,
+                 std::vector<FusedStatistics>* const fused_statistics,
+                 size_t* const failed_measure_idx) const {
+        q_eval->qid = query->qid;
+
+        // Empty buffer; every measure only writes its own values.
+        for (int32 value_idx = 0; value_idx < q_eval->num_values; ++value_idx) {
+            q_eval->values[value_idx].value = 0;
+        }
+
+        // The cache is keyed by evaluator and query identifier, while the
+        // same query may be computed for several runs.
+        te_form_res_rels_cleanup();
+        form_res_rels.evaluator = evaluator_;
+
+        if (num_fused_ > 0) {
+            // Before trec_eval's measures, which may modify the relevance
+            // levels they receive.
+            RES_RELS res_rels;
+
+            if (te_form_res_rels(&evaluator_->epi_,
+                                 &evaluator_->all_rel_info_.rel_info[eval_query_idx],
+                                 query, &res_rels) == UNDEF) {
+                *failed_measure_idx = std::find_if(
+                    fused_measures_.begin(), fused_measures_.end(),
+                    [](const int fused_measure) { return fused_measure != kFusedNone; })
+                    - fused_measures_.begin();
+
+                return false;
+            }
+
+            ComputeFused((*evaluator_->judgments_)[eval_query_idx], res_rels,
+                         fused_statistics, q_eval);
+        }
+
+        std::unique_lock<std::mutex> lock(trec_eval_mutex, std::defer_lock);
+
+        for (size_t plan_idx = 0; plan_idx < plan_->size(); ++plan_idx) {
+            TREC_MEAS* const measure = &(*plan_)[plan_idx];
+
+            if (fused_measures_[plan_idx] != kFusedNone) {
+                continue;
+            }
+
+            if (!lock.owns_lock()) {
+                lock.lock();
+            }
+
+            // Compute measure.
+            if (measure->calc_meas(
+                    &evaluator_->epi_,
+                    &evaluator_->all_rel_info_.rel_info[eval_query_idx],
+                    query,
+                    measure,
+                    q_eval) == UNDEF) {
+                *failed_measure_idx = plan_idx;
+
+                return false;
+            }
+
+            CHECK_GE(measure->eval_index, 0);
+        }
+
+        return true;
+    }
+
+    // Computes the curves of a ranked query: for every measure in
+    // curve_measures, its value at every cutoff 1..num_ranks in a single
+    // pass over the ranking, stored consecutively in values. Values match
+    // those of the cutoff measures of trec_eval. Returns false on failure
+    // (e.g., duplicate documents).
+    bool ComputeCurves(const size_t eval_query_idx,
+                       RESULTS* const query,
+                       const std::vector<size_t>& curve_measures,
+                       const long num_ranks,
+                       double* const values) const {
+        te_form_res_rels_cleanup();
+        form_res_rels.evaluator = evaluator_;
+
+        RES_RELS res_rels;
+
+        if (te_form_res_rels(&evaluator_->epi_,
+                             &evaluator_->all_rel_info_.rel_info[eval_query_idx],
+                             query, &res_rels) == UNDEF) {
+            return false;
+        }
+
+        const long relevance_level = evaluator_->epi_.relevance_level;
+        const QueryJudgments& judgments = (*evaluator_->judgments_)[eval_query_idx];
+
+        long num_rel_ret = 0;
+        double precision_sum = 0.0;
+        double gain = 0.0;
+
+        for (long rank_idx = 0; rank_idx < num_ranks; ++rank_idx) {
+            if (rank_idx < res_rels.num_ret) {
+                const long rel = res_rels.results_rel_list[rank_idx];
+
+                if (rel >= relevance_level) {
+                    ++num_rel_ret;
+                    precision_sum += (double) num_rel_ret / (double) (rank_idx + 1);
+                }
+
+                if (rel > 0) {
+                    gain += (double) rel / log2((double) (rank_idx + 2));
+                }
+            }
+
+            const double ideal_gain = IdealGain(judgments, rank_idx + 1);
+
+            for (size_t idx = 0; idx < curve_measures.size(); ++idx) {
+                double value = 0.0;
+
+                switch (curve_measures[idx]) {
+                    case kCurveP:
+                        value = (double) num_rel_ret / (double) (rank_idx + 1);
+                        break;
+                    case kCurveRecall:
+                        value = res_rels.num_rel > 0 ? (double) num_rel_ret / (double) res_rels.num_rel : 0.0;
+                        break;
+                    case kCurveSuccess:
+                        value = num_rel_ret > 0 ? 1.0 : 0.0;
+                        break;
+                    case kCurveMapCut:
+                        value = res_rels.num_rel > 0 ? precision_sum / (double) res_rels.num_rel : 0.0;
+                        break;
+                    case kCurveNdcgCut:
+                        value = ideal_gain > 0.0 ? gain / ideal_gain : gain;
+                        break;
+                }
+
+                values[idx * num_ranks + rank_idx] = value;
+            }
+        }
+
+        return true;
+    }
+
+    void SetComputeError(const size_t plan_idx, const char* const qid) const {
+        // For example, because a document occurs twice in the ranking.
+        PyErr_Format(PyExc_ValueError,
+                     "Unable to compute %s for query '%s'.",
+                     (*plan_)[plan_idx].name, qid);
+    }
+
+    // Adds the measures computed into q_eval to the aggregates and, unless
+    // result is NULL, outputs them: as a row if the session collects rows
+    // (see CollectRows), and otherwise as a dictionary in result.
+    void Emit(const char* const qid, TREC_EVAL* const q_eval, PyObject* const result) {
+        Output(qid, q_eval, result);
+
+        for (size_t plan_idx = 0; plan_idx < plan_->size(); ++plan_idx) {
+            TREC_MEAS* const measure = &(*plan_)[plan_idx];
+
+            // Add the measure value to the aggregate.
+            measure->acc_meas(
+                &evaluator_->epi_,
+                measure,
+                q_eval,
+                &accum_eval_);
+
+            if (__DEVELOPMENT) {
+                // Print.
+                measure->print_single_meas(
+                    &evaluator_->epi_,
+                    measure,
+                    q_eval);
+            }
+        }
+
+        accum_eval_.num_queries++;
+    }
+
+    // Finalizes the aggregates of all emitted queries as trec_eval
+    // summarizes them (e.g., sums for num_ measures and geometric means for
+    // gm_ measures), and outputs them as Emit does under scope. Call once.
+    void EmitAggregates(const char* const scope, PyObject* const result) {
+        for (size_t plan_idx = 0; plan_idx < plan_->size(); ++plan_idx) {
+            TREC_MEAS* const measure = &(*plan_)[plan_idx];
+
+            measure->calc_avg_meas(
+                &evaluator_->epi_,
+                measure,
+                &evaluator_->all_rel_info_,
+                &accum_eval_);
+        }
+
+        Output(scope, &accum_eval_, result);
+    }
+
+    // Outputs the aggregates of the queries emitted so far as
+    // EmitAggregates does, without finalizing them; more queries can be
+    // emitted afterwards.
+    void EmitSnapshot(const char* const scope, PyObject* const result) const {
+        TREC_EVAL snapshot = accum_eval_;
+        snapshot.values = Malloc(accum_eval_.num_values, TREC_EVAL_VALUE);
+        CHECK_NOTNULL(snapshot.values);
+
+        memcpy(snapshot.values, accum_eval_.values,
+               accum_eval_.num_values * sizeof (TREC_EVAL_VALUE));
+
+        for (size_t plan_idx = 0; plan_idx < plan_->size(); ++plan_idx) {
+            TREC_MEAS* const measure = &(*plan_)[plan_idx];
+
+            measure->calc_avg_meas(
+                &evaluator_->epi_,
+                measure,
+                &evaluator_->all_rel_info_,
+                &snapshot);
+        }
+
+        Output(scope, &snapshot, result);
+
+        Free(snapshot.values);
+    }
+
+    // Discards the aggregates of all emitted queries.
+    void ResetAggregates() {
+        memcpy(accum_eval_.values, evaluator_->measure_values_.values,
+               accum_eval_.num_values * sizeof (TREC_EVAL_VALUE));
+
+        accum_eval_.num_queries = 0;
+    }
+
+    // Number of queries emitted since construction or ResetAggregates.
+    long num_queries() const {
+        return accum_eval_.num_queries;
+    }
+
+    // Makes Emit append the values of every query, in the order of
+    // ListValues, to rows and its identifier to the list qids.
+    void CollectRows(std::vector<double>* const rows, PyObject* const qids) {
+        rows_ = rows;
+        row_qids_ = qids;
+    }
+
+    // Returns a new list with the (interned) names of the values, in the
+    // order of ListValues.
+    PyObject* ValueNames() const {
+        PyObject* const names = PyList_New(value_names_.size());
+
+        for (size_t idx = 0; idx < value_names_.size(); ++idx) {
+            Py_INCREF(value_names_[idx].first);
+            PyList_SET_ITEM(names, idx, value_names_[idx].first);
+        }
+
+        return names;
+    }
+
+    // Lists the name and value index of every measure value, in the order
+    // in which Emit reports them.
+    void ListValues(std::vector<std::pair<const char*, int32> >* const values) const {
+        for (size_t plan_idx = 0; plan_idx < plan_->size(); ++plan_idx) {
+            const TREC_MEAS* const measure = &(*plan_)[plan_idx];
+
+            if (measure->print_single_meas == &te_print_single_meas_a_cut) {
+                for (int32 param_idx = 0;
+                     param_idx < measure->meas_params->num_params;
+                     ++param_idx) {
+                    const int32 value_idx = measure->eval_index + param_idx;
+
+                    values->push_back(std::make_pair(
+                        (const char*) accum_eval_.values[value_idx].name, value_idx));
+                }
+            } else {
+                values->push_back(std::make_pair(
+                    (const char*) measure->name, measure->eval_index));
+            }
+        }
+    }
+
+    // Prepares a per-query buffer with the value layout of the session;
+    // release using FreeQueryEval.
+    void InitQueryEval(TREC_EVAL* const q_eval) const {
+        q_eval->qid = NULL;
+        q_eval->values = Malloc(
+            accum_eval_.num_values, TREC_EVAL_VALUE);
+        CHECK_NOTNULL(q_eval->values);
+
+        memcpy(q_eval->values, accum_eval_.values,
+               accum_eval_.num_values * sizeof (TREC_EVAL_VALUE));
+
+        q_eval->num_values = accum_eval_.num_values;
+        q_eval->max_num_values = accum_eval_.num_values;
+        q_eval->num_queries = 0;
+    }
+
+    static void FreeQueryEval(TREC_EVAL* const q_eval) {
+        Free(q_eval->values);
+    }
+
+    int32 num_values() const {
+        return accum_eval_.num_values;
+    }
+
+ private:
+    RelevanceEvaluator* const evaluator_;
+    std::vector<TREC_MEAS>* const plan_;
+
+    // Number of top-ranked documents that gets evaluated.
+    const long depth_;
+
+    TREC_EVAL accum_eval_;
+    TREC_EVAL q_eval_;
+
+    // Names and value indices of the output values (see ListValues).
+    std::vector<std::pair<PyObject*, int32> > value_names_;
+
+    // Set by CollectRows (NULL otherwise).
+    std::vector<double>* rows_;
+    PyObject* row_qids_;
+
+    // For every measure of the plan, its FusedMeasure, or kFusedNone if
+    // trec_eval computes it (see InitFusedPlan).
+    std::vector<int> fused_measures_;
+    size_t num_fused_;
+
+    // Cutoffs of the fused measures, ascending and without duplicates.
+    std::vector<long> fused_cutoffs_;
+
+    // Scratch of ComputeFused for the queries of Evaluate; reused across
+    // queries.
+    std::vector<FusedStatistics> fused_statistics_;
+
+    // Determines which measures of the plan ComputeFused computes: those in
+    // kFusedMeasures, unless the evaluator disables fusing or they have
+    // parameters other than cutoffs (e.g., the gains of ndcg).
+    void InitFusedPlan() {
+        fused_measures_.assign(plan_->size(), kFusedNone);
+        num_fused_ = 0;
+
+        if (!evaluator_->fused_) {
+            return;
+        }
+
+        for (size_t plan_idx = 0; plan_idx < plan_->size(); ++plan_idx) {
+            const TREC_MEAS* const measure = &(*plan_)[plan_idx];
+
+            int fused_measure = 0;
+
+            while (kFusedMeasures[fused_measure] != NULL &&
+                   strcmp(measure->name, kFusedMeasures[fused_measure]) != 0) {
+                ++fused_measure;
+            }
+
+            if (kFusedMeasures[fused_measure] == NULL) {
+                continue;
+            }
+
+            const long num_params =
+                measure->meas_params != NULL ? measure->meas_params->num_params : 0;
+
+            if (fused_measure <= kFusedNdcgCut) {
+                if (num_params == 0) {
+                    continue;
+                }
+
+                const long* const cutoffs = (const long*) measure->meas_params->param_values;
+
+                fused_cutoffs_.insert(fused_cutoffs_.end(), cutoffs, cutoffs + num_params);
+            } else if (num_params > 0) {
+                continue;
+            }
+
+            fused_measures_[plan_idx] = fused_measure;
+            ++num_fused_;
+        }
+
+        std::sort(fused_cutoffs_.begin(), fused_cutoffs_.end());
+        fused_cutoffs_.erase(
+            std::unique(fused_cutoffs_.begin(), fused_cutoffs_.end()),
+            fused_cutoffs_.end());
+    }
+
+    // Computes the fused measures of a query from its matched ranking, in a
+    // single pass over the ranking that keeps the statistics of all
+    // measures, instead of a pass by trec_eval for every measure; the gains
+    // of the ideal ranking are those cached in judgments. Values are
+    // identical to those of trec_eval. fused_statistics receives the
+    // statistics at every cutoff.
+    void ComputeFused(const QueryJudgments& judgments,
+                      const RES_RELS& res_rels,
+                      std::vector<FusedStatistics>* const fused_statistics,
+                      TREC_EVAL* const q_eval) const {
+        const long relevance_level = evaluator_->epi_.relevance_level;
+        const size_t num_cutoffs = fused_cutoffs_.size();
+
+        fused_statistics->resize(num_cutoffs);
+
+        // Judged non-relevant documents, for bpref.
+        long num_nonrel = 0;
+
+        for (long rel = 0; rel < std::min(relevance_level, res_rels.num_rel_levels); ++rel) {
+            num_nonrel += res_rels.rel_levels[rel];
+        }
+
+        long num_rel_ret = 0;
+        long num_nonrel_ret = 0;
+        long first_rel_rank_idx = -1;
+        long rprec_num_rel_ret = -1;
+        double precision_sum = 0.0;
+        double gain = 0.0;
+        double bpref = 0.0;
+
+        size_t cutoff_idx = 0;
+
+        for (long rank_idx = 0; rank_idx <= res_rels.num_ret; ++rank_idx) {
+            // Statistics of the documents ranked before rank_idx; cutoffs
+            // beyond the ranking get those of the full ranking.
+            for (; cutoff_idx < num_cutoffs &&
+                   (fused_cutoffs_[cutoff_idx] == rank_idx || rank_idx == res_rels.num_ret);
+                 ++cutoff_idx) {
+                FusedStatistics* const statistics = &(*fused_statistics)[cutoff_idx];
+
+                statistics->num_rel_ret = num_rel_ret;
+                statistics->precision_sum = precision_sum;
+                statistics->gain = gain;
+                statistics->ideal_gain = IdealGain(judgments, fused_cutoffs_[cutoff_idx]);
+            }
+
+            if (rank_idx == res_rels.num_rel) {
+                rprec_num_rel_ret = num_rel_ret;
+            }
+
+            if (rank_idx == res_rels.num_ret) {
+                break;
+            }
+
+            const long rel = res_rels.results_rel_list[rank_idx];
+
+            if (rel >= relevance_level) {
+                ++num_rel_ret;
+                precision_sum += (double) num_rel_ret / (double) (rank_idx + 1);
+
+                if (first_rel_rank_idx < 0) {
+                    first_rel_rank_idx = rank_idx;
+                }
+
+                // Single precision, as in trec_eval.
+                bpref += num_nonrel_ret > 0
+                    ? 1.0 - ((float) std::min(num_nonrel_ret, res_rels.num_rel) /
+                             (float) std::min(num_nonrel, res_rels.num_rel))
+                    : 1.0;
+            } else if (rel >= 0) {
+                // Judged non-relevant; unjudged documents are skipped.
+                ++num_nonrel_ret;
+            }
+
+            if (rel > 0) {
+                gain += (double) rel / log2((double) (rank_idx + 2));
+            }
+        }
+
+        if (rprec_num_rel_ret < 0) {
+            rprec_num_rel_ret = num_rel_ret;
+        }
+
+        const double num_rel = (double) res_rels.num_rel;
+
+        for (size_t plan_idx = 0; plan_idx < plan_->size(); ++plan_idx) {
+            const int fused_measure = fused_measures_[plan_idx];
+
+            if (fused_measure == kFusedNone) {
+                continue;
+            }
+
+            const TREC_MEAS* const measure = &(*plan_)[plan_idx];
+            TREC_EVAL_VALUE* const values = &q_eval->values[measure->eval_index];
+
+            if (fused_measure <= kFusedNdcgCut) {
+                const long* const cutoffs = (const long*) measure->meas_params->param_values;
+
+                for (long param_idx = 0; param_idx < measure->meas_params->num_params; ++param_idx) {
+                    const FusedStatistics& statistics = (*fused_statistics)[
+                        std::lower_bound(fused_cutoffs_.begin(), fused_cutoffs_.end(),
+                                         cutoffs[param_idx]) - fused_cutoffs_.begin()];
+
+                    double value = 0.0;
+
+                    switch (fused_measure) {
+                        case kFusedP:
+                            value = (double) statistics.num_rel_ret / (double) cutoffs[param_idx];
+                            break;
+                        case kFusedRecall:
+                            value = num_rel > 0 ? (double) statistics.num_rel_ret / num_rel : 0.0;
+                            break;
+                        case kFusedSuccess:
+                            value = statistics.num_rel_ret > 0 ? 1.0 : 0.0;
+                            break;
+                        case kFusedMapCut:
+                            value = num_rel > 0 ? statistics.precision_sum / num_rel : 0.0;
+                            break;
+                        case kFusedNdcgCut:
+                            value = statistics.ideal_gain > 0.0
+                                ? statistics.gain / statistics.ideal_gain : statistics.gain;
+                            break;
+                    }
+
+                    values[param_idx].value = value;
+                }
+
+                continue;
+            }
+
+            double value = 0.0;
+
+            switch (fused_measure) {
+                case kFusedMap:
+                    value = num_rel > 0 ? precision_sum / num_rel : 0.0;
+                    break;
+                case kFusedNdcg: {
+                    const double ideal_gain = IdealGain(judgments, judgments.ideal_gains.size());
+
+                    value = ideal_gain > 0.0 ? gain / ideal_gain : 0.0;
+                    break;
+                }
+                case kFusedRprec:
+                    value = num_rel > 0 ? (double) rprec_num_rel_ret / num_rel : 0.0;
+                    break;
+                case kFusedRecipRank:
+                    value = first_rel_rank_idx >= 0 ? 1.0 / (double) (first_rel_rank_idx + 1) : 0.0;
+                    break;
+                case kFusedBpref:
+                    value = num_rel > 0 ? bpref / num_rel : 0.0;
+                    break;
+                case kFusedNumRet:
+                    value = (double) res_rels.num_ret;
+                    break;
+                case kFusedNumRel:
+                    value = num_rel;
+                    break;
+                case kFusedNumRelRet:
+                    value = (double) res_rels.num_rel_ret;
+                    break;
+                case kFusedSetP:
+                    value = res_rels.num_ret > 0
+                        ? (double) res_rels.num_rel_ret / (double) res_rels.num_ret : 0.0;
+                    break;
+                case kFusedSetRecall:
+                    value = num_rel > 0 ? (double) res_rels.num_rel_ret / num_rel : 0.0;
+                    break;
+            }
+
+            values[0].value = value;
+        }
+    }
+
+    void Output(const char* const qid, const TREC_EVAL* const values, PyObject* const result) const {
+        if (result == NULL) {
+            return;
+        }
+
+        if (rows_ != NULL) {
+            for (size_t idx = 0; idx < value_names_.size(); ++idx) {
+                rows_->push_back(values->values[value_names_[idx].second].value);
+            }
+
+            PyObject* const row_qid = PyUnicode_FromString(qid);
+            PyList_Append(row_qids_, row_qid);
+            Py_DECREF(row_qid);
+        } else {
+            PyObject* const measures = PyDict_New();
+
+            for (size_t idx = 0; idx < value_names_.size(); ++idx) {
+                PyObject* const value = PyFloat_FromDouble(
+                    values->values[value_names_[idx].second].value);
+
+                PyDict_SetItem(measures, value_names_[idx].first, value);
+                Py_DECREF(value);
+            }
+
+            PyDict_SetItemAndSteal(
+                result,
+                PyUnicode_FromString(qid),
+                measures);
+        }
+    }
+};
+
+// Ranks and computes the measures of all queries on num_threads native
+// threads (or the calling thread if num_threads is 1); must be called
+// without holding the GIL. Queries with a negative eval_query_idxs entry
+// are skipped. The values of query i are stored in
+// values[i * session->num_values(), ...). On failure, returns false and
+// stores the offending query and measure.
+static bool ComputeQueriesInParallel(const EvaluationSession* const session,
+                                     const std::vector<RESULTS*>& queries,
+                                     const std::vector<long>& eval_query_idxs,
+                                     const int num_threads,
+                                     std::vector<double>* const values,
+                                     size_t* const failed_query_idx,
+                                     size_t* const failed_measure_idx) {
+    const int32 num_values = session->num_values();
+    const size_t num_queries = queries.size();
+
+    std::atomic<size_t> next_query_idx(0);
+    std::atomic<bool> failed(false);
+
+    std::mutex failure_mutex;
+    *failed_query_idx = num_queries;
+
+    const auto worker = [&]() {
+            // Per-thread buffers.
+            TREC_EVAL q_eval;
+            session->InitQueryEval(&q_eval);
+
+            std::vector<FusedStatistics> fused_statistics;
+
+            size_t query_idx;
+            while (!failed && (query_idx = next_query_idx++) < num_queries) {
+                if (eval_query_idxs[query_idx] < 0) {
+                    continue;
+                }
+
+                size_t measure_idx = 0;
+
+                if (!session->Rank(queries[query_idx], false /* ranked */) ||
+                        !session->Compute(eval_query_idxs[query_idx], queries[query_idx],
+                                          &q_eval, &fused_statistics, &measure_idx)) {
+                    std::lock_guard<std::mutex> lock(failure_mutex);
+
+                    if (query_idx < *failed_query_idx) {
+                        *failed_query_idx = query_idx;
+                        *failed_measure_idx = measure_idx;
+                    }
+
+                    failed = true;
+
+                    break;
+                }
+
+                for (int32 value_idx = 0; value_idx < num_values; ++value_idx) {
+                    (*values)[query_idx * num_values + value_idx] = q_eval.values[value_idx].value;
+                }
+            }
+
+            EvaluationSession::FreeQueryEval(&q_eval);
+    };
+
+    if (num_threads <= 1) {
+        worker();
+    } else {
+        std::vector<std::thread> threads;
+
+        for (int thread_idx = 0; thread_idx < num_threads; ++thread_idx) {
+            threads.push_back(std::thread(worker));
+        }
+
+        for (size_t thread_idx = 0; thread_idx < threads.size(); ++thread_idx) {
+            threads[thread_idx].join();
+        }
+    }
+
+    return !failed;
+}
+
+// Scope of the aggregates in the result of evaluate, as in trec_eval.
+static const char* const kAggregateScope = "all";
+
+static PyObject* RelevanceEvaluator_evaluate(RelevanceEvaluator* self, PyObject* args, PyObject* kwds) {
+    PyObject* object_scores = NULL;
+    int num_threads = 1;
+
+    // Whether to add the aggregates to the result, and whether to include
+    // the measures of every query.
+    int aggregate = 0;
+    int per_query = 1;
+
+    // Whether to return a buffer of doubles with shape [queries, values],
+    // together with the query identifiers and measure names, instead of
+    // dictionaries. Aggregates form the last row.
+    int columnar = 0;
+
+    static char* kwlist[] = {"scores", "num_threads", "aggregate", "per_query", "columnar", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|ippp", kwlist,
+                                     &object_scores, &num_threads,
+                                     &aggregate, &per_query, &columnar) ||
+        !PyDict_Check(object_scores)) {
+        PyErr_SetString(
+            PyExc_TypeError,
+            "Argument object scores should be of type dictionary.");
+
+        return NULL;
+    }
+
+    if (num_threads < 1) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Argument num_threads should be positive.");
+
+        return NULL;
+    }
+
+    ResultRankingBuilder builder;
+
+    int64 num_queries = 0;
+    ResultRankingBuilder::QueryType* queries = NULL;
+
+    if (!builder(object_scores, num_queries, queries)) {
+        PyErr_SetString(
+            PyExc_TypeError,
+            "Unable to extract query/object scores.");
+
+        return NULL;
+    }
+
+    CHECK_NOTNULL(queries);
+
+    // Holds the result.
+    PyObject* result = PyDict_New();
+
+    // Holds the per-query measures (NULL if only aggregates are requested).
+    PyObject* const query_result = per_query ? result : NULL;
+
+    // Rows and their query identifiers, when columnar.
+    std::vector<double> rows;
+    PyObject* const row_qids = columnar ? PyList_New(0) : NULL;
+
+    PyObject* value_names = NULL;
+
+    {
+        EvaluationSession session(self);
+
+        if (columnar) {
+            session.CollectRows(&rows, row_qids);
+            value_names = session.ValueNames();
+        }
+
+        if (num_threads == 1 || num_queries <= 1) {
+            for (size_t query_idx = 0; query_idx < num_queries; ++query_idx) {
+                if (!session.Evaluate(&queries[query_idx], query_result)) {
+                    Py_DECREF(result);
+                    result = NULL;
+
+                    break;
+                }
+            }
+        } else {
+            // All Python objects have been converted; rank and compute
+            // without the GIL, and convert the values afterwards. Document
+            // identifiers are borrowed from the run, so keep them alive in
+            // case another thread modifies it meanwhile.
+            PyObject* const document_keys = PyList_New(0);
+
+            PyObject* key = NULL;
+            PyObject* value = NULL;
+
+            Py_ssize_t pos = 0;
+
+            while (PyDict_Next(object_scores, &pos, &key, &value)) {
+                PyObject* const keys = PyDict_Keys(value);
+
+                PyList_Append(document_keys, keys);
+                Py_DECREF(keys);
+            }
+
+            std::vector<RESULTS*> query_ptrs(num_queries);
+            std::vector<long> eval_query_idxs(num_queries);
+
+            for (size_t query_idx = 0; query_idx < num_queries; ++query_idx) {
+                query_ptrs[query_idx] = &queries[query_idx];
+                eval_query_idxs[query_idx] = session.FindQuery(queries[query_idx].qid);
+            }
+
+            const int32 num_values = session.num_values();
+            std::vector<double> values(num_queries * num_values);
+
+            size_t failed_query_idx = 0;
+            size_t failed_measure_idx = 0;
+            bool success = false;
+
+            Py_BEGIN_ALLOW_THREADS
+            success = ComputeQueriesInParallel(
+                &session, query_ptrs, eval_query_idxs,
+                (int) std::min((int64) num_threads, num_queries),
+                &values, &failed_query_idx, &failed_measure_idx);
+            Py_END_ALLOW_THREADS
+
+            if (success) {
+                TREC_EVAL q_eval;
+                session.InitQueryEval(&q_eval);
+
+                for (size_t query_idx = 0; query_idx < num_queries; ++query_idx) {
+                    if (eval_query_idxs[query_idx] < 0) {
+                        continue;
+                    }
+
+                    for (int32 value_idx = 0; value_idx < num_values; ++value_idx) {
+                        q_eval.values[value_idx].value = values[query_idx * num_values + value_idx];
+                    }
+
+                    session.Emit(queries[query_idx].qid, &q_eval, query_result);
+                }
+
+                EvaluationSession::FreeQueryEval(&q_eval);
+            } else {
+                session.SetComputeError(failed_measure_idx, queries[failed_query_idx].qid);
+
+                Py_DECREF(result);
+                result = NULL;
+            }
+
+            Py_DECREF(document_keys);
+        }
+
+        if (result != NULL && aggregate) {
+            PyObject* const scope = PyUnicode_FromString(kAggregateScope);
+
+            if (columnar ? PySequence_Contains(row_qids, scope) == 1
+                         : PyDict_Contains(result, scope) == 1) {
+                PyErr_Format(PyExc_ValueError,
+                             "Query identifier '%s' is reserved for the "
+                             "aggregates.", kAggregateScope);
+
+                Py_DECREF(result);
+                result = NULL;
+            } else {
+                session.EmitAggregates(kAggregateScope, result);
+            }
+
+            Py_DECREF(scope);
+        }
+    }
+
+    if (columnar) {
+        if (result != NULL) {
+            Py_DECREF(result);
+
+            result = Py_BuildValue(
+                "(NOO)",
+                PyByteArray_FromStringAndSize(
+                    rows.empty() ? NULL : (const char*) &rows[0],
+                    rows.size() * sizeof (double)),
+                row_qids, value_names);
+        }
+
+        Py_DECREF(row_qids);
+        Py_DECREF(value_names);
+    }
+
+    // Clean.
+    builder.cleanup(num_queries, queries);
+
+    return result;
+}
+
+// The queries of a single run of evaluate_many, converted while holding the
+// GIL. A run is either a dictionary as accepted by evaluate, or a tuple of
+// (qids, docids, scores[, offsets]) arrays as accepted by evaluate_arrays.
+class PreparedRun {
+ public:
+    PreparedRun() : num_queries_(0), queries_(NULL), document_keys_(NULL) {}
+
+    ~PreparedRun() {
+        if (queries_ != NULL) {
+            builder_.cleanup(num_queries_, queries_);
+        }
+
+        Py_XDECREF(document_keys_);
+    }
+
+    bool Prepare(PyObject* const run) {
+        if (PyDict_Check(run)) {
+            return PrepareDict(run);
+        } else if (PyTuple_Check(run) &&
+                   (PyTuple_Size(run) == 3 || PyTuple_Size(run) == 4)) {
+            return PrepareArrays(run);
+        }
+
+        PyErr_SetString(PyExc_TypeError,
+                        "Expected every run to be a dictionary or a tuple of "
+                        "qids, docids, scores and optionally offsets.");
+
+        return false;
+    }
+
+    // Appends the queries of the run to queries.
+    void AppendQueries(std::vector<RESULTS*>* const queries) {
+        if (queries_ != NULL) {
+            for (int64 query_idx = 0; query_idx < num_queries_; ++query_idx) {
+                queries->push_back(&queries_[query_idx]);
+            }
+        }
+
+        for (size_t query_idx = 0; query_idx < array_queries_.size(); ++query_idx) {
+            queries->push_back(&array_queries_[query_idx]);
+        }
+    }
+
+ private:
+    bool PrepareDict(PyObject* const run) {
+        int64 num_queries = 0;
+        RESULTS* queries = NULL;
+
+        if (!builder_(run, num_queries, queries)) {
+            return false;
+        }
+
+        num_queries_ = num_queries;
+        queries_ = queries;
+
+        // Document identifiers are borrowed from the run; keep them alive
+        // while the GIL is released.
+        document_keys_ = PyList_New(0);
+
+        PyObject* key = NULL;
+        PyObject* value = NULL;
+
+        Py_ssize_t pos = 0;
+
+        while (PyDict_Next(run, &pos, &key, &value)) {
+            PyObject* const keys = PyDict_Keys(value);
+
+            PyList_Append(document_keys_, keys);
+            Py_DECREF(keys);
+        }
+
+        return true;
+    }
+
+    bool PrepareArrays(PyObject* const run) {
+        PyObject* const offsets_obj =
+            PyTuple_Size(run) == 4 ? PyTuple_GET_ITEM(run, 3) : Py_None;
+
+        ArrayView qids, docids, scores, offsets;
+
+        if (!qids.Acquire(PyTuple_GET_ITEM(run, 0), "qids", true /* integral */) ||
+                !docids.Acquire(PyTuple_GET_ITEM(run, 1), "docids", true /* integral */) ||
+                !scores.Acquire(PyTuple_GET_ITEM(run, 2), "scores", false /* integral */) ||
+                (offsets_obj != Py_None &&
+                 !offsets.Acquire(offsets_obj, "offsets", true /* integral */))) {
+            return false;
+        }
+
+        if (docids.size() != scores.size()) {
+            PyErr_SetString(PyExc_ValueError,
+                            "Arguments docids and scores should be of equal length.");
+
+            return false;
+        }
+
+        std::vector<int64> segment_qids;
+        std::vector<Py_ssize_t> segment_offsets;
+
+        if (!ComputeSegments(qids, offsets_obj != Py_None ? &offsets : NULL,
+                             docids.size(), true /* unique_qids */,
+                             &segment_qids, &segment_offsets)) {
+            return false;
+        }
+
+        const size_t num_segments = segment_qids.size();
+
+        // Identifiers are stored as offsets into strings_ until the block
+        // no longer grows. Every query is followed by a sentinel.
+        std::vector<size_t> qid_offsets(num_segments);
+        std::vector<size_t> docno_offsets(docids.size());
+
+        text_results_.resize(docids.size() + num_segments);
+
+        for (size_t segment_idx = 0; segment_idx < num_segments; ++segment_idx) {
+            qid_offsets[segment_idx] = strings_.size();
+            AppendIdentifier(segment_qids[segment_idx], &strings_);
+
+            for (Py_ssize_t idx = segment_offsets[segment_idx];
+                 idx < segment_offsets[segment_idx + 1]; ++idx) {
+                docno_offsets[idx] = strings_.size();
+                AppendIdentifier(docids.AsInt(idx), &strings_);
+
+                text_results_[idx + segment_idx].sim = (float) scores.AsDouble(idx);
+            }
+
+            text_results_[segment_offsets[segment_idx + 1] + segment_idx].docno = NULL;
+            text_results_[segment_offsets[segment_idx + 1] + segment_idx].sim = 0.0;
+        }
+
+        text_results_info_.resize(num_segments);
+        array_queries_.resize(num_segments);
+
+        for (size_t segment_idx = 0; segment_idx < num_segments; ++segment_idx) {
+            for (Py_ssize_t idx = segment_offsets[segment_idx];
+                 idx < segment_offsets[segment_idx + 1]; ++idx) {
+                text_results_[idx + segment_idx].docno = &strings_[docno_offsets[idx]];
+            }
+
+            TEXT_RESULTS_INFO* const text_results_info = &text_results_info_[segment_idx];
+
+            text_results_info->num_text_results =
+                segment_offsets[segment_idx + 1] - segment_offsets[segment_idx];
+            text_results_info->max_num_text_results = text_results_info->num_text_results;
+            text_results_info->text_results =
+                &text_results_[segment_offsets[segment_idx] + segment_idx];
+
+            RESULTS* const query = &array_queries_[segment_idx];
+
+            query->qid = &strings_[qid_offsets[segment_idx]];
+            query->run_id = "my_little_test_run";
+            query->ret_format = "trec_results";
+            query->q_results = text_results_info;
+        }
+
+        return true;
+    }
+
+    // Dictionary runs.
+    ResultRankingBuilder builder_;
+    int64 num_queries_;
+    RESULTS* queries_;
+    PyObject* document_keys_;
+
+    // Array runs.
+    std::vector<char> strings_;
+    std::vector<TEXT_RESULTS> text_results_;
+    std::vector<TEXT_RESULTS_INFO> text_results_info_;
+    std::vector<RESULTS> array_queries_;
+};
+
+// Evaluates several runs against the same judgments, and returns a tuple
+// of a buffer of doubles with shape [runs, queries, values], the query
+// identifiers and the measure names. Queries follow the order of the
+// judgments; queries that a run does not rank are NaN.
+static PyObject* RelevanceEvaluator_evaluate_many(RelevanceEvaluator* self, PyObject* args, PyObject* kwds) {
+    PyObject* runs_obj = NULL;
+    int num_threads = 1;
+
+    static char* kwlist[] = {"runs", "num_threads", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|i", kwlist,
+                                     &runs_obj, &num_threads)) {
+        return NULL;
+    }
+
+    if (num_threads < 1) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Argument num_threads should be positive.");
+
+        return NULL;
+    }
+
+    // Holds a reference to every run.
+    PyObject* const runs = PySequence_Fast(runs_obj, "Argument runs should be a sequence.");
+
+    if (runs == NULL) {
+        return NULL;
+    }
+
+    const Py_ssize_t num_runs = PySequence_Fast_GET_SIZE(runs);
+
+    std::vector<PreparedRun> prepared_runs(num_runs);
+
+    // Flattened (run, query) pairs.
+    std::vector<RESULTS*> queries;
+    std::vector<size_t> run_idxs;
+
+    for (Py_ssize_t run_idx = 0; run_idx < num_runs; ++run_idx) {
+        if (!prepared_runs[run_idx].Prepare(PySequence_Fast_GET_ITEM(runs, run_idx))) {
+            Py_DECREF(runs);
+
+            return NULL;
+        }
+
+        prepared_runs[run_idx].AppendQueries(&queries);
+        run_idxs.resize(queries.size(), run_idx);
+    }
+
+    const size_t num_eval_queries = self->all_rel_info_.num_q_rels;
+
+    PyObject* result = NULL;
+
+    {
+        EvaluationSession session(self);
+
+        std::vector<std::pair<const char*, int32> > value_names;
+        session.ListValues(&value_names);
+
+        const size_t num_columns = value_names.size();
+
+        std::vector<long> eval_query_idxs(queries.size());
+
+        for (size_t query_idx = 0; query_idx < queries.size(); ++query_idx) {
+            eval_query_idxs[query_idx] = session.FindQuery(queries[query_idx]->qid);
+        }
+
+        const int32 num_values = session.num_values();
+        std::vector<double> values(queries.size() * num_values);
+
+        size_t failed_query_idx = 0;
+        size_t failed_measure_idx = 0;
+        bool success = false;
+
+        Py_BEGIN_ALLOW_THREADS
+        success = ComputeQueriesInParallel(
+            &session, queries, eval_query_idxs,
+            (int) std::max((size_t) 1, std::min((size_t) num_threads, queries.size())),
+            &values, &failed_query_idx, &failed_measure_idx);
+        Py_END_ALLOW_THREADS
+
+        if (success) {
+            PyObject* const tensor = PyByteArray_FromStringAndSize(
+                NULL, num_runs * num_eval_queries * num_columns * sizeof (double));
+
+            double* const tensor_values = (double*) PyByteArray_AsString(tensor);
+
+            std::fill(tensor_values,
+                      tensor_values + num_runs * num_eval_queries * num_columns,
+                      std::numeric_limits<double>::quiet_NaN());
+
+            for (size_t query_idx = 0; query_idx < queries.size(); ++query_idx) {
+                if (eval_query_idxs[query_idx] < 0) {
+                    continue;
+                }
+
+                double* const row = tensor_values +
+                    (run_idxs[query_idx] * num_eval_queries +
+                     eval_query_idxs[query_idx]) * num_columns;
+
+                for (size_t column_idx = 0; column_idx < num_columns; ++column_idx) {
+                    row[column_idx] = values[query_idx * num_values +
+                                             value_names[column_idx].second];
+                }
+            }
+
+            PyObject* const qids = PyList_New(num_eval_queries);
+
+            for (size_t eval_query_idx = 0; eval_query_idx < num_eval_queries; ++eval_query_idx) {
+                PyList_SET_ITEM(qids, eval_query_idx, PyUnicode_FromString(
+                    self->all_rel_info_.rel_info[eval_query_idx].qid));
+            }
+
+            PyObject* const measure_names = PyList_New(num_columns);
+
+            for (size_t column_idx = 0; column_idx < num_columns; ++column_idx) {
+                PyList_SET_ITEM(measure_names, column_idx,
+                                PyUnicode_FromString(value_names[column_idx].first));
+            }
+
+            result = Py_BuildValue("(NNN)", tensor, qids, measure_names);
+        } else {
+            session.SetComputeError(failed_measure_idx, queries[failed_query_idx]->qid);
+        }
+    }
+
+    Py_DECREF(runs);
+
+    return result;
+}
+
+// Evaluates a single query given its results, in any order unless ranked.
+// The results are sorted in place.
+static bool EvaluateTextResults(EvaluationSession* const session,
+                                const char* const qid,
+                                std::vector<TEXT_RESULTS>* const text_results,
+                                PyObject* const result,
+                                const bool ranked = false) {
+    const size_t num_results = text_results->size();
+
+    // Sentinel; this also guarantees a valid array for empty rankings.
+    TEXT_RESULTS sentinel;
+    sentinel.docno = NULL;
+    sentinel.sim = 0.0;
+
+    text_results->push_back(sentinel);
+
+    TEXT_RESULTS_INFO text_results_info;
+    text_results_info.num_text_results = num_results;
+    text_results_info.max_num_text_results = num_results;
+    text_results_info.text_results = &(*text_results)[0];
+
+    RESULTS query;
+    query.qid = (char*) qid;
+    query.run_id = "my_little_test_run";
+    query.ret_format = "trec_results";
+    query.q_results = &text_results_info;
+
+    const bool success = session->Evaluate(&query, result, ranked);
+
+    text_results->pop_back();
+
+    return success;
+}
+
+// Evaluates a single query whose document identifiers are stored, NUL
+// separated, in docnos; sims holds (offset in docnos, score) pairs.
+static bool EvaluateQueryBuffer(EvaluationSession* const session,
+                                const char* const qid,
+                                const std::vector<char>& docnos,
+                                const std::vector<std::pair<size_t, float> >& sims,
+                                PyObject* const result) {
+    const char* const docnos_begin = docnos.empty() ? NULL : &docnos[0];
+
+    std::vector<TEXT_RESULTS> text_results(sims.size());
+
+    for (size_t pair_idx = 0; pair_idx < sims.size(); ++pair_idx) {
+        text_results[pair_idx].docno = (char*) docnos_begin + sims[pair_idx].first;
+        text_results[pair_idx].sim = sims[pair_idx].second;
+    }
+
+    return EvaluateTextResults(session, qid, &text_results, result);
+}
+
+// Accumulates the lines of a TREC run, grouped by query, and evaluates every
+// query as soon as all of its lines have been seen. When the lines are
+// sorted by query, only a single query is kept in memory at any time.
+class RunStreamEvaluator {
+ public:
+    RunStreamEvaluator(RelevanceEvaluator* const evaluator,
+                       const bool sorted_by_query,
+                       PyObject* const result)
+        : session_(evaluator), sorted_by_query_(sorted_by_query),
+          result_(result), current_query_(NULL) {}
+
+    ~RunStreamEvaluator() {
+        for (std::map<std::string, QueryBuffer*>::iterator it = queries_.begin();
+             it != queries_.end(); ++it) {
+            delete it->second;
+        }
+    }
+
+    // Adds a NUL-terminated line; source and line_number are used for error
+    // messages. Returns false and sets a Python exception on failure.
+    bool AddLine(char* const line, const char* const source, const size_t line_number) {
+        char* fields[RUN_NUM_FIELDS];
+
+        const size_t num_fields = SplitFields(line, fields, RUN_NUM_FIELDS);
+
+        if (num_fields == 0) {
+            return true;  // Skip blank lines.
+        }
+
+        double score = 0.0;
+
+        if (num_fields != RUN_NUM_FIELDS) {
+            PyErr_Format(PyExc_ValueError,
+                         "%s:%zu: expected %d fields.",
+                         source, line_number, RUN_NUM_FIELDS);
+
+            return false;
+        } else if (!ParseDouble(fields[RUN_SIM_FIELD], &score)) {
+            PyErr_Format(PyExc_ValueError,
+                         "%s:%zu: unable to parse score '%s'.",
+                         source, line_number, fields[RUN_SIM_FIELD]);
+
+            return false;
+        }
+
+        if (current_query_ == NULL || current_qid_.compare(fields[RUN_QID_FIELD]) != 0) {
+            if (sorted_by_query_ && current_query_ != NULL) {
+                // Query complete; evaluate and release it.
+                if (!Flush(current_qid_)) {
+                    return false;
+                }
+            }
+
+            current_qid_ = fields[RUN_QID_FIELD];
+
+            std::map<std::string, QueryBuffer*>::iterator it = queries_.find(current_qid_);
+
+            if (it == queries_.end()) {
+                current_query_ = new QueryBuffer;
+                queries_.insert(std::make_pair(current_qid_, current_query_));
+                query_order_.push_back(current_qid_);
+            } else if (sorted_by_query_) {
+                PyErr_Format(PyExc_ValueError,
+                             "%s:%zu: query '%s' occurs in multiple "
+                             "non-consecutive blocks; the run is not sorted "
+                             "by query.",
+                             source, line_number, fields[RUN_QID_FIELD]);
+
+                return false;
+            } else {
+                current_query_ = it->second;
+            }
+        }
+
+        const char* const docno = fields[RUN_DOCNO_FIELD];
+
+        current_query_->sims.push_back(
+            std::make_pair(current_query_->docnos.size(), (float) score));
+        current_query_->docnos.insert(
+            current_query_->docnos.end(), docno, docno + strlen(docno) + 1);
+
+        return true;
+    }
+
+    // Evaluates all remaining queries, in the order in which they first
+    // occurred.
+    bool Finish() {
+        for (size_t query_idx = 0; query_idx < query_order_.size(); ++query_idx) {
+            if (!Flush(query_order_[query_idx])) {
+                return false;
+            }
+        }
+
+        return true;
+    }
+
+ private:
+    // Document identifiers (NUL-separated) and (offset, score) pairs.
+    struct QueryBuffer {
+        std::vector<char> docnos;
+        std::vector<std::pair<size_t, float> > sims;
+        bool flushed;
+
+        QueryBuffer() : flushed(false) {}
+    };
+
+    bool Flush(const std::string& qid) {
+        QueryBuffer* const buffer = queries_[qid];
+
+        if (buffer->flushed) {
+            return true;
+        }
+
+        const bool success = EvaluateQueryBuffer(
+            &session_, qid.c_str(), buffer->docnos, buffer->sims, result_);
+
+        // Release the memory held by the query, but remember that it was
+        // seen such that a repeated occurrence can be detected.
+        std::vector<char>().swap(buffer->docnos);
+        std::vector<std::pair<size_t, float> >().swap(buffer->sims);
+        buffer->flushed = true;
+
+        return success;
+    }
+
+    EvaluationSession session_;
+
+    const bool sorted_by_query_;
+    PyObject* const result_;
+
+    std::map<std::string, QueryBuffer*> queries_;
+
+    // Query identifiers in the order in which they first occurred.
+    std::vector<std::string> query_order_;
+
+    std::string current_qid_;
+    QueryBuffer* current_query_;
+};
+
+static PyObject* RelevanceEvaluator_evaluate_file(RelevanceEvaluator* self, PyObject* args, PyObject* kwds) {
+    PyObject* path = NULL;
+    int sorted_by_query = 1;
+
+    static char* kwlist[] = {"path", "sorted_by_query", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(
+            args, kwds, "O&|p", kwlist,
+            PyUnicode_FSConverter, &path,
+            &sorted_by_query)) {
+        return NULL;
+    }
+
+    const char* const path_str = PyBytes_AsString(path);
+
+    FILE* const f = fopen(path_str, "rb");
+    if (f == NULL) {
+        PyErr_SetFromErrnoWithFilename(PyExc_OSError, path_str);
+        Py_DECREF(path);
+
+        return NULL;
+    }
+
+    PyObject* result = PyDict_New();
+
+    {
+        RunStreamEvaluator stream(self, sorted_by_query, result);
+        LineReader reader(f);
+
+        char* line = NULL;
+        size_t length = 0;
+
+        bool success = true;
+
+        while (success && reader.Next(&line, &length)) {
+            success = stream.AddLine(line, path_str, reader.line_number());
+        }
+
+        if (success && reader.error()) {
+            PyErr_SetFromErrnoWithFilename(PyExc_OSError, path_str);
+
+            success = false;
+        }
+
+        if (success) {
+            success = stream.Finish();
+        }
+
+        if (!success) {
+            Py_DECREF(result);
+            result = NULL;
+        }
+    }
+
+    fclose(f);
+    Py_DECREF(path);
+
+    return result;
+}
+
+static PyObject* RelevanceEvaluator_evaluate_stream(RelevanceEvaluator* self, PyObject* args, PyObject* kwds) {
+    PyObject* lines = NULL;
+    int sorted_by_query = 1;
+
+    static char* kwlist[] = {"lines", "sorted_by_query", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(
+            args, kwds, "O|p", kwlist,
+            &lines,
+            &sorted_by_query)) {
+        return NULL;
+    }
+
+    PyObject* const lines_iter = PyObject_GetIter(lines);
+    if (lines_iter == NULL) {
+        return NULL;
+    }
+
+    PyObject* result = PyDict_New();
+
+    {
+        RunStreamEvaluator stream(self, sorted_by_query, result);
+
+        std::vector<char> line_buffer;
+        size_t line_number = 0;
+
+        bool success = true;
+
+        PyObject* line = NULL;
+        while (success && (line = PyIter_Next(lines_iter))) {
+            ++line_number;
+
+            const char* data = NULL;
+            Py_ssize_t length = 0;
+
+            if (PyUnicode_Check(line)) {
+                data = PyUnicode_AsUTF8AndSize(line, &length);
+            } else if (PyBytes_Check(line)) {
+                data = PyBytes_AS_STRING(line);
+                length = PyBytes_GET_SIZE(line);
+            } else {
+                PyErr_SetString(PyExc_TypeError, "Expected lines to be str or bytes.");
+            }
+
+            if (data != NULL) {
+                // Copy, as fields get terminated in place.
+                line_buffer.assign(data, data + length);
+                line_buffer.push_back('\0');
+
+                success = stream.AddLine(&line_buffer[0], "<stream>", line_number);
+            } else {
+                success = false;
+            }
+
+            Py_DECREF(line);
+        }
+
+        if (success && PyErr_Occurred()) {
+            success = false;  // Raised by the iterator.
         }
-        Py_DECREF(meas);
+
+        if (success) {
+            success = stream.Finish();
+        }
+
+        if (!success) {
+            Py_DECREF(result);
+            result = NULL;
+        }
+    }
+
+    Py_DECREF(lines_iter);
+
+    return result;
+}
+
+static PyObject* RelevanceEvaluator_evaluate_arrays(RelevanceEvaluator* self, PyObject* args, PyObject* kwds) {
+    PyObject* qids_obj = NULL;
+    PyObject* docids_obj = NULL;
+    PyObject* scores_obj = NULL;
+    PyObject* offsets_obj = Py_None;
+    int interned = 0;
+
+    static char* kwlist[] = {"qids", "docids", "scores", "offsets", "interned", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(
+            args, kwds, "OOO|Op", kwlist,
+            &qids_obj, &docids_obj, &scores_obj, &offsets_obj, &interned)) {
+        return NULL;
+    }
+
+    ArrayView qids, docids, scores, offsets;
+
+    if (!qids.Acquire(qids_obj, "qids", true /* integral */) ||
+            !docids.Acquire(docids_obj, "docids", true /* integral */) ||
+            !scores.Acquire(scores_obj, "scores", false /* integral */) ||
+            (offsets_obj != Py_None &&
+             !offsets.Acquire(offsets_obj, "offsets", true /* integral */))) {
+        return NULL;
+    }
+
+    if (docids.size() != scores.size()) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Arguments docids and scores should be of equal length.");
+
+        return NULL;
+    }
+
+    if (interned) {
+        const int64 num_documents = self->documents_->size();
+
+        for (Py_ssize_t idx = 0; idx < docids.size(); ++idx) {
+            const int64 docid = docids.AsInt(idx);
+
+            if (docid < 0 || docid >= num_documents) {
+                PyErr_Format(PyExc_ValueError,
+                             "Document identifier %lld at position %zd is "
+                             "not an interned identifier.",
+                             (long long) docid, idx);
+
+                return NULL;
+            }
+        }
+    }
+
+    std::vector<int64> segment_qids;
+    std::vector<Py_ssize_t> segment_offsets;
+
+    if (!ComputeSegments(qids, offsets_obj != Py_None ? &offsets : NULL,
+                         docids.size(), true /* unique_qids */,
+                         &segment_qids, &segment_offsets)) {
+        return NULL;
+    }
+
+    PyObject* result = PyDict_New();
+
+    {
+        EvaluationSession session(self);
+
+        // Buffers for a single query, reused across queries.
+        std::vector<char> qid, docnos;
+        std::vector<std::pair<size_t, float> > sims;
+        std::vector<TEXT_RESULTS> text_results;
+
+        for (size_t segment_idx = 0; segment_idx < segment_qids.size(); ++segment_idx) {
+            qid.clear();
+            AppendIdentifier(segment_qids[segment_idx], &qid);
+
+            bool success = true;
+
+            if (interned) {
+                // Interned identifiers resolve to the stored strings directly.
+                text_results.resize(segment_offsets[segment_idx + 1] - segment_offsets[segment_idx]);
+
+                for (Py_ssize_t idx = segment_offsets[segment_idx];
+                     idx < segment_offsets[segment_idx + 1]; ++idx) {
+                    TEXT_RESULTS* const text_result =
+                        &text_results[idx - segment_offsets[segment_idx]];
+
+                    text_result->docno = self->documents_->Get(docids.AsInt(idx));
+                    text_result->sim = (float) scores.AsDouble(idx);
+                }
+
+                success = EvaluateTextResults(&session, &qid[0], &text_results, result);
+            } else {
+                docnos.clear();
+                sims.clear();
+
+                for (Py_ssize_t idx = segment_offsets[segment_idx];
+                     idx < segment_offsets[segment_idx + 1]; ++idx) {
+                    sims.push_back(std::make_pair(docnos.size(), (float) scores.AsDouble(idx)));
+                    AppendIdentifier(docids.AsInt(idx), &docnos);
+                }
+
+                success = EvaluateQueryBuffer(&session, &qid[0], docnos, sims, result);
+            }
+
+            if (!success) {
+                Py_DECREF(result);
+                result = NULL;
+
+                break;
+            }
+        }
+    }
+
+    return result;
+}
+
+// Largest ranking for which every rank maps to a distinct float score.
+#define MAX_RANKING_LENGTH (1L << 24)
+
+// Collects a ranking given as an ordered sequence of document identifiers,
+// or as an array of interned identifiers, into text_results. Scores are
+// strictly decreasing, such that trec_eval keeps the given order. Stores a
+// reference that keeps the document identifiers alive until evaluated (or
+// NULL) in sequence. Returns false and sets a Python exception on failure.
+static bool CollectRanking(RelevanceEvaluator* const self,
+                           PyObject* const ranking,
+                           std::vector<TEXT_RESULTS>* const text_results,
+                           PyObject** const sequence) {
+    text_results->clear();
+    *sequence = NULL;
+
+    if (PyObject_CheckBuffer(ranking)) {
+        // Array of interned identifiers.
+        ArrayView docids;
+
+        if (!docids.Acquire(ranking, "ranking", true /* integral */)) {
+            return false;
+        }
+
+        for (Py_ssize_t idx = 0; idx < docids.size(); ++idx) {
+            const int64 docid = docids.AsInt(idx);
+
+            if (docid < 0 || docid >= self->documents_->size()) {
+                PyErr_Format(PyExc_ValueError,
+                             "Document identifier %lld at position "
+                             "%zd is not an interned identifier.",
+                             (long long) docid, idx);
+
+                return false;
+            }
+
+            TEXT_RESULTS text_result;
+            text_result.docno = self->documents_->Get(docid);
+
+            text_results->push_back(text_result);
+        }
+    } else {
+        *sequence = PySequence_Fast(
+            ranking, "Expected rankings to be sequences of document identifiers.");
+
+        if (*sequence == NULL) {
+            return false;
+        }
+
+        for (Py_ssize_t idx = 0; idx < PySequence_Fast_GET_SIZE(*sequence); ++idx) {
+            PyObject* const docno = PySequence_Fast_GET_ITEM(*sequence, idx);
+
+            if (!PyUnicode_Check(docno)) {
+                PyErr_SetString(PyExc_TypeError, "Expected document identifiers to be str.");
+
+                return false;
+            }
+
+            TEXT_RESULTS text_result;
+            text_result.docno = (char*) PyUnicode_AsUTF8(docno);
+
+            text_results->push_back(text_result);
+        }
+    }
+
+    if (text_results->size() > (size_t) MAX_RANKING_LENGTH) {
+        PyErr_Format(PyExc_ValueError,
+                     "Rankings should hold at most %ld documents.",
+                     MAX_RANKING_LENGTH);
+
+        return false;
+    }
+
+    for (size_t rank = 0; rank < text_results->size(); ++rank) {
+        (*text_results)[rank].sim = (float) (text_results->size() - rank);
+    }
+
+    return true;
+}
+
+static PyObject* RelevanceEvaluator_evaluate_ranked(RelevanceEvaluator* self, PyObject* args) {
+    PyObject* rankings = NULL;
+
+    if (!PyArg_ParseTuple(args, "O", &rankings) ||
+        !PyDict_Check(rankings)) {
+        PyErr_SetString(
+            PyExc_TypeError,
+            "Argument rankings should be of type dictionary.");
+
+        return NULL;
+    }
+
+    PyObject* result = PyDict_New();
+
+    {
+        EvaluationSession session(self);
+
+        std::vector<TEXT_RESULTS> text_results;
+
+        PyObject* key = NULL;
+        PyObject* value = NULL;
+
+        Py_ssize_t pos = 0;
+
+        while (PyDict_Next(rankings, &pos, &key, &value)) {
+            if (!PyUnicode_Check(key)) {
+                PyErr_SetString(PyExc_TypeError, "Expected string as key.");
+
+                break;
+            }
+
+            // Keeps the document identifiers alive until evaluated.
+            PyObject* sequence = NULL;
+
+            if (CollectRanking(self, value, &text_results, &sequence)) {
+                EvaluateTextResults(&session, PyUnicode_AsUTF8(key),
+                                    &text_results, result, true /* ranked */);
+            }
+
+            Py_XDECREF(sequence);
+
+            if (PyErr_Occurred()) {
+                break;
+            }
+        }
+    }
+
+    if (PyErr_Occurred()) {
+        Py_DECREF(result);
+
+        return NULL;
+    }
+
+    return result;
+}
+
+// Evaluates a run at every cutoff 1..depth for the given cutoff measures.
+// Returns a tuple of a buffer of doubles with shape [queries, measures,
+// depth] and the identifiers of the evaluated queries.
+static PyObject* RelevanceEvaluator_evaluate_curves(RelevanceEvaluator* self, PyObject* args, PyObject* kwds) {
+    PyObject* object_scores = NULL;
+    PyObject* measures_obj = NULL;
+    long depth = 0;
+
+    static char* kwlist[] = {"scores", "measures", "depth", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!Ol", kwlist,
+                                     &PyDict_Type, &object_scores,
+                                     &measures_obj, &depth)) {
+        return NULL;
+    }
+
+    if (depth < 1 || depth > MAX_RANKING_LENGTH) {
+        PyErr_Format(PyExc_ValueError,
+                     "Argument depth should be between 1 and %ld.",
+                     MAX_RANKING_LENGTH);
+
+        return NULL;
+    }
+
+    PyObject* const measures = PySequence_Fast(
+        measures_obj, "Argument measures should be a sequence.");
+
+    if (measures == NULL) {
+        return NULL;
+    }
+
+    std::vector<size_t> curve_measures;
+
+    for (Py_ssize_t idx = 0; idx < PySequence_Fast_GET_SIZE(measures); ++idx) {
+        PyObject* const measure = PySequence_Fast_GET_ITEM(measures, idx);
+        const char* const name = PyUnicode_Check(measure) ? PyUnicode_AsUTF8(measure) : NULL;
+
+        size_t curve_measure = 0;
+
+        while (kCurveMeasures[curve_measure] != NULL &&
+               (name == NULL || strcmp(name, kCurveMeasures[curve_measure]) != 0)) {
+            ++curve_measure;
+        }
+
+        if (kCurveMeasures[curve_measure] == NULL) {
+            PyErr_Format(PyExc_ValueError,
+                         "Unsupported curve measure %R; expected one of P, "
+                         "recall, success, map_cut and ndcg_cut.", measure);
+
+            Py_DECREF(measures);
+
+            return NULL;
+        }
+
+        curve_measures.push_back(curve_measure);
+    }
+
+    Py_DECREF(measures);
+
+    ResultRankingBuilder builder;
+
+    int64 num_queries = 0;
+    ResultRankingBuilder::QueryType* queries = NULL;
+
+    if (!builder(object_scores, num_queries, queries)) {
+        PyErr_SetString(
+            PyExc_TypeError,
+            "Unable to extract query/object scores.");
+
+        return NULL;
+    }
+
+    const size_t num_values = curve_measures.size() * depth;
+
+    std::vector<double> values;
+    PyObject* const qids = PyList_New(0);
+
+    bool success = true;
+
+    {
+        EvaluationSession session(self, depth);
+
+        for (int64 query_idx = 0; query_idx < num_queries; ++query_idx) {
+            const long eval_query_idx = session.FindQuery(queries[query_idx].qid);
+
+            if (eval_query_idx < 0) {
+                // Query not found in relevance judgments; skipping.
+                continue;
+            }
+
+            values.resize(values.size() + num_values);
+
+            if (!session.Rank(&queries[query_idx], false /* ranked */) ||
+                    !session.ComputeCurves(eval_query_idx, &queries[query_idx],
+                                           curve_measures, depth,
+                                           &values[values.size() - num_values])) {
+                PyErr_Format(PyExc_ValueError,
+                             "Unable to compute curves for query '%s'.",
+                             queries[query_idx].qid);
+
+                success = false;
+                break;
+            }
+
+            PyObject* const qid = PyUnicode_FromString(queries[query_idx].qid);
+            PyList_Append(qids, qid);
+            Py_DECREF(qid);
+        }
+    }
+
+    builder.cleanup(num_queries, queries);
+
+    if (!success) {
+        Py_DECREF(qids);
+
+        return NULL;
+    }
+
+    return Py_BuildValue(
+        "(NN)",
+        PyByteArray_FromStringAndSize(
+            values.empty() ? NULL : (const char*) &values[0],
+            values.size() * sizeof (double)),
+        qids);
+}
+
+static PyObject* RelevanceEvaluator_intern_documents(RelevanceEvaluator* self, PyObject* args) {
+    PyObject* docnos = NULL;
+
+    if (!PyArg_ParseTuple(args, "O", &docnos)) {
+        return NULL;
+    }
+
+    PyObject* const docnos_iter = PyObject_GetIter(docnos);
+    if (docnos_iter == NULL) {
+        return NULL;
+    }
+
+    std::vector<int64> ids;
+
+    PyObject* docno = NULL;
+    while ((docno = PyIter_Next(docnos_iter))) {
+        const char* const docno_str = PyUnicode_Check(docno) ? PyUnicode_AsUTF8(docno) : NULL;
+
+        if (docno_str == NULL) {
+            if (!PyErr_Occurred()) {
+                PyErr_SetString(PyExc_TypeError, "Expected document identifiers to be str.");
+            }
+
+            Py_DECREF(docno);
+
+            break;
+        }
+
+        ids.push_back(self->documents_->Intern(docno_str));
+
+        Py_DECREF(docno);
+    }
+
+    Py_DECREF(docnos_iter);
+
+    if (PyErr_Occurred()) {
+        return NULL;
+    }
+
+    // Native-endian int64 values, to be wrapped without copying.
+    return PyByteArray_FromStringAndSize(
+        ids.empty() ? NULL : (const char*) &ids[0], ids.size() * sizeof(int64));
+}
+
+static PyObject* RelevanceEvaluator_set_candidates(RelevanceEvaluator* self, PyObject* args) {
+    PyObject* qids = NULL;
+    PyObject* candidates = NULL;
+
+    if (!PyArg_ParseTuple(args, "OO", &qids, &candidates)) {
+        return NULL;
+    }
+
+    PyObject* const qids_seq = PySequence_Fast(qids, "Argument qids should be a sequence.");
+    if (qids_seq == NULL) {
+        return NULL;
+    }
+
+    PyObject* const candidates_seq = PySequence_Fast(
+        candidates, "Argument candidates should be a sequence.");
+    if (candidates_seq == NULL) {
+        Py_DECREF(qids_seq);
+
+        return NULL;
+    }
+
+    CandidateSet* candidate_set = new CandidateSet;
+    std::set<std::string> seen_qids;
+
+    if (PySequence_Fast_GET_SIZE(qids_seq) != PySequence_Fast_GET_SIZE(candidates_seq)) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Arguments qids and candidates should be of equal length.");
+    }
+
+    for (Py_ssize_t query_idx = 0;
+         !PyErr_Occurred() && query_idx < PySequence_Fast_GET_SIZE(qids_seq);
+         ++query_idx) {
+        PyObject* const qid = PySequence_Fast_GET_ITEM(qids_seq, query_idx);
+
+        if (!PyUnicode_Check(qid)) {
+            PyErr_SetString(PyExc_TypeError, "Expected query identifiers to be str.");
+
+            break;
+        }
+
+        const char* const qid_str = PyUnicode_AsUTF8(qid);
+
+        if (!seen_qids.insert(qid_str).second) {
+            PyErr_Format(PyExc_ValueError, "Query '%s' occurs more than once.", qid_str);
+
+            break;
+        }
+
+        PyObject* const docnos_seq = PySequence_Fast(
+            PySequence_Fast_GET_ITEM(candidates_seq, query_idx),
+            "Expected candidates to be sequences of document identifiers.");
+        if (docnos_seq == NULL) {
+            break;
+        }
+
+        candidate_set->qids.push_back(qid_str);
+        candidate_set->candidates.push_back(std::vector<char*>());
+
+        std::vector<char*>& query_candidates = candidate_set->candidates.back();
+        std::set<int64> seen_docnos;
+
+        for (Py_ssize_t docno_idx = 0; docno_idx < PySequence_Fast_GET_SIZE(docnos_seq); ++docno_idx) {
+            PyObject* const docno = PySequence_Fast_GET_ITEM(docnos_seq, docno_idx);
+
+            if (!PyUnicode_Check(docno)) {
+                PyErr_SetString(PyExc_TypeError, "Expected document identifiers to be str.");
+
+                break;
+            }
+
+            const int64 docid = self->documents_->Intern(PyUnicode_AsUTF8(docno));
+
+            if (!seen_docnos.insert(docid).second) {
+                PyErr_Format(PyExc_ValueError,
+                             "Document '%s' occurs more than once in the "
+                             "candidates of query '%s'.",
+                             PyUnicode_AsUTF8(docno), qid_str);
+
+                break;
+            }
+
+            query_candidates.push_back(self->documents_->Get(docid));
+        }
+
+        Py_DECREF(docnos_seq);
+
+        candidate_set->max_num_candidates = std::max(
+            candidate_set->max_num_candidates, query_candidates.size());
+    }
+
+    Py_DECREF(qids_seq);
+    Py_DECREF(candidates_seq);
+
+    if (PyErr_Occurred()) {
+        delete candidate_set;
+
+        return NULL;
     }
 
-    Py_DECREF(meas_iter);
+    delete self->candidates_;
+    self->candidates_ = candidate_set;
 
-    for (size_t measure_idx = 0;
-         measure_idx < te_num_trec_measures;
-         ++measure_idx) {
-        PyObject* const measure_name = PyUnicode_FromFormat(
-            "%s", te_trec_measures[measure_idx]->name);
+    Py_RETURN_NONE;
+}
 
-        if (1 == PySet_Contains(tmp_measures, measure_name)) {
-            self->measures_->insert(measure_idx);
-        }
+static PyObject* RelevanceEvaluator_evaluate_matrix(RelevanceEvaluator* self, PyObject* args, PyObject* kwds) {
+    PyObject* scores_obj = NULL;
 
-        Py_DECREF(measure_name);
+    // Whether to return rows as evaluate does with columnar=True.
+    int columnar = 0;
+
+    static char* kwlist[] = {"scores", "columnar", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|p", kwlist,
+                                     &scores_obj, &columnar)) {
+        return NULL;
     }
 
-    const bool invalid_measures = self->measures_->size() != PySet_Size(tmp_measures);
+    const CandidateSet* const candidate_set = self->candidates_;
 
-    Py_DECREF(tmp_measures);
+    if (candidate_set == NULL) {
+        PyErr_SetString(PyExc_ValueError,
+                        "No candidates were set; call set_candidates first.");
 
-    if (invalid_measures) {
-        PyErr_SetString(
-            PyExc_TypeError,
-            "Unable to resolve all measures.");
+        return NULL;
+    }
 
-        return -1;
+    ArrayView scores;
+
+    if (!scores.Acquire(scores_obj, "scores", false /* integral */, 2 /* ndim */)) {
+        return NULL;
     }
 
-    // Save reference to object_relevance_per_qid.
-    Py_INCREF(object_relevance_per_qid);
+    const Py_ssize_t num_rows = scores.shape(0);
+    const Py_ssize_t num_columns = scores.shape(1);
 
-    self->object_relevance_per_qid_ = object_relevance_per_qid;
-    CHECK_NOTNULL(self->object_relevance_per_qid_);
+    if (num_rows != (Py_ssize_t) candidate_set->qids.size() ||
+            num_columns != (Py_ssize_t) candidate_set->max_num_candidates) {
+        PyErr_Format(PyExc_ValueError,
+                     "Argument scores should have shape (%zu, %zu), got (%zd, %zd).",
+                     candidate_set->qids.size(), candidate_set->max_num_candidates,
+                     num_rows, num_columns);
 
-    // Build internal trec_eval data structures.
-    QrelRankingBuilder builder;
+        return NULL;
+    }
 
-    int64 num_queries = 0;
-    QrelRankingBuilder::QueryType* queries = NULL;
+    PyObject* result = PyDict_New();
 
-    if (!builder(self->object_relevance_per_qid_, num_queries, queries)) {
-        Py_DECREF(self->object_relevance_per_qid_);
+    // Rows and their query identifiers, when columnar.
+    std::vector<double> rows;
+    PyObject* const row_qids = columnar ? PyList_New(0) : NULL;
 
-        return -1;
-    }
+    PyObject* value_names = NULL;
 
-    CHECK_NOTNULL(queries);
+    {
+        EvaluationSession session(self);
 
-    for (size_t query_idx = 0; query_idx < num_queries; ++query_idx) {
-        TEXT_QRELS_INFO* const text_qrels_info = (TEXT_QRELS_INFO*) queries[query_idx].q_rel_info;
+        if (columnar) {
+            session.CollectRows(&rows, row_qids);
+            value_names = session.ValueNames();
+        }
 
-        QrelRankingBuilder::QueryDocumentPairType* const text_qrels = text_qrels_info->text_qrels;
-        const long num_text_qrels = text_qrels_info->num_text_qrels;
+        std::vector<TEXT_RESULTS> text_results;
 
-        std::sort(
-            text_qrels, text_qrels + num_text_qrels,
-            qrel_docno_compare);
+        for (Py_ssize_t row_idx = 0; row_idx < num_rows; ++row_idx) {
+            const std::vector<char*>& query_candidates = candidate_set->candidates[row_idx];
+
+            // Columns beyond the query's candidates are padding.
+            text_results.resize(query_candidates.size());
+
+            for (size_t column_idx = 0; column_idx < query_candidates.size(); ++column_idx) {
+                text_results[column_idx].docno = query_candidates[column_idx];
+                text_results[column_idx].sim =
+                    (float) scores.AsDouble(row_idx * num_columns + column_idx);
+            }
+
+            if (!EvaluateTextResults(&session, candidate_set->qids[row_idx].c_str(),
+                                     &text_results, result)) {
+                Py_DECREF(result);
+                result = NULL;
+
+                break;
+            }
+        }
     }
 
-    self->all_rel_info_.num_q_rels = num_queries;
-    self->all_rel_info_.rel_info = queries;
+    if (columnar) {
+        if (result != NULL) {
+            Py_DECREF(result);
 
-    for (size_t query_idx = 0; query_idx < num_queries; ++query_idx) {
-        const std::string& qid = queries[query_idx].qid;
-        CHECK_EQ(self->query_id_to_idx_->find(qid), self->query_id_to_idx_->end());
+            result = Py_BuildValue(
+                "(NOO)",
+                PyByteArray_FromStringAndSize(
+                    rows.empty() ? NULL : (const char*) &rows[0],
+                    rows.size() * sizeof (double)),
+                row_qids, value_names);
+        }
 
-        self->query_id_to_idx_->insert(std::pair<std::string, size_t>(qid, query_idx));
+        Py_DECREF(row_qids);
+        Py_DECREF(value_names);
     }
 
-    self->inited_ = true;
+    return result;
+}
 
-    return NULL;
+static PyObject* RelevanceEvaluator_query_relevance(RelevanceEvaluator* self) {
+    PyObject* const query_relevance = PyDict_New();
+
+    for (long query_idx = 0; query_idx < self->all_rel_info_.num_q_rels; ++query_idx) {
+        const REL_INFO& rel_info = self->all_rel_info_.rel_info[query_idx];
+        const TEXT_QRELS_INFO* const text_qrels_info = (TEXT_QRELS_INFO*) rel_info.q_rel_info;
+
+        PyObject* const document_relevance = PyDict_New();
+
+        for (long pair_idx = 0; pair_idx < text_qrels_info->num_text_qrels; ++pair_idx) {
+            PyDict_SetItemAndSteal(
+                document_relevance,
+                PyUnicode_FromString(text_qrels_info->text_qrels[pair_idx].docno),
+                PyLong_FromLong(text_qrels_info->text_qrels[pair_idx].rel));
+        }
+
+        PyDict_SetItemAndSteal(
+            query_relevance,
+            PyUnicode_FromString(rel_info.qid),
+            document_relevance);
+    }
+
+    return query_relevance;
 }
 
-static void RelevanceEvaluator_dealloc(RelevanceEvaluator* self) {
-    if (self->object_relevance_per_qid_ != NULL) {
-        Py_DECREF(self->object_relevance_per_qid_);
+static PyObject* RelevanceEvaluator_interned_documents(RelevanceEvaluator* self) {
+    PyObject* const documents = PyList_New(self->documents_->size());
 
-        self->object_relevance_per_qid_ = NULL;
+    for (int64 docid = 0; docid < self->documents_->size(); ++docid) {
+        PyList_SET_ITEM(documents, docid, PyUnicode_FromString(self->documents_->Get(docid)));
     }
 
-    if (self->all_rel_info_.num_q_rels >= 0) {
-        // Clean up internal trec_eval data structures.
-        QrelRankingBuilder builder;
-        builder.cleanup(self->all_rel_info_.num_q_rels, self->all_rel_info_.rel_info);
+    return documents;
+}
 
-        self->all_rel_info_.num_q_rels = -1;
+static PyObject* RelevanceEvaluator_get_measures(RelevanceEvaluator* self, void* closure) {
+    if (!self->inited_) {
+        PyErr_SetString(PyExc_ValueError, "Evaluator was not initialized.");
+
+        return NULL;
     }
 
-    delete self->query_id_to_idx_;
-    delete self->measures_;
-    if (self->inited_) {
-        size_t i = 0;
-        while (self->epi_.meas_arg[i].measure_name != NULL) {
-            Free(self->epi_.meas_arg[i].measure_name);
-            i++;
-        }
-        Free(self->epi_.meas_arg);
+    EvaluationSession session(self);
+
+    return session.ValueNames();
+}
+
+static PyMemberDef RelevanceEvaluator_members[] = {
+    {NULL}  /* Sentinel */
+};
+
+static PyGetSetDef RelevanceEvaluator_getset[] = {
+    {"measures", (getter) RelevanceEvaluator_get_measures, NULL,
+     "Names of the measure values, in the order of the columns of columnar results.", NULL},
+    {NULL}  /* Sentinel */
+};
+
+static PyMethodDef RelevanceEvaluator_methods[] = {
+    {"evaluate", (PyCFunction) RelevanceEvaluator_evaluate, METH_VARARGS | METH_KEYWORDS,
+     "Evaluate a ranking according to query relevance."},
+    {"evaluate_file", (PyCFunction) RelevanceEvaluator_evaluate_file, METH_VARARGS | METH_KEYWORDS,
+     "Evaluate a TREC run file query by query. With sorted_by_query=False, all queries are\n"
+     "buffered until the end of the file, and evaluated in the order they first occur."},
+    {"evaluate_stream", (PyCFunction) RelevanceEvaluator_evaluate_stream, METH_VARARGS | METH_KEYWORDS,
+     "Evaluate an iterable of TREC run lines query by query. With sorted_by_query=False, all\n"
+     "queries are buffered until the end of the stream, and evaluated in the order they first occur."},
+    {"evaluate_arrays", (PyCFunction) RelevanceEvaluator_evaluate_arrays, METH_VARARGS | METH_KEYWORDS,
+     "Evaluate a ranking given as arrays of integer query/document identifiers and scores."},
+    {"evaluate_many", (PyCFunction) RelevanceEvaluator_evaluate_many, METH_VARARGS | METH_KEYWORDS,
+     "Evaluate several runs into a dense buffer of measure values."},
+    {"evaluate_ranked", (PyCFunction) RelevanceEvaluator_evaluate_ranked, METH_VARARGS,
+     "Evaluate rankings given as ordered lists of document identifiers."},
+    {"evaluate_curves", (PyCFunction) RelevanceEvaluator_evaluate_curves, METH_VARARGS | METH_KEYWORDS,
+     "Evaluate cutoff measures at every rank up to a depth."},
+    {"intern_documents", (PyCFunction) RelevanceEvaluator_intern_documents, METH_VARARGS,
+     "Map document identifiers to integer identifiers, adding unseen ones."},
+    {"query_relevance", (PyCFunction) RelevanceEvaluator_query_relevance, METH_NOARGS,
+     "Return the relevance information as a dictionary."},
+    {"interned_documents", (PyCFunction) RelevanceEvaluator_interned_documents, METH_NOARGS,
+     "Return the interned document identifiers, ordered by integer identifier."},
+    {"set_candidates", (PyCFunction) RelevanceEvaluator_set_candidates, METH_VARARGS,
+     "Set the fixed candidate documents per query for evaluate_matrix."},
+    {"evaluate_matrix", (PyCFunction) RelevanceEvaluator_evaluate_matrix, METH_VARARGS | METH_KEYWORDS,
+     "Evaluate a dense matrix of candidate scores (one row per query)."},
+    {NULL}  /* Sentinel */
+};
+
+// EvaluationAccumulator
+
+typedef struct {
+    PyObject_HEAD
+
+    // Evaluator whose judgments and measures are used; a reference is held.
+    PyObject* evaluator_;
+
+    // Aggregates the measures of all added queries (NULL until init).
+    EvaluationSession* session_;
+} EvaluationAccumulator;
+
+static PyObject* EvaluationAccumulator_new(PyTypeObject* type, PyObject* args, PyObject* kwds) {
+    EvaluationAccumulator* self;
+
+    self = (EvaluationAccumulator*) type->tp_alloc(type, 0);
+    if (self != NULL) {
+        self->evaluator_ = NULL;
+        self->session_ = NULL;
     }
+
+    return (PyObject*) self;
 }
 
-bool query_document_pair_compare(
-        const ResultRankingBuilder::QueryDocumentPairType& a,
-        const ResultRankingBuilder::QueryDocumentPairType& b) {
-    if (a.sim < b.sim) return false;
-    if (a.sim > b.sim) return true;
-    return strcmp(a.docno, b.docno) < 0;
+static void EvaluationAccumulator_clear(EvaluationAccumulator* self) {
+    delete self->session_;
+    self->session_ = NULL;
+
+    Py_CLEAR(self->evaluator_);
 }
 
-static PyObject* RelevanceEvaluator_evaluate(RelevanceEvaluator* self, PyObject* args) {
-    PyObject* object_scores = NULL;
+static int EvaluationAccumulator_init(EvaluationAccumulator* self, PyObject* args, PyObject* kwds) {
+    PyObject* evaluator = NULL;
 
-    if (!PyArg_ParseTuple(args, "O", &object_scores) ||
-        !PyDict_Check(object_scores)) {
-        PyErr_SetString(
-            PyExc_TypeError,
-            "Argument object scores should be of type dictionary.");
+    static char* kwlist[] = {"evaluator", NULL};
 
-        return NULL;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!", kwlist,
+                                     &RelevanceEvaluatorType, &evaluator)) {
+        return -1;
     }
 
-    ResultRankingBuilder builder;
+    if (!((RelevanceEvaluator*) evaluator)->inited_) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Argument evaluator should be an initialized "
+                        "evaluator.");
 
-    int64 num_queries = 0;
-    ResultRankingBuilder::QueryType* queries = NULL;
+        return -1;
+    }
 
-    if (!builder(object_scores, num_queries, queries)) {
-        PyErr_SetString(
-            PyExc_TypeError,
-            "Unable to extract query/object scores.");
+    EvaluationAccumulator_clear(self);
 
-        return NULL;
-    }
+    Py_INCREF(evaluator);
+    self->evaluator_ = evaluator;
 
-    CHECK_NOTNULL(queries);
+    self->session_ = new EvaluationSession((RelevanceEvaluator*) evaluator);
 
-    for (size_t query_idx = 0; query_idx < num_queries; ++query_idx) {
-        TEXT_RESULTS_INFO* const text_results_info = (TEXT_RESULTS_INFO*) queries[query_idx].q_results;
+    return 0;
+}
 
-        ResultRankingBuilder::QueryDocumentPairType* const text_results = text_results_info->text_results;
-        const long num_text_results = text_results_info->num_text_results;
+static void EvaluationAccumulator_dealloc(EvaluationAccumulator* self) {
+    EvaluationAccumulator_clear(self);
 
-        std::sort(
-            text_results, text_results + num_text_results,
-            query_document_pair_compare);
+    Py_TYPE(self)->tp_free((PyObject*) self);
+}
+
+static bool EvaluationAccumulator_check(EvaluationAccumulator* self) {
+    if (self->session_ == NULL) {
+        PyErr_SetString(PyExc_RuntimeError,
+                        "Accumulator was not initialized.");
+
+        return false;
     }
 
-    ALL_RESULTS all_results;
-    TREC_EVAL q_eval;
+    return true;
+}
 
-    all_results.num_q_results = num_queries;
-    all_results.results = queries;
+// Adds the measures of a single query to the aggregates. The ranking is
+// either a dictionary of document scores, or the document identifiers in
+// ranking order (as with evaluate_ranked). Returns whether the query has
+// relevance information; other queries are skipped.
+static PyObject* EvaluationAccumulator_add(EvaluationAccumulator* self, PyObject* args, PyObject* kwds) {
+    const char* qid = NULL;
+    PyObject* ranking = NULL;
 
-    TREC_EVAL accum_eval;
-#ifdef _MSC_VER
-    accum_eval = TREC_EVAL {"all", 0, NULL, 0, 0};
-#else
-    accum_eval = (TREC_EVAL) {"all", 0, NULL, 0, 0};
-#endif
-    for (std::set<size_t>::iterator it = self->measures_->begin();
-         it != self->measures_->end(); ++it) {
-        const size_t measure_idx = *it;
-        // re-apply default arg values
-        if (te_trec_measures[measure_idx]->meas_params != NULL) {
-            Free(te_trec_measures[measure_idx]->meas_params);
-            PARAMS* params = new PARAMS();
-            params->printable_params = default_meas_params[measure_idx].printable_params;
-            params->num_params = default_meas_params[measure_idx].num_params;
-            params->param_values = default_meas_params[measure_idx].param_values;
-            te_trec_measures[measure_idx]->meas_params = params; /* {
-                default_meas_params[measure_idx].printable_params,
-                default_meas_params[measure_idx].num_params,
-                default_meas_params[measure_idx].param_values};*/
-        }
-        te_trec_measures[measure_idx]->init_meas(
-            &self->epi_,
-            te_trec_measures[measure_idx],
-            &accum_eval);
-    }
-
-    /* Reserve space and initialize q_eval to be copy of accum_eval */
-    q_eval.values = Malloc(
-        accum_eval.num_values, TREC_EVAL_VALUE);
-    CHECK_NOTNULL(q_eval.values);
-
-    memcpy(q_eval.values, accum_eval.values,
-           accum_eval.num_values * sizeof (TREC_EVAL_VALUE));
-
-    q_eval.num_values = accum_eval.num_values;
-    q_eval.num_queries = 0;
+    static char* kwlist[] = {"qid", "ranking", NULL};
 
-    // Holds the result.
-    PyObject* const result = PyDict_New();
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "sO", kwlist, &qid, &ranking) ||
+            !EvaluationAccumulator_check(self)) {
+        return NULL;
+    }
 
-    for (size_t result_query_idx = 0;
-         result_query_idx < num_queries;
-         ++result_query_idx) {
-        const std::string qid = all_results.results[result_query_idx].qid;
-        std::map<std::string, size_t>::iterator it = self->query_id_to_idx_->find(qid);
+    if (self->session_->FindQuery(qid) < 0) {
+        Py_RETURN_FALSE;
+    }
 
-        if (it == self->query_id_to_idx_->end()) {
-            // Query not found in relevance judgments; skipping.
-            continue;
-        }
+    RelevanceEvaluator* const evaluator = (RelevanceEvaluator*) self->evaluator_;
 
-        const size_t eval_query_idx = it->second;
-        q_eval.qid = all_results.results[result_query_idx].qid;
+    std::vector<TEXT_RESULTS> text_results;
 
-        PyObject* const query_measures = PyDict_New();
+    // Keeps the document identifiers alive until evaluated.
+    PyObject* sequence = NULL;
 
-        for (std::set<size_t>::iterator it = self->measures_->begin();
-             it != self->measures_->end(); ++it) {
-            const size_t measure_idx = *it;
+    bool success = true;
+    bool ranked = false;
 
-            // Empty buffer.
-            for (int32 value_idx = 0; value_idx < q_eval.num_values; ++value_idx) {
-                q_eval.values[value_idx].value = 0;
-            }
+    if (PyDict_Check(ranking)) {
+        PyObject* key = NULL;
+        PyObject* value = NULL;
 
-            // Compute measure.
-            te_trec_measures[measure_idx]->calc_meas(
-                &self->epi_,
-                &self->all_rel_info_.rel_info[eval_query_idx],
-                &all_results.results[result_query_idx],
-                te_trec_measures[measure_idx],
-                &q_eval);
+        Py_ssize_t pos = 0;
 
-            CHECK_GE(te_trec_measures[measure_idx]->eval_index, 0);
+        while (success && PyDict_Next(ranking, &pos, &key, &value)) {
+            TEXT_RESULTS text_result;
 
-            if (te_trec_measures[measure_idx]->print_single_meas == &te_print_single_meas_a_cut) {
-                for (int32 param_idx = 0;
-                     param_idx < te_trec_measures[measure_idx]->meas_params->num_params;
-                     ++param_idx) {
-                    PyDict_SetItemAndSteal(
-                        query_measures,
-                        PyUnicode_FromString(
-                            q_eval.values[te_trec_measures[measure_idx]->eval_index + param_idx].name),
-                        PyFloat_FromDouble(
-                            q_eval.values[te_trec_measures[measure_idx]->eval_index + param_idx].value));
-                }
+            if (!PyUnicode_Check(key)) {
+                PyErr_SetString(PyExc_TypeError, "Expected string as key.");
+
+                success = false;
+            } else if (PyFloat_Check(value)) {
+                text_result.sim = PyFloat_AsDouble(value);
+            } else if (PyLong_Check(value)) {
+                text_result.sim = PyLong_AsDouble(value);
             } else {
-                PyDict_SetItemAndSteal(
-                    query_measures,
-                    PyUnicode_FromString(te_trec_measures[measure_idx]->name),
-                    PyFloat_FromDouble(
-                        q_eval.values[te_trec_measures[measure_idx]->eval_index].value));
+                PyErr_SetString(PyExc_TypeError, "Expected matching score to be int, long or float.");
+
+                success = false;
             }
 
-            // Add the measure value to the aggregate.
-            // This call is probably unnecessary as we don't rely on trec_eval's averaging mechanism.
-            te_trec_measures[measure_idx]->acc_meas(
-                &self->epi_,
-                te_trec_measures[measure_idx],
-                &q_eval,
-                &accum_eval);
+            if (success) {
+                text_result.docno = (char*) PyUnicode_AsUTF8(key);
 
-            if (__DEVELOPMENT) {
-                // Print.
-                te_trec_measures[measure_idx]->print_single_meas(
-                    &self->epi_,
-                    te_trec_measures[measure_idx],
-                    &q_eval);
+                text_results.push_back(text_result);
             }
-
-            accum_eval.num_queries++;
         }
+    } else {
+        success = CollectRanking(evaluator, ranking, &text_results, &sequence);
+        ranked = true;
+    }
 
-        PyDict_SetItemAndSteal(
-            result,
-            PyUnicode_FromString(qid.c_str()),
-            query_measures);
+    if (success) {
+        success = EvaluateTextResults(self->session_, qid, &text_results,
+                                      NULL /* result */, ranked);
     }
 
-    for (std::set<size_t>::iterator it = self->measures_->begin();
-         it != self->measures_->end(); ++it) {
-        const size_t measure_idx = *it;
+    Py_XDECREF(sequence);
 
-        // Cleanup; nothing gets printed as self->epi_.summary_flag == 0.
-        te_trec_measures[measure_idx]->print_final_and_cleanup_meas 
-            (&self->epi_, te_trec_measures[measure_idx],  &accum_eval);
+    if (!success) {
+        return NULL;
     }
 
-    // Clean.
-    builder.cleanup(num_queries, queries);
+    Py_RETURN_TRUE;
+}
+
+// Returns a dictionary with the aggregates of the queries added so far, as
+// evaluate computes them with aggregate=True.
+static PyObject* EvaluationAccumulator_snapshot(EvaluationAccumulator* self) {
+    if (!EvaluationAccumulator_check(self)) {
+        return NULL;
+    }
+
+    PyObject* const result = PyDict_New();
 
-    Free(q_eval.values);
-    Free(accum_eval.values);
+    self->session_->EmitSnapshot(kAggregateScope, result);
 
-    te_form_res_rels_cleanup();
+    PyObject* const aggregates = PyDict_GetItemString(result, kAggregateScope);
+    Py_XINCREF(aggregates);
 
-    return result;
+    Py_DECREF(result);
+
+    return aggregates;
 }
 
-static PyMemberDef RelevanceEvaluator_members[] = {
+static PyObject* EvaluationAccumulator_reset(EvaluationAccumulator* self) {
+    if (!EvaluationAccumulator_check(self)) {
+        return NULL;
+    }
+
+    self->session_->ResetAggregates();
+
+    Py_RETURN_NONE;
+}
+
+static PyObject* EvaluationAccumulator_get_num_queries(EvaluationAccumulator* self, void* closure) {
+    if (!EvaluationAccumulator_check(self)) {
+        return NULL;
+    }
+
+    return PyLong_FromLong(self->session_->num_queries());
+}
+
+static PyMethodDef EvaluationAccumulator_methods[] = {
+    {"add", (PyCFunction) EvaluationAccumulator_add, METH_VARARGS | METH_KEYWORDS,
+     "Add the measures of a single query to the aggregates.\n\n"
+     "ranking is either a dictionary of document scores, as in the runs accepted by evaluate,\n"
+     "or a sequence of document identifiers in ranking order, as accepted by evaluate_ranked.\n"
+     "Returns whether the query was added; queries without judgments are skipped."},
+    {"snapshot", (PyCFunction) EvaluationAccumulator_snapshot, METH_NOARGS,
+     "Return the aggregates of the queries added so far, as evaluate with aggregate=True\n"
+     "returns them under 'all' for a run of the same queries."},
+    {"reset", (PyCFunction) EvaluationAccumulator_reset, METH_NOARGS,
+     "Discard the aggregates of all added queries."},
     {NULL}  /* Sentinel */
 };
 
-static PyMethodDef RelevanceEvaluator_methods[] = {
-    {"evaluate", (PyCFunction) RelevanceEvaluator_evaluate, METH_VARARGS,
-     "Evaluate a ranking according to query relevance."},
+static PyGetSetDef EvaluationAccumulator_getset[] = {
+    {"num_queries", (getter) EvaluationAccumulator_get_num_queries, NULL,
+     "Number of queries added so far.", NULL},
+    {NULL}  /* Sentinel */
+};
+
+static PyMethodDef PyTrecEvalModule_methods[] = {
+    {"parse_run_file", (PyCFunction) parse_run_file, METH_VARARGS,
+     "Parse a TREC run file into a dictionary of query/document scores."},
+    {"parse_qrel_file", (PyCFunction) parse_qrel_file, METH_VARARGS,
+     "Parse a TREC qrel file into a dictionary of query/document relevance."},
     {NULL}  /* Sentinel */
 };
 
@@ -712,7 +4612,7 @@ static PyModuleDef PyTrecEvalModule = {
     "pytrec_eval_ext",
     "Python interface to TREC Eval.",
     -1,
-    RelevanceEvaluator_methods,
+    PyTrecEvalModule_methods,
     NULL, NULL, NULL, NULL
 };
 
@@ -748,7 +4648,7 @@ PyMODINIT_FUNC PyInit_pytrec_eval_ext(void) {
         0,                         /* tp_iternext */
         RelevanceEvaluator_methods,         /* tp_methods */
         RelevanceEvaluator_members,         /* tp_members */
-        0,                         /* tp_getset */
+        RelevanceEvaluator_getset,          /* tp_getset */
         0,                         /* tp_base */
         0,                         /* tp_dict */
         0,                         /* tp_descr_get */
@@ -765,6 +4665,57 @@ PyMODINIT_FUNC PyInit_pytrec_eval_ext(void) {
         return NULL;
     }
 
+    PyTypeObject EvaluationAccumulatorType_local = {
+        PyVarObject_HEAD_INIT(NULL, 0)
+        "pytrec_eval.EvaluationAccumulator", /* tp_name */
+        sizeof(EvaluationAccumulator),      /* tp_basicsize */
+        0,                         /* tp_itemsize */
+        (destructor) EvaluationAccumulator_dealloc, /* tp_dealloc */
+        0,                         /* tp_print */
+        0,                         /* tp_getattr */
+        0,                         /* tp_setattr */
+        0,                         /* tp_reserved */
+        0,                         /* tp_repr */
+        0,                         /* tp_as_number */
+        0,                         /* tp_as_sequence */
+        0,                         /* tp_as_mapping */
+        0,                         /* tp_hash */
+        0,                         /* tp_call */
+        0,                         /* tp_str */
+        0,                         /* tp_getattro */
+        0,                         /* tp_setattro */
+        0,                         /* tp_as_buffer */
+        Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE, /* tp_flags */
+        "EvaluationAccumulator(evaluator)\n\n"
+        "Aggregates measures over rankings added one query at a time. Only the running\n"
+        "aggregates of trec_eval are kept, so memory does not grow with the number of added\n"
+        "queries, and they can be read at any moment. Every query should be added at most\n"
+        "once between resets.", /* tp_doc */
+        0,                         /* tp_traverse */
+        0,                         /* tp_clear */
+        0,                         /* tp_richcompare */
+        0,                         /* tp_weaklistoffset */
+        0,                         /* tp_iter */
+        0,                         /* tp_iternext */
+        EvaluationAccumulator_methods,      /* tp_methods */
+        0,                         /* tp_members */
+        EvaluationAccumulator_getset,       /* tp_getset */
+        0,                         /* tp_base */
+        0,                         /* tp_dict */
+        0,                         /* tp_descr_get */
+        0,                         /* tp_descr_set */
+        0,                         /* tp_dictoffset */
+        (initproc) EvaluationAccumulator_init, /* tp_init */
+        0,                         /* tp_alloc */
+        EvaluationAccumulator_new,          /* tp_new */
+    };
+
+    EvaluationAccumulatorType = EvaluationAccumulatorType_local;
+
+    if (PyType_Ready(&EvaluationAccumulatorType) < 0) {
+        return NULL;
+    }
+
     PyObject* const module = PyModule_Create(&PyTrecEvalModule);
 
     if (module == NULL) {
@@ -774,8 +4725,32 @@ PyMODINIT_FUNC PyInit_pytrec_eval_ext(void) {
     Py_INCREF(&RelevanceEvaluatorType);
     PyModule_AddObject(module, "RelevanceEvaluator", (PyObject*) &RelevanceEvaluatorType);
 
+    Py_INCREF(&EvaluationAccumulatorType);
+    PyModule_AddObject(module, "EvaluationAccumulator", (PyObject*) &EvaluationAccumulatorType);
+
     CHECK_STR_EQ(te_trec_measure_nicknames[2].name, "all_trec");
 
+    // Fused measures are matched by name (see InitFusedPlan); a name that
+    // trec_eval does not define would silently never be fused.
+    for (size_t fused_measure = 0; kFusedMeasures[fused_measure] != NULL; ++fused_measure) {
+        int32 measure_idx = 0;
+
+        while (measure_idx < te_num_trec_measures &&
+               strcmp(te_trec_measures[measure_idx]->name, kFusedMeasures[fused_measure]) != 0) {
+            ++measure_idx;
+        }
+
+        if (measure_idx == te_num_trec_measures) {
+            PyErr_Format(PyExc_ImportError,
+                         "Fused measure '%s' is not a trec_eval measure.",
+                         kFusedMeasures[fused_measure]);
+
+            Py_DECREF(module);
+
+            return NULL;
+        }
+    }
+
     // Add set of all supported relevance measures.
     PyObject* const measures = PySet_New(NULL);
 
@@ -810,27 +4785,13 @@ PyMODINIT_FUNC PyInit_pytrec_eval_ext(void) {
 
     PyModule_AddObject(module, "supported_nicknames", nicknames);
 
-    // Grab the default meas_params (if not done already). Need to do this because
-    // trec_eval clobbers the references to these if they are ever overwritten.
+    // Grab the default meas_params (if not done already); every evaluator
+    // starts its private copies of the measures from these.
     if (default_meas_params == NULL) {
         default_meas_params = Malloc(te_num_trec_measures, PARAMS);
         for (int i=0; i<te_num_trec_measures; i++) {
             if (te_trec_measures[i]->meas_params != NULL) {
-                te_trec_measures[measure_idx]->meas_params;
-#ifdef _MSC_VER                
-                default_meas_params[i] = PARAMS {
-#else 
-                default_meas_params[i] = (PARAMS) {
-#endif
-                    te_trec_measures[i]->meas_params->printable_params,
-                    te_trec_measures[i]->meas_params->num_params,
-                    te_trec_measures[i]->meas_params->param_values
-                };
-                PARAMS* params = new PARAMS();
-                params->printable_params = default_meas_params[i].printable_params;
-                params->num_params = default_meas_params[i].num_params;
-                params->param_values = default_meas_params[i].param_values;
-                te_trec_measures[i]->meas_params = params;
+                default_meas_params[i] = *te_trec_measures[i]->meas_params;
             }
         }
     }
@@ -1,8 +1,15 @@
 import collections
+import locale
+import multiprocessing
 import os
+import pickle
 import re
+import tempfile
+import time
 import unittest
 
+import numpy as np
+
 import pytrec_eval
 
 TREC_EVAL_TEST_DIR = os.path.join(
@@ -295,6 +302,1241 @@ class PyTrecEvalUnitTest(unittest.TestCase):
         evaluator = pytrec_eval.RelevanceEvaluator(qrel, ['ndcg_cut', 'ndcg_cut.1,4', 'ndcg_cut_20,4', 'ndcg_cut_15', 'recall.1000', 'P'])
         self.assertEqual(set(evaluator.evaluate(run)['q1'].keys()), {'ndcg_cut_1', 'ndcg_cut_4', 'ndcg_cut_15', 'ndcg_cut_20', 'recall_1000', 'P_200', 'P_15', 'P_10', 'P_5', 'P_30', 'P_100', 'P_20', 'P_500', 'P_1000'})
 
+    def test_parse_files(self):
+        run_lines = [
+            'q1 Q0 d1 1 1.5 run\n',
+            'q1 Q0 d2 2 0.25 run\n',
+            '\n',
+            'q2 Q0 d1 1 -3e-1 run\n',
+            'q1 Q0 d3 3 0.0 run',
+        ]
+        qrel_lines = [
+            'q1 0 d1 0\n',
+            'q1 0 d2 2\r\n',
+            'q2 0 d3 1\n',
+        ]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            run_path = os.path.join(tmp_dir, 'run')
+            with open(run_path, 'w') as f_run:
+                f_run.writelines(run_lines)
+
+            qrel_path = os.path.join(tmp_dir, 'qrel')
+            with open(qrel_path, 'w', newline='') as f_qrel:
+                f_qrel.writelines(qrel_lines)
+
+            self.assertEqual(
+                pytrec_eval.parse_run_file(run_path),
+                pytrec_eval.parse_run(
+                    line for line in run_lines if line.strip()))
+            self.assertEqual(
+                pytrec_eval.parse_qrel_file(qrel_path),
+                pytrec_eval.parse_qrel(qrel_lines))
+
+            # Scores are parsed as float does, regardless of the locale.
+            previous_locale = locale.setlocale(locale.LC_NUMERIC)
+
+            for comma_locale in ('de_DE.UTF-8', 'de_DE', 'fr_FR.UTF-8'):
+                try:
+                    locale.setlocale(locale.LC_NUMERIC, comma_locale)
+                except locale.Error:
+                    continue
+
+                try:
+                    self.assertEqual(
+                        pytrec_eval.parse_run_file(run_path)['q1']['d1'], 1.5)
+                finally:
+                    locale.setlocale(locale.LC_NUMERIC, previous_locale)
+
+                break
+
+            garbage_path = os.path.join(tmp_dir, 'garbage')
+            with open(garbage_path, 'w') as f_garbage:
+                f_garbage.write('q1 Q0 d1 1 1.5x run\n')
+
+            with self.assertRaisesRegex(ValueError, r':1: unable to parse'):
+                pytrec_eval.parse_run_file(garbage_path)
+
+            with open(run_path, 'a') as f_run:
+                f_run.write('\nq1 Q0 d1 4 0.0 run\n')
+
+            with self.assertRaisesRegex(ValueError, r':6: duplicate'):
+                pytrec_eval.parse_run_file(run_path)
+
+            with open(qrel_path, 'a') as f_qrel:
+                f_qrel.write('q2 0 d4 relevant\n')
+
+            with self.assertRaisesRegex(ValueError, r':4: unable to parse'):
+                pytrec_eval.parse_qrel_file(qrel_path)
+
+            with self.assertRaisesRegex(ValueError, r':1: expected 4 fields'):
+                pytrec_eval.parse_qrel_file(run_path)
+
+    def test_from_qrel_file(self):
+        qrel = {
+            'q1': {
+                'd1': 0,
+                'd2': 1,
+                'd3': 0,
+            },
+            'q2': {
+                'd2': 1,
+                'd3': 1,
+            },
+        }
+        run = {
+            'q1': {
+                'd1': 1.0,
+                'd2': 0.0,
+                'd3': 1.5,
+            },
+            'q2': {
+                'd1': 1.5,
+                'd2': 0.2,
+                'd3': 0.5,
+            },
+        }
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            qrel_path = os.path.join(tmp_dir, 'qrel')
+            with open(qrel_path, 'w') as f_qrel:
+                # Interleave queries to check that judgments get grouped.
+                f_qrel.write('q1 0 d3 0\nq2 0 d3 1\nq1 0 d1 0\n')
+                f_qrel.write('q1 0 d2 1\nq2 0 d2 1\n')
+
+            evaluator = pytrec_eval.RelevanceEvaluator.from_qrel_file(
+                qrel_path, {'map', 'ndcg', 'P.1,2'})
+            self.assertIsInstance(evaluator, pytrec_eval.RelevanceEvaluator)
+
+            self.assertEqual(
+                evaluator.evaluate(run),
+                pytrec_eval.RelevanceEvaluator(
+                    qrel, {'map', 'ndcg', 'P.1,2'}).evaluate(run))
+
+            with open(qrel_path, 'a') as f_qrel:
+                f_qrel.write('q2 0 d2 0\n')
+
+            with self.assertRaisesRegex(ValueError, 'duplicate document'):
+                pytrec_eval.RelevanceEvaluator.from_qrel_file(
+                    qrel_path, {'map'})
+
+    def test_evaluate_file(self):
+        qrel = {
+            'q1': {
+                'd1': 0,
+                'd2': 1,
+                'd3': 0,
+            },
+            'q2': {
+                'd2': 1,
+                'd3': 1,
+            },
+        }
+        run_lines = [
+            'q1 Q0 d1 1 1.0 run\n',
+            'q1 Q0 d2 2 0.0 run\n',
+            'q1 Q0 d3 3 1.5 run\n',
+            'q2 Q0 d1 1 1.5 run\n',
+            'q2 Q0 d2 2 0.2 run\n',
+            'q2 Q0 d3 3 0.5 run\n',
+            'q3 Q0 d1 1 0.5 run\n',
+        ]
+
+        evaluator = pytrec_eval.RelevanceEvaluator(
+            qrel, {'map', 'ndcg', 'P.1,2'})
+        expected = evaluator.evaluate(pytrec_eval.parse_run(run_lines))
+
+        self.assertEqual(evaluator.evaluate_stream(run_lines), expected)
+
+        # Interleaved queries are only supported when asked for.
+        unsorted_run_lines = run_lines[::2] + run_lines[1::2]
+
+        with self.assertRaisesRegex(ValueError, 'not sorted by query'):
+            evaluator.evaluate_stream(unsorted_run_lines)
+
+        self.assertEqual(
+            evaluator.evaluate_stream(
+                unsorted_run_lines, sorted_by_query=False),
+            expected)
+
+        # Queries are emitted in the order in which they first occur.
+        self.assertEqual(
+            list(evaluator.evaluate_stream(
+                run_lines[3:] + run_lines[:3], sorted_by_query=False)),
+            ['q2', 'q1'])
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            run_path = os.path.join(tmp_dir, 'run')
+            with open(run_path, 'w') as f_run:
+                f_run.writelines(run_lines)
+
+            self.assertEqual(evaluator.evaluate_file(run_path), expected)
+
+            with open(run_path, 'w') as f_run:
+                f_run.writelines(unsorted_run_lines)
+
+            self.assertEqual(
+                evaluator.evaluate_file(run_path, sorted_by_query=False),
+                expected)
+
+            with open(run_path, 'a') as f_run:
+                f_run.write('q2 Q0 d1 1 1.5\n')
+
+            with self.assertRaisesRegex(ValueError, ':8: expected 6 fields'):
+                evaluator.evaluate_file(run_path, sorted_by_query=False)
+
+    def test_evaluate_arrays(self):
+        qrel = {
+            '1': {
+                '10': 0,
+                '20': 1,
+                '30': 0,
+            },
+            '2': {
+                '20': 1,
+                '30': 1,
+            },
+        }
+        run = {
+            '1': {
+                '10': 1.0,
+                '20': 0.0,
+                '30': 1.5,
+            },
+            '2': {
+                '10': 1.5,
+                '20': 0.2,
+                '30': 0.5,
+            },
+        }
+
+        measures = {'map', 'ndcg', 'P.1,2'}
+        expected = pytrec_eval.RelevanceEvaluator(
+            qrel, measures).evaluate(run)
+
+        evaluator = pytrec_eval.RelevanceEvaluator.from_arrays(
+            np.array([1, 1, 1, 2, 2]),
+            np.array([10, 20, 30, 20, 30]),
+            np.array([0, 1, 0, 1, 1]),
+            measures)
+
+        qids = np.array([1, 1, 1, 2, 2, 2], dtype=np.int32)
+        docids = np.array([10, 20, 30, 10, 20, 30], dtype=np.int64)
+        scores = np.array([1.0, 0.0, 1.5, 1.5, 0.2, 0.5], dtype=np.float32)
+
+        self.assertEqual(
+            evaluator.evaluate_arrays(qids, docids, scores), expected)
+
+        # Ragged segments given by offsets.
+        self.assertEqual(
+            evaluator.evaluate_arrays(
+                np.array([2, 1]),
+                np.concatenate([docids[3:], docids[:3]]),
+                np.concatenate([scores[3:], scores[:3]]),
+                offsets=np.array([0, 3, 6])),
+            expected)
+
+        with self.assertRaisesRegex(ValueError, 'grouped by query'):
+            evaluator.evaluate_arrays(
+                np.array([1, 2, 1]), docids[:3], scores[:3])
+
+        with self.assertRaises(TypeError):
+            evaluator.evaluate_arrays(qids, docids.astype(np.float64), scores)
+
+    def test_intern_documents(self):
+        qrel = {
+            '1': {
+                'd1': 0,
+                'd2': 1,
+                'd3': 0,
+            },
+            '2': {
+                'd2': 1,
+                'd3': 1,
+            },
+        }
+        run = {
+            '1': {
+                'd1': 1.0,
+                'd2': 0.0,
+                'd4': 1.5,
+            },
+        }
+
+        evaluator = pytrec_eval.RelevanceEvaluator(qrel, {'map', 'ndcg'})
+
+        docids = evaluator.intern_documents(['d1', 'd2', 'd4', 'd2'])
+
+        self.assertEqual(docids.dtype, np.int64)
+        self.assertEqual(docids[1], docids[3])
+        self.assertEqual(len(set(docids.tolist())), 3)
+
+        self.assertEqual(
+            evaluator.evaluate_arrays(
+                np.array([1, 1, 1]), docids[:3],
+                np.array([1.0, 0.0, 1.5]), interned=True),
+            evaluator.evaluate(run))
+
+        with self.assertRaisesRegex(ValueError, 'not an interned'):
+            evaluator.evaluate_arrays(
+                np.array([1]), np.array([docids.max() + 1]),
+                np.array([1.0]), interned=True)
+
+    def test_evaluate_matrix(self):
+        qrel = {
+            'q1': {
+                'd1': 0,
+                'd2': 1,
+                'd3': 0,
+            },
+            'q2': {
+                'd2': 1,
+                'd3': 1,
+            },
+        }
+
+        evaluator = pytrec_eval.RelevanceEvaluator(
+            qrel, {'map', 'ndcg', 'P.1'})
+
+        with self.assertRaisesRegex(ValueError, 'set_candidates'):
+            evaluator.evaluate_matrix(np.zeros((2, 3)))
+
+        evaluator.set_candidates({
+            'q1': ['d1', 'd2', 'd3'],
+            'q2': ['d3', 'd4'],
+        })
+
+        scores = np.array([
+            [1.0, 0.0, 1.5],
+            [0.5, 2.0, -1.0],  # Last column is padding.
+        ], dtype=np.float32)
+
+        self.assertEqual(
+            evaluator.evaluate_matrix(scores),
+            evaluator.evaluate({
+                'q1': {'d1': 1.0, 'd2': 0.0, 'd3': 1.5},
+                'q2': {'d3': 0.5, 'd4': 2.0},
+            }))
+
+        with self.assertRaisesRegex(ValueError, 'shape'):
+            evaluator.evaluate_matrix(scores[:, :2].copy())
+
+        with self.assertRaisesRegex(ValueError, 'more than once'):
+            evaluator.set_candidates({'q1': ['d1', 'd1']})
+
+    def test_depth(self):
+        qrel = {
+            'q1': {'d{}'.format(idx): int(idx % 3 == 0) for idx in range(50)},
+        }
+        # Includes ties, which trec_eval breaks by decreasing document id.
+        run = {
+            'q1': {'d{}'.format(idx): float(idx % 7) for idx in range(200)},
+        }
+
+        measures = {'P.5,10', 'ndcg_cut.10', 'recall.20', 'num_q'}
+
+        full = pytrec_eval.RelevanceEvaluator(
+            qrel, measures | {'map'}).evaluate(run)['q1']
+        truncated = pytrec_eval.RelevanceEvaluator(
+            qrel, measures).evaluate(run)['q1']
+
+        for measure, value in truncated.items():
+            self.assertAlmostEqual(full[measure], value)
+
+        # Same as considering the top 5 documents only.
+        top = dict(sorted(run['q1'].items(),
+                          key=lambda item: (item[1], item[0]),
+                          reverse=True)[:5])
+
+        self.assertAlmostEqual(
+            pytrec_eval.RelevanceEvaluator(
+                qrel, {'map'}, depth=5).evaluate(run)['q1']['map'],
+            pytrec_eval.RelevanceEvaluator(
+                qrel, {'map'}).evaluate({'q1': top})['q1']['map'])
+
+        with self.assertRaises(ValueError):
+            pytrec_eval.RelevanceEvaluator(qrel, {'map'}, depth=0)
+
+        # Duplicates are rejected, also beyond the depth.
+        with self.assertRaises(ValueError):
+            pytrec_eval.RelevanceEvaluator(
+                qrel, {'map'}, depth=5).evaluate_ranked(
+                    {'q1': ['d{}'.format(idx) for idx in range(1, 8)] +
+                           ['d1']})
+
+    def test_evaluate_ranked(self):
+        qrel = {
+            'q1': {
+                'd1': 0,
+                'd2': 1,
+                'd3': 0,
+            },
+            'q2': {
+                'd2': 1,
+                'd3': 1,
+            },
+        }
+
+        evaluator = pytrec_eval.RelevanceEvaluator(
+            qrel, {'map', 'ndcg', 'P.1,2'})
+
+        expected = evaluator.evaluate({
+            'q1': {'d3': 3.0, 'd1': 2.0, 'd2': 1.0},
+            'q2': {'d1': 2.0, 'd2': 1.0},
+        })
+
+        self.assertEqual(
+            evaluator.evaluate_ranked({
+                'q1': ['d3', 'd1', 'd2'],
+                'q2': ('d1', 'd2'),
+            }),
+            expected)
+
+        self.assertEqual(
+            evaluator.evaluate_ranked({
+                'q1': evaluator.intern_documents(['d3', 'd1', 'd2']),
+                'q2': evaluator.intern_documents(['d1', 'd2']),
+            }),
+            expected)
+
+        with self.assertRaises(ValueError):
+            evaluator.evaluate_ranked({'q1': ['d1', 'd1']})
+
+    def test_evaluate_threads(self):
+        qrel = {
+            'q{}'.format(query_idx): {
+                'd{}'.format(doc_idx): (query_idx + doc_idx) % 3
+                for doc_idx in range(20)
+            }
+            for query_idx in range(50)
+        }
+        run = {
+            'q{}'.format(query_idx): {
+                'd{}'.format(doc_idx): float((query_idx * doc_idx) % 11)
+                for doc_idx in range(30)
+            }
+            for query_idx in range(60)
+        }
+
+        evaluator = pytrec_eval.RelevanceEvaluator(
+            qrel, {'map', 'ndcg_cut.5', 'P.10', 'bpref'})
+
+        self.assertEqual(evaluator.evaluate(run, num_threads=4),
+                         evaluator.evaluate(run))
+
+        with self.assertRaises(ValueError):
+            evaluator.evaluate(run, num_threads=0)
+
+        # Measures are computed concurrently: with several threads, the
+        # process uses more CPU time than wall-clock time. The measures are
+        # fused (trec_eval's own are serialized) and have many cutoffs, such
+        # that computing them dominates converting the run.
+        if hasattr(os, 'sched_getaffinity'):
+            num_cpus = len(os.sched_getaffinity(0))
+        else:
+            num_cpus = os.cpu_count() or 1
+
+        if num_cpus < 4:
+            self.skipTest('requires at least 4 CPUs')
+
+        qrel = {
+            'q{}'.format(query_idx): {
+                'd{}'.format(doc_idx): (query_idx + doc_idx) % 3
+                for doc_idx in range(0, 200, 2)
+            }
+            for query_idx in range(2000)
+        }
+        run = {
+            'q{}'.format(query_idx): {
+                'd{}'.format(doc_idx): float((query_idx * doc_idx) % 101)
+                for doc_idx in range(100)
+            }
+            for query_idx in range(2000)
+        }
+
+        cutoffs = ','.join(str(cutoff) for cutoff in range(1, 501))
+
+        evaluator = pytrec_eval.RelevanceEvaluator(
+            qrel, {'map', 'ndcg', 'Rprec', 'recip_rank', 'bpref'} |
+            {'{}.{}'.format(measure, cutoffs)
+             for measure in ('P', 'recall', 'success', 'map_cut', 'ndcg_cut')})
+
+        self.assertEqual(
+            evaluator.evaluate(run, num_threads=4, aggregate='only'),
+            evaluator.evaluate(run, aggregate='only'))
+
+        cpu_time_ratios = []
+
+        for _ in range(3):
+            start_cpu_time = time.process_time()
+            start_time = time.perf_counter()
+
+            evaluator.evaluate(run, num_threads=4, aggregate='only')
+
+            cpu_time_ratios.append(
+                (time.process_time() - start_cpu_time) /
+                (time.perf_counter() - start_time))
+
+        self.assertGreater(max(cpu_time_ratios), 1.5)
+
+    def test_independent_evaluators(self):
+        qrel = {
+            'q1': {'d{}'.format(idx): int(idx % 4 == 0) for idx in range(20)},
+        }
+        run = {
+            'q1': {'d{}'.format(idx): 1.0 / (idx + 1) for idx in range(20)},
+        }
+
+        expected_5 = pytrec_eval.RelevanceEvaluator(
+            qrel, {'ndcg_cut.5'}).evaluate(run)
+
+        evaluator_5 = pytrec_eval.RelevanceEvaluator(qrel, {'ndcg_cut.5'})
+        evaluator_10 = pytrec_eval.RelevanceEvaluator(qrel, {'ndcg_cut.10'})
+        evaluator_default = pytrec_eval.RelevanceEvaluator(qrel, {'ndcg_cut'})
+
+        for _ in range(2):
+            self.assertEqual(evaluator_10.evaluate(run)['q1'].keys(),
+                             {'ndcg_cut_10'})
+            self.assertEqual(evaluator_5.evaluate(run), expected_5)
+            self.assertIn('ndcg_cut_1000',
+                          evaluator_default.evaluate(run)['q1'])
+
+    def test_judgment_statistics(self):
+        qrel = {
+            'q1': {'a': 2, 'b': 0, 'c': 1, 'd': -1, 'e': 1},
+        }
+        run = {
+            'q1': {'a': 0.9, 'x': 0.8, 'd': 0.7, 'c': 0.6},
+        }
+
+        measures = {'num_rel', 'num_rel_ret', 'num_ret', 'P.5'}
+
+        evaluator = pytrec_eval.RelevanceEvaluator(qrel, measures)
+        evaluator_level_2 = pytrec_eval.RelevanceEvaluator(
+            qrel, measures, relevance_level=2)
+        evaluator_other = pytrec_eval.RelevanceEvaluator(
+            {'q1': {'x': 1}}, measures)
+
+        for _ in range(2):
+            self.assertEqual(evaluator.evaluate(run), {
+                'q1': {'num_rel': 3.0, 'num_rel_ret': 2.0,
+                       'num_ret': 4.0, 'P_5': 0.4}})
+            self.assertEqual(evaluator_level_2.evaluate(run), {
+                'q1': {'num_rel': 1.0, 'num_rel_ret': 1.0,
+                       'num_ret': 4.0, 'P_5': 0.2}})
+            self.assertEqual(evaluator_other.evaluate(run), {
+                'q1': {'num_rel': 1.0, 'num_rel_ret': 1.0,
+                       'num_ret': 4.0, 'P_5': 0.2}})
+
+        # Queries whose labels are all negative have no relevant documents.
+        for fused in (True, False):
+            self.assertEqual(
+                pytrec_eval.RelevanceEvaluator(
+                    {'q1': {'a': -1, 'd': -2}}, {'num_rel', 'ndcg', 'bpref'},
+                    fused=fused).evaluate(run),
+                {'q1': {'num_rel': 0.0, 'ndcg': 0.0, 'bpref': 0.0}})
+
+    def test_evaluation_session(self):
+        qrel = {
+            'q{}'.format(query_idx): {
+                'd{}'.format(doc_idx): (query_idx + doc_idx) % 3
+                for doc_idx in range(10)
+            }
+            for query_idx in range(6)
+        }
+        run = {
+            'q{}'.format(query_idx): {
+                'd{}'.format(doc_idx): float((query_idx * doc_idx) % 7)
+                for doc_idx in range(10)
+            }
+            for query_idx in range(6)
+        }
+
+        evaluator = pytrec_eval.RelevanceEvaluator(
+            qrel, {'map', 'gm_map', 'num_rel_ret'})
+        session = pytrec_eval.EvaluationSession(evaluator, run)
+
+        partial_run = {
+            'q2': {'d{}'.format(doc_idx): float(doc_idx) for doc_idx in range(10)},
+            'q4': {'d1': 1.0},
+        }
+        run.update(partial_run)
+
+        self.assertEqual(session.update(partial_run).keys(), {'q2', 'q4'})
+
+        expected = evaluator.evaluate(run)
+        self.assertEqual(session.results, expected)
+
+        aggregates = session.aggregated_measures()
+
+        for measure in ('map', 'gm_map', 'num_rel_ret'):
+            self.assertAlmostEqual(
+                aggregates[measure],
+                pytrec_eval.compute_aggregated_measure(
+                    measure,
+                    [query_measures[measure]
+                     for query_measures in expected.values()]))
+
+    def test_evaluate_curves(self):
+        qrel = {
+            'q{}'.format(query_idx): {
+                'd{}'.format(doc_idx): (query_idx + doc_idx) % 4
+                for doc_idx in range(0, 30, query_idx + 1)
+            }
+            for query_idx in range(4)
+        }
+        run = {
+            'q{}'.format(query_idx): {
+                'd{}'.format(doc_idx): float((query_idx * doc_idx) % 13)
+                for doc_idx in range(20)
+            }
+            for query_idx in range(4)
+        }
+
+        cutoffs = [1, 2, 3, 5, 10, 20, 25]
+        measures = ['P', 'recall', 'success', 'map_cut', 'ndcg_cut']
+
+        evaluator = pytrec_eval.RelevanceEvaluator(
+            qrel, {'{}.{}'.format(measure, ','.join(map(str, cutoffs)))
+                   for measure in measures}, relevance_level=2)
+
+        expected = evaluator.evaluate(run)
+        curves = evaluator.evaluate_curves(run, measures, depth=25)
+
+        self.assertEqual(curves.keys(), expected.keys())
+
+        for query_id, query_curves in curves.items():
+            for measure in measures:
+                self.assertEqual(query_curves[measure].shape, (25,))
+
+                for cutoff in cutoffs:
+                    self.assertAlmostEqual(
+                        query_curves[measure][cutoff - 1],
+                        expected[query_id]['{}_{}'.format(measure, cutoff)])
+
+        with self.assertRaisesRegex(ValueError, 'Unsupported curve measure'):
+            evaluator.evaluate_curves(run, ['map'])
+
+    def test_with_measures(self):
+        qrel = {
+            'q1': {'d1': 2, 'd2': 1, 'd3': 0},
+            'q2': {'d2': 1, 'd4': 2},
+        }
+        run = {
+            'q1': {'d1': 0.2, 'd2': 0.9, 'd3': 0.5},
+            'q2': {'d1': 0.4, 'd4': 0.3},
+        }
+
+        evaluator = pytrec_eval.RelevanceEvaluator(qrel, {'map'}, depth=10)
+        ndcg_evaluator = evaluator.with_measures({'ndcg', 'P.2'})
+        strict_evaluator = ndcg_evaluator.with_measures(
+            {'map'}, relevance_level=2)
+
+        del evaluator
+
+        self.assertEqual(
+            ndcg_evaluator.evaluate(run),
+            pytrec_eval.RelevanceEvaluator(
+                qrel, {'ndcg', 'P.2'}).evaluate(run))
+        self.assertEqual(
+            strict_evaluator.evaluate(run),
+            pytrec_eval.RelevanceEvaluator(
+                qrel, {'map'}, relevance_level=2).evaluate(run))
+
+        self.assertEqual(strict_evaluator.query_relevance(), qrel)
+        self.assertEqual(
+            pickle.loads(pickle.dumps(strict_evaluator)).evaluate(run),
+            strict_evaluator.evaluate(run))
+
+        # Documents interned by a clone are private to it.
+        documents = ndcg_evaluator.interned_documents()
+
+        self.assertEqual(
+            strict_evaluator.intern_documents(['d5', 'd1']).tolist(),
+            [len(documents), documents.index('d1')])
+        strict_evaluator.set_candidates({'q1': ['d1', 'd6'], 'q2': ['d4']})
+
+        self.assertEqual(ndcg_evaluator.interned_documents(), documents)
+        self.assertEqual(
+            strict_evaluator.interned_documents(),
+            documents + ['d5', 'd6'])
+        self.assertEqual(
+            strict_evaluator.with_measures({'map'}).interned_documents(),
+            documents + ['d5', 'd6'])
+
+    def test_aggregate(self):
+        qrel = {
+            'q{}'.format(query_idx): {
+                'd{}'.format(doc_idx): (query_idx + doc_idx) % 3
+                for doc_idx in range(10)
+            }
+            for query_idx in range(5)
+        }
+        run = {
+            'q{}'.format(query_idx): {
+                'd{}'.format(doc_idx): float((query_idx * doc_idx) % 7)
+                for doc_idx in range(12)
+            }
+            for query_idx in range(6)
+        }
+
+        evaluator = pytrec_eval.RelevanceEvaluator(
+            qrel, {'map', 'gm_map', 'P.5,10', 'num_rel_ret', 'num_q'})
+
+        results = evaluator.evaluate(run)
+
+        for num_threads in (1, 3):
+            aggregated_results = evaluator.evaluate(
+                run, num_threads=num_threads, aggregate=True)
+            aggregates = aggregated_results.pop('all')
+
+            self.assertEqual(aggregated_results, results)
+            self.assertEqual(
+                evaluator.evaluate(
+                    run, num_threads=num_threads, aggregate='only'),
+                {'all': aggregates})
+
+            self.assertEqual(aggregates['num_q'], 5.0)
+
+            for measure, value in aggregates.items():
+                self.assertAlmostEqual(
+                    value,
+                    pytrec_eval.compute_aggregated_measure(
+                        measure,
+                        [query_measures[measure]
+                         for query_measures in results.values()]))
+
+        # Empty runs are still summarized.
+        self.assertEqual(evaluator.evaluate({}), {})
+        self.assertEqual(list(evaluator.evaluate({}, aggregate=True)), ['all'])
+
+        empty_aggregates = evaluator.evaluate({}, aggregate='only')
+
+        self.assertEqual(list(empty_aggregates), ['all'])
+        self.assertEqual(set(empty_aggregates['all']), set(aggregates))
+        self.assertEqual(empty_aggregates['all']['num_q'], 0.0)
+        self.assertEqual(empty_aggregates['all']['num_rel_ret'], 0.0)
+
+        with self.assertRaisesRegex(ValueError, 'reserved'):
+            pytrec_eval.RelevanceEvaluator(
+                {'all': {'d1': 1}}, {'map'}).evaluate(
+                    {'all': {'d1': 1.0}}, aggregate=True)
+
+    def test_columnar(self):
+        qrel = {
+            'q{}'.format(query_idx): {
+                'd{}'.format(doc_idx): (query_idx + doc_idx) % 3
+                for doc_idx in range(10)
+            }
+            for query_idx in range(5)
+        }
+        run = {
+            'q{}'.format(query_idx): {
+                'd{}'.format(doc_idx): float((query_idx * doc_idx) % 7)
+                for doc_idx in range(12)
+            }
+            for query_idx in range(6)
+        }
+
+        evaluator = pytrec_eval.RelevanceEvaluator(
+            qrel, {'map', 'P.5,10', 'num_rel_ret'})
+
+        results = evaluator.evaluate(run, aggregate=True)
+
+        for num_threads in (1, 3):
+            matrix = evaluator.evaluate(
+                run, num_threads=num_threads, aggregate=True, columnar=True)
+
+            self.assertEqual(matrix.values.shape, (len(results), 4))
+            self.assertEqual(sorted(matrix.measures),
+                             ['P_10', 'P_5', 'map', 'num_rel_ret'])
+            self.assertEqual(matrix.query_ids[-1], 'all')
+
+            self.assertEqual(
+                {query_id: dict(zip(matrix.measures, row))
+                 for query_id, row in zip(matrix.query_ids,
+                                          matrix.values.tolist())},
+                results)
+
+        only_aggregates = evaluator.evaluate(
+            run, aggregate='only', columnar=True)
+
+        self.assertEqual(only_aggregates.query_ids, ['all'])
+        self.assertEqual(
+            dict(zip(only_aggregates.measures,
+                     only_aggregates.values[0].tolist())),
+            results['all'])
+
+        empty = evaluator.evaluate({}, columnar=True)
+
+        self.assertEqual(empty.values.shape, (0, 4))
+        self.assertEqual(empty.query_ids, [])
+        self.assertEqual(empty.measures, matrix.measures)
+        self.assertEqual(evaluator.measures, matrix.measures)
+
+        empty_aggregates = evaluator.evaluate({}, aggregate=True, columnar=True)
+
+        self.assertEqual(empty_aggregates.values.shape, (1, 4))
+        self.assertEqual(empty_aggregates.query_ids, ['all'])
+
+    def test_lazy_results(self):
+        qrel = {
+            'q1': {'d1': 2, 'd2': 1, 'd3': 0},
+            'q2': {'d2': 1, 'd4': 2},
+        }
+        run = {
+            'q1': {'d1': 0.2, 'd2': 0.9, 'd3': 0.5},
+            'q2': {'d1': 0.4, 'd4': 0.3},
+            'q3': {'d1': 0.1},
+        }
+
+        evaluator = pytrec_eval.RelevanceEvaluator(qrel, {'map', 'P.1,2'})
+
+        results = evaluator.evaluate(run, aggregate=True)
+        lazy_results = evaluator.evaluate(run, aggregate=True, lazy=True)
+
+        self.assertIsInstance(lazy_results, pytrec_eval.EvaluationResults)
+        self.assertEqual(lazy_results, results)
+        self.assertEqual(len(lazy_results), 3)
+        self.assertNotIn('q3', lazy_results)
+        self.assertEqual(lazy_results['q1']['P_1'], results['q1']['P_1'])
+
+        self.assertEqual(
+            lazy_results.measure('map').tolist(),
+            [results[query_id]['map'] for query_id in lazy_results])
+
+        with self.assertRaises(ValueError):
+            lazy_results.measure('map')[0] = 1.0
+
+        empty_results = evaluator.evaluate({}, lazy=True)
+
+        self.assertEqual(len(empty_results), 0)
+        self.assertEqual(sorted(empty_results.measures), ['P_1', 'P_2', 'map'])
+        self.assertEqual(empty_results.measure('map').shape, (0,))
+
+    def test_evaluate_matrix_vectorized(self):
+        rng = np.random.RandomState(42)
+
+        qrel = {
+            'q{}'.format(query_idx): {
+                'd{}'.format(doc_idx): int(rng.randint(-1, 4))
+                for doc_idx in rng.choice(30, size=15, replace=False)
+            }
+            for query_idx in range(20)
+        }
+        candidates = {
+            'q{}'.format(query_idx): [
+                'd{}'.format(doc_idx)
+                for doc_idx in rng.choice(30, size=rng.randint(1, 25),
+                                          replace=False)]
+            for query_idx in range(25)  # Some queries are not judged.
+        }
+
+        for relevance_level, depth in ((1, None), (2, 10)):
+            evaluator = pytrec_eval.RelevanceEvaluator(
+                qrel, {'ndcg', 'ndcg_cut.3,10', 'P.1,5,30', 'recall.5',
+                       'map', 'recip_rank', 'Rprec'},
+                relevance_level=relevance_level, depth=depth)
+            evaluator.set_candidates(candidates)
+
+            # Includes ties, which are broken by decreasing document id.
+            scores = rng.randint(
+                0, 5, size=(25, max(map(len, candidates.values())))
+            ).astype(np.float32)
+
+            expected = evaluator.evaluate_matrix(scores)
+            results = evaluator.evaluate_matrix(scores, vectorized=True)
+
+            self.assertIsInstance(results, dict)
+            self.assertEqual(sorted(results), sorted(expected))
+
+            for query_id, query_measures in expected.items():
+                self.assertEqual(
+                    sorted(results[query_id]), sorted(query_measures))
+
+                for measure, value in query_measures.items():
+                    self.assertAlmostEqual(
+                        results[query_id][measure], value, places=10)
+
+            for vectorized in (False, True):
+                matrix = evaluator.evaluate_matrix(
+                    scores, vectorized=vectorized, columnar=True)
+
+                self.assertIsInstance(matrix, pytrec_eval.EvaluationMatrix)
+                self.assertEqual(matrix.measures, evaluator.measures)
+                self.assertEqual(
+                    matrix.values.shape,
+                    (len(expected), len(next(iter(expected.values())))))
+
+                for query_id, row in zip(matrix.query_ids, matrix.values):
+                    for measure, value in zip(matrix.measures, row):
+                        self.assertAlmostEqual(
+                            value, expected[query_id][measure], places=10)
+
+        evaluator = pytrec_eval.RelevanceEvaluator(qrel, {'bpref'})
+        evaluator.set_candidates(candidates)
+
+        with self.assertRaisesRegex(ValueError, 'vectorized'):
+            evaluator.evaluate_matrix(scores, vectorized=True)
+
+    def test_fused(self):
+        rng = np.random.RandomState(7)
+
+        qrel = {
+            'q{}'.format(query_idx): {
+                'd{}'.format(doc_idx): int(rng.randint(-1, 4))
+                for doc_idx in rng.choice(50, size=rng.randint(1, 30),
+                                          replace=False)
+            }
+            for query_idx in range(20)
+        }
+        run = {
+            'q{}'.format(query_idx): {
+                # Includes ties and unjudged documents.
+                'd{}'.format(doc_idx): float(rng.randint(0, 10))
+                for doc_idx in rng.choice(60, size=rng.randint(1, 40),
+                                          replace=False)
+            }
+            for query_idx in range(20)
+        }
+
+        for relevance_level, depth in ((1, None), (2, 15)):
+            evaluator = pytrec_eval.RelevanceEvaluator(
+                qrel, {'all_trec', 'P.3,7', 'ndcg_cut.4,100'},
+                relevance_level=relevance_level, depth=depth)
+            reference = pytrec_eval.RelevanceEvaluator(
+                qrel, {'all_trec', 'P.3,7', 'ndcg_cut.4,100'},
+                relevance_level=relevance_level, depth=depth, fused=False)
+
+            results = evaluator.evaluate(run)
+            expected = reference.evaluate(run)
+
+            self.assertEqual(sorted(results), sorted(expected))
+
+            for query_id, query_measures in expected.items():
+                self.assertEqual(
+                    sorted(results[query_id]), sorted(query_measures))
+
+                for measure, value in query_measures.items():
+                    self.assertAlmostEqual(
+                        results[query_id][measure], value,
+                        msg='{} of {}'.format(measure, query_id))
+
+    def test_significance(self):
+        from pytrec_eval import significance
+
+        rng = np.random.RandomState(0)
+
+        first = rng.rand(40, 3)
+        second = first + rng.normal(0.1, 0.1, size=first.shape)
+
+        result = significance.randomization_test(
+            first, second, num_permutations=2000, seed=42)
+
+        np.testing.assert_allclose(
+            result.statistic, (first - second).mean(axis=0))
+        self.assertEqual(result.pvalue.shape, (3,))
+        self.assertTrue(np.all(result.pvalue < 0.01))
+
+        # Permutations only depend on the seed.
+        np.testing.assert_array_equal(
+            result.pvalue,
+            significance.randomization_test(
+                first, second, num_permutations=2000, seed=42,
+                num_threads=4).pvalue)
+
+        self.assertEqual(
+            significance.randomization_test(
+                first[:, 0], first[:, 0], seed=1).pvalue, 1.0)
+
+        with self.assertRaisesRegex(ValueError, 'NaN'):
+            significance.randomization_test(first, np.full_like(first, np.nan))
+
+        # The aggregates of evaluate(..., aggregate=True) are not a query.
+        query_ids = ['q{}'.format(idx) for idx in range(40)] + ['all']
+
+        np.testing.assert_array_equal(
+            significance.randomization_test(
+                pytrec_eval.EvaluationMatrix(
+                    np.vstack([first, first.mean(axis=0)]), query_ids,
+                    ['map', 'P_5', 'ndcg']),
+                pytrec_eval.EvaluationMatrix(
+                    np.vstack([second, second.mean(axis=0)]), query_ids,
+                    ['map', 'P_5', 'ndcg']),
+                num_permutations=2000, seed=42),
+            result)
+
+        try:
+            import scipy.stats
+        except ImportError:
+            return
+
+        t_result = significance.t_test(first, second)
+        wilcoxon_result = significance.wilcoxon_test(first, second)
+
+        for measure_idx in range(first.shape[1]):
+            self.assertAlmostEqual(
+                t_result.pvalue[measure_idx],
+                scipy.stats.ttest_rel(
+                    first[:, measure_idx], second[:, measure_idx]).pvalue)
+            self.assertAlmostEqual(
+                wilcoxon_result.pvalue[measure_idx],
+                scipy.stats.wilcoxon(
+                    first[:, measure_idx], second[:, measure_idx]).pvalue)
+
+    def test_bootstrap_intervals(self):
+        rng = np.random.RandomState(0)
+
+        measures = ['map', 'num_rel', 'gm_map']
+
+        values = rng.rand(2, 50, 3)
+        values[..., 2] = np.log(values[..., 2])
+
+        tensor = pytrec_eval.EvaluationTensor(
+            values, ['q{}'.format(idx) for idx in range(50)], measures)
+
+        intervals = pytrec_eval.compute_bootstrap_intervals(
+            tensor, num_samples=2500, seed=42)
+
+        self.assertEqual(intervals.measures, measures)
+        self.assertEqual(intervals.lower.shape, (2, 3))
+
+        for run_idx in range(2):
+            for measure_idx, measure in enumerate(measures):
+                self.assertAlmostEqual(
+                    intervals.estimates[run_idx, measure_idx],
+                    pytrec_eval.compute_aggregated_measure(
+                        measure, values[run_idx, :, measure_idx]))
+
+        self.assertTrue(np.all(intervals.lower < intervals.estimates))
+        self.assertTrue(np.all(intervals.estimates < intervals.upper))
+
+        # All runs share the same resamples of the queries.
+        matrix = pytrec_eval.compute_bootstrap_intervals(
+            pytrec_eval.EvaluationMatrix(
+                values[1], tensor.query_ids, measures),
+            num_samples=2500, seed=42)
+
+        np.testing.assert_allclose(matrix.lower, intervals.lower[1])
+        np.testing.assert_allclose(matrix.upper, intervals.upper[1])
+
+        # The aggregates of evaluate(..., aggregate=True) are not a query.
+        aggregated = pytrec_eval.compute_bootstrap_intervals(
+            pytrec_eval.EvaluationMatrix(
+                np.vstack([values[1], values[1].mean(axis=0)]),
+                tensor.query_ids + ['all'], measures),
+            num_samples=2500, seed=42)
+
+        np.testing.assert_array_equal(aggregated.estimates, matrix.estimates)
+        np.testing.assert_array_equal(aggregated.lower, matrix.lower)
+        np.testing.assert_array_equal(aggregated.upper, matrix.upper)
+
+    def test_compare_runs(self):
+        from pytrec_eval import significance
+
+        rng = np.random.RandomState(0)
+
+        values = rng.rand(4, 40, 2)
+        values[1] += 0.5
+        values[3] = values[0]
+
+        comparison = significance.compare_runs(
+            values, num_permutations=2000, seed=42)
+
+        self.assertEqual(comparison.pvalues.shape, (4, 4, 2))
+
+        np.testing.assert_array_equal(
+            significance.compare_runs(
+                pytrec_eval.EvaluationTensor(
+                    np.concatenate(
+                        [values, values.mean(axis=1, keepdims=True)], axis=1),
+                    ['q{}'.format(idx) for idx in range(40)] + ['all'],
+                    ['map', 'ndcg']),
+                num_permutations=2000, seed=42).pvalues,
+            comparison.pvalues)
+
+        for first_idx in range(4):
+            self.assertTrue(
+                np.all(np.isnan(comparison.pvalues[first_idx, first_idx])))
+
+            for second_idx in range(4):
+                if first_idx == second_idx:
+                    continue
+
+                # All pairs share the same permutations.
+                result = significance.randomization_test(
+                    values[first_idx], values[second_idx],
+                    num_permutations=2000, seed=42)
+
+                np.testing.assert_allclose(
+                    comparison.differences[first_idx, second_idx],
+                    result.statistic)
+                np.testing.assert_allclose(
+                    comparison.pvalues[first_idx, second_idx], result.pvalue)
+
+        self.assertTrue(np.all(comparison.adjusted_pvalues[0, 1] < 0.01))
+        self.assertTrue(np.all(comparison.adjusted_pvalues[0, 3] == 1.0))
+        self.assertTrue(np.all(comparison.effect_sizes[1, 0] > 0))
+
+        np.testing.assert_allclose(
+            significance.adjust_pvalues([0.01, 0.04, 0.03, 0.005], 'holm'),
+            [0.03, 0.06, 0.06, 0.02])
+        np.testing.assert_allclose(
+            significance.adjust_pvalues([0.01, 0.04, 0.03, 0.005], 'fdr_bh'),
+            [0.02, 0.04, 0.04, 0.02])
+
+    def test_evaluation_accumulator(self):
+        qrel = {
+            'q{}'.format(query_idx): {
+                'd{}'.format(doc_idx): (query_idx + doc_idx) % 3
+                for doc_idx in range(10)
+            }
+            for query_idx in range(5)
+        }
+        run = {
+            'q{}'.format(query_idx): {
+                'd{}'.format(doc_idx): float((query_idx * doc_idx) % 7)
+                for doc_idx in range(12)
+            }
+            for query_idx in range(6)
+        }
+
+        evaluator = pytrec_eval.RelevanceEvaluator(
+            qrel, {'map', 'gm_map', 'P.5,10', 'num_rel_ret', 'num_q'})
+
+        accumulator = pytrec_eval.EvaluationAccumulator(evaluator)
+
+        added_run = {}
+
+        for query_id, ranking in sorted(run.items()):
+            self.assertEqual(accumulator.add(query_id, ranking),
+                             query_id in qrel)
+
+            added_run[query_id] = ranking
+
+            # Snapshots leave the running aggregates intact.
+            expected = evaluator.evaluate(added_run, aggregate='only')['all']
+            snapshot = accumulator.snapshot()
+
+            self.assertEqual(sorted(snapshot), sorted(expected))
+
+            for measure, value in expected.items():
+                self.assertAlmostEqual(snapshot[measure], value)
+
+        self.assertEqual(accumulator.num_queries, 5)
+
+        accumulator.reset()
+        self.assertEqual(accumulator.num_queries, 0)
+
+        # Rankings in order are accepted as well.
+        ranked_run = {
+            query_id: sorted(ranking, key=lambda docno: (ranking[docno], docno),
+                             reverse=True)
+            for query_id, ranking in run.items()
+        }
+
+        for query_id, ranking in ranked_run.items():
+            accumulator.add(query_id, ranking)
+
+        snapshot = accumulator.snapshot()
+
+        for measure, value in expected.items():
+            self.assertAlmostEqual(snapshot[measure], value)
+
+    def test_pickle_and_evaluate_parallel(self):
+        qrel = {
+            'q{}'.format(query_idx): {
+                'd{}'.format(doc_idx): (query_idx + doc_idx) % 3
+                for doc_idx in range(20)
+            }
+            for query_idx in range(10)
+        }
+        run = {
+            'q{}'.format(query_idx): {
+                'd{}'.format(doc_idx): float((query_idx * doc_idx) % 11)
+                for doc_idx in range(30)
+            }
+            for query_idx in range(10)
+        }
+
+        evaluator = pytrec_eval.RelevanceEvaluator(
+            qrel, {'map', 'ndcg_cut.5'}, depth=25)
+        docids = evaluator.intern_documents(['d3', 'd40'])
+        expected = evaluator.evaluate(run)
+
+        restored = pickle.loads(pickle.dumps(evaluator))
+
+        self.assertEqual(restored.evaluate(run), expected)
+        self.assertEqual(restored.query_relevance(), qrel)
+        self.assertEqual(restored.intern_documents(['d3', 'd40']).tolist(),
+                         docids.tolist())
+
+        self.assertEqual(evaluator.evaluate_parallel(run, processes=3),
+                         expected)
+
+        if 'fork' in multiprocessing.get_all_start_methods():
+            self.assertEqual(
+                evaluator.evaluate_parallel(run, processes=3,
+                                            start_method='fork'),
+                expected)
+
+        # Workers that do not inherit the evaluator receive a pickled copy.
+        self.assertEqual(
+            evaluator.evaluate_parallel(run, processes=2,
+                                        start_method='spawn'),
+            expected)
+
+    def test_evaluate_many(self):
+        qrel = {
+            '{}'.format(query_idx): {
+                '{}'.format(doc_idx): (query_idx + doc_idx) % 3
+                for doc_idx in range(20)
+            }
+            for query_idx in range(5)
+        }
+        runs = [
+            {
+                '{}'.format(query_idx): {
+                    '{}'.format(doc_idx): float((query_idx * doc_idx + seed) % 7)
+                    for doc_idx in range(25)
+                }
+                for query_idx in range(5) if (query_idx + seed) % 4
+            }
+            for seed in range(3)
+        ]
+
+        evaluator = pytrec_eval.RelevanceEvaluator(
+            qrel, {'map', 'P.5,10', 'ndcg'})
+
+        qids = np.array([1, 1, 1, 3, 3], dtype=np.int64)
+        docids = np.array([0, 1, 2, 0, 4], dtype=np.int64)
+        scores = np.array([0.5, 0.2, 0.9, 0.1, 0.3])
+
+        for num_threads in (1, 3):
+            tensor = evaluator.evaluate_many(
+                runs + [(qids, docids, scores)], num_threads=num_threads)
+
+            self.assertEqual(tensor.values.shape,
+                             (len(runs) + 1, len(qrel), len(tensor.measures)))
+            self.assertEqual(sorted(tensor.query_ids), sorted(qrel))
+            self.assertEqual(sorted(tensor.measures),
+                             ['P_10', 'P_5', 'map', 'ndcg'])
+
+            expected_results = [evaluator.evaluate(run) for run in runs]
+            expected_results.append(
+                evaluator.evaluate_arrays(qids, docids, scores))
+
+            for run_idx, expected in enumerate(expected_results):
+                for query_idx, qid in enumerate(tensor.query_ids):
+                    for measure_idx, measure in enumerate(tensor.measures):
+                        value = tensor.values[run_idx, query_idx, measure_idx]
+
+                        if qid in expected:
+                            self.assertAlmostEqual(
+                                value, expected[qid][measure])
+                        else:
+                            self.assertTrue(np.isnan(value))
+
 # TODO(cvangysel): add tests to detect memory leaks.
 class PyTrecEvalIntegrationTest(unittest.TestCase):
 